@@ -0,0 +1,320 @@
+import os
+import sys
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from .SGLXMetaToCoords import readMeta, ChannelCountsIM, geomMapToGeom, shankMapToGeom
+from .snippets import plan_snippet_reads, extract_block_snippets
+from .spike_index import SpikeIndex
+from .snippet_cache import SnippetCache
+from .spike_selection import load_or_select_spikes
+from .epoch import Epoch
+
+
+def c_waves(spikeglx_bin,
+            clus_table_npy,
+            clus_time_npy,
+            clus_lbl_npy,
+            dest,
+            samples_per_spike = 82,
+            pre_samples = 20,
+            num_spikes = 1000,
+            snr_radius = 8,
+            snr_radius_um = None,
+            prefix = '',
+            bit_volts = 0.195,
+            num_threads = None,
+            chunk_bytes = 2**26,
+            cache_dir = None,
+            spike_selection_file = None,
+            spike_selection_seed = 0,
+            prefer_isolated_spikes = False):
+
+    """
+    In-package replacement for the C_Waves executable
+
+    Takes the same inputs as C_Waves and writes the same two files to dest,
+    with the same names, shapes and dtypes:
+
+        <prefix>_mean_waveforms.npy : float32 (num_clusters x num_AP_channels x samples_per_spike)
+            Mean waveform of each cluster in uV; zeros for clusters with no spikes
+        <prefix>_cluster_snr.npy : float32 (num_clusters x 2)
+            SNR and number of spikes averaged for each cluster
+
+    (no prefix and no underscore if prefix is empty). num_clusters is the
+    number of rows in clus_Table.
+
+    Up to num_spikes spikes are averaged per cluster, evenly spaced through
+    the cluster's spike train. The binary is read in time-ordered blocks of
+    about chunk_bytes by a pool of num_threads threads; each block's snippets
+    are summed into per-cluster accumulators (sums of int16 values in float64
+    are exact, so the result does not depend on thread scheduling).
+
+    SNR is the peak-to-peak amplitude of the mean waveform on the peak channel
+    (column 1 of clus_Table) divided by twice the standard deviation of the
+    single-spike residuals about the mean, pooled over the sites within
+    snr_radius_um of the peak site on the same shank (site geometry from
+    the .meta file), or within snr_radius channels if snr_radius_um is not
+    given. With a radius of 0 this is the same as the SNR of the Python
+    mean waveforms path.
+
+    If cache_dir is given, snippets (all saved channels) are read from and
+    added to a SnippetCache there, in a single thread, instead of from the
+    binary.
+
+    If spike_selection_file is given, the spikes are instead the
+    'complete_session' selection of the Python mean waveforms path (see
+    spike_selection.load_or_select_spikes), read from that file or made and
+    saved there, so both paths average the same spikes.
+
+    Inputs:
+    -------
+    spikeglx_bin : str
+        Path to the SpikeGLX AP band binary; the .meta file must be next to it
+    clus_table_npy : str
+        Path to clus_Table.npy (num_clusters x 2; spike count, peak channel)
+    clus_time_npy : str
+        Path to spike_times.npy (samples)
+    clus_lbl_npy : str
+        Path to spike_clusters.npy
+    dest : str
+        Output directory
+
+    Outputs:
+    --------
+    mean_waveforms_file : str
+    snr_file : str
+
+    """
+
+    meta = readMeta(Path(os.path.splitext(spikeglx_bin)[0] + '.meta'))
+    num_saved_channels = int(meta['nSavedChans'])
+    num_ap_channels, num_lf_channels, num_sy_channels = ChannelCountsIM(meta)
+
+    num_samples = os.path.getsize(spikeglx_bin) // (2 * num_saved_channels)
+
+    clus_table = np.load(clus_table_npy)
+    spike_times = np.squeeze(np.load(clus_time_npy))
+    spike_clusters = np.squeeze(np.load(clus_lbl_npy)).astype('int64')
+
+    num_clusters = clus_table.shape[0]
+    peak_channels = clus_table[:, 1].astype('int64')
+
+    # spikes labelled beyond the end of clus_Table are ignored, as in C_Waves
+    in_table = spike_clusters < num_clusters
+
+    if spike_selection_file is None:
+        selected = select_spikes(spike_clusters[in_table], num_clusters, num_spikes)
+        selected = np.where(in_table)[0][selected]
+    else:
+        selection = load_or_select_spikes(spike_selection_file, spike_times, spike_clusters,
+                                          [Epoch('complete_session', 0, np.inf)],
+                                          float(meta['imSampRate']), num_spikes,
+                                          spike_selection_seed, prefer_isolated_spikes, samples_per_spike)
+        selected = selection.for_epoch('complete_session')
+        selected = selected[in_table[selected]]
+
+    sums = np.zeros((num_clusters, num_ap_channels, samples_per_spike), dtype = 'float64')
+    sums_sq = np.zeros((num_clusters, num_ap_channels, samples_per_spike), dtype = 'float64')
+    counts = np.zeros((num_clusters,), dtype = 'int64')
+
+    chunk_samples = max(chunk_bytes // (2 * num_saved_channels), samples_per_spike)
+
+    order, sorted_starts, blocks = plan_snippet_reads(spike_times[selected], pre_samples, samples_per_spike, num_samples, chunk_samples)
+
+    sorted_clusters = spike_clusters[selected][order]
+
+    lock = threading.Lock()
+    batch_size = 256
+
+    def add_snippets(labels, snippets_at):
+
+        # group the snippets by cluster; sum each group in batches of a few
+        # hundred snippets to bound memory per thread. snippets_at(rows)
+        # returns the snippets for the given rows of labels
+        by_cluster = np.argsort(labels, kind = 'stable')
+        labels = labels[by_cluster]
+
+        for batch_start in range(0, labels.size, batch_size):
+
+            batch_labels = labels[batch_start:batch_start+batch_size]
+            batch_snippets = snippets_at(by_cluster[batch_start:batch_start+batch_size]).astype('int32')
+
+            group_starts = np.concatenate(([0], np.where(np.diff(batch_labels) > 0)[0] + 1))
+            batch_clusters = batch_labels[group_starts]
+
+            batch_sums = np.add.reduceat(batch_snippets, group_starts, axis = 0, dtype = 'float64')
+            batch_sums_sq = np.add.reduceat(batch_snippets * batch_snippets, group_starts, axis = 0, dtype = 'float64')
+            batch_counts = np.diff(np.concatenate((group_starts, [batch_labels.size])))
+
+            with lock:
+                sums[batch_clusters] += batch_sums
+                sums_sq[batch_clusters] += batch_sums_sq
+                counts[batch_clusters] += batch_counts
+
+    def accumulate(block_range):
+
+        first, last = block_range
+
+        block_start = sorted_starts[first]
+        block_end = sorted_starts[last-1] + samples_per_spike
+
+        block = np.fromfile(spikeglx_bin, dtype = 'int16',
+                            count = (block_end - block_start) * num_saved_channels,
+                            offset = int(block_start) * num_saved_channels * 2)
+        block = block.reshape(-1, num_saved_channels)[:, :num_ap_channels]
+
+        offsets = sorted_starts[first:last] - block_start
+
+        add_snippets(sorted_clusters[first:last],
+                     lambda rows: extract_block_snippets(block, offsets[rows], samples_per_spike))
+
+    if cache_dir is None:
+
+        with ThreadPoolExecutor(max_workers = num_threads) as pool:
+            for _ in pool.map(accumulate, blocks):
+                pass
+
+    else:
+
+        raw_data = np.memmap(spikeglx_bin, dtype = 'int16', mode = 'r', shape = (num_samples, num_saved_channels))
+        snippet_cache = SnippetCache(cache_dir, spikeglx_bin, spike_times, pre_samples, samples_per_spike, num_saved_channels)
+
+        for positions, snippets in snippet_cache.iter_snippets(raw_data, spike_times, selected, chunk_bytes):
+            add_snippets(spike_clusters[selected[positions]], lambda rows: snippets[rows, :num_ap_channels, :])
+
+    site_x, site_y, site_shank = site_geometry(meta, num_ap_channels)
+
+    mean_waveforms = np.zeros((num_clusters, num_ap_channels, samples_per_spike), dtype = 'float32')
+    cluster_snr = np.zeros((num_clusters, 2), dtype = 'float32')
+
+    for cluster_id in np.where(counts > 0)[0]:
+
+        n = counts[cluster_id]
+        mean = sums[cluster_id] / n
+        variance = np.maximum(sums_sq[cluster_id] / n - mean * mean, 0)
+
+        peak = peak_channels[cluster_id]
+        disk = snr_disk(peak, site_x, site_y, site_shank, snr_radius, snr_radius_um)
+
+        noise = np.sqrt(np.mean(variance[disk, :]))
+        amplitude = np.max(mean[peak, :]) - np.min(mean[peak, :])
+
+        mean_waveforms[cluster_id] = mean * bit_volts
+        cluster_snr[cluster_id, 0] = amplitude / (2 * noise) if noise > 0 else 0
+        cluster_snr[cluster_id, 1] = n
+
+    name_prefix = prefix + '_' if len(prefix) > 0 else ''
+
+    mean_waveforms_file = os.path.join(dest, name_prefix + 'mean_waveforms.npy')
+    snr_file = os.path.join(dest, name_prefix + 'cluster_snr.npy')
+
+    np.save(mean_waveforms_file, mean_waveforms)
+    np.save(snr_file, cluster_snr)
+
+    return mean_waveforms_file, snr_file
+
+
+def c_waves_executable(cWaves_path,
+                       spikeglx_bin,
+                       clus_table_npy,
+                       clus_time_npy,
+                       clus_lbl_npy,
+                       dest,
+                       samples_per_spike = 82,
+                       pre_samples = 20,
+                       num_spikes = 1000,
+                       snr_radius = 8,
+                       snr_radius_um = None,
+                       prefix = ''):
+
+    """
+    Runs the C_Waves executable in cWaves_path (through runit.bat on
+    Windows, runit.sh on linux) with the same inputs as c_waves, and returns
+    the paths of the two files it writes
+
+    """
+
+    # path to the 'runit.bat' executable that calls C_Waves.
+    # Essential in linux where C_Waves executable is only callable through runit
+    if sys.platform.startswith('win'):
+        exe_path = os.path.join(cWaves_path, 'runit.bat')
+    elif sys.platform.startswith('linux'):
+        exe_path = os.path.join(cWaves_path, 'runit.sh')
+    else:
+        raise OSError('unknown system, cannot run C_Waves')
+
+    cwaves_cmd = [exe_path,
+                  '-spikeglx_bin=' + spikeglx_bin,
+                  '-clus_table_npy=' + clus_table_npy,
+                  '-clus_time_npy=' + clus_time_npy,
+                  '-clus_lbl_npy=' + clus_lbl_npy,
+                  '-dest=' + dest,
+                  '-samples_per_spike=' + repr(samples_per_spike),
+                  '-pre_samples=' + repr(pre_samples),
+                  '-num_spikes=' + repr(num_spikes),
+                  '-snr_radius=' + repr(snr_radius)]
+
+    if snr_radius_um is not None:
+        cwaves_cmd.append('-snr_radius_um=' + repr(snr_radius_um))
+
+    if len(prefix) > 0:
+        cwaves_cmd.append('-prefix=' + prefix)
+
+    print(' '.join(cwaves_cmd))
+
+    # arguments are passed as a list, so no shell is needed on either system
+    subprocess.call(cwaves_cmd)
+
+    name_prefix = prefix + '_' if len(prefix) > 0 else ''
+
+    return os.path.join(dest, name_prefix + 'mean_waveforms.npy'), os.path.join(dest, name_prefix + 'cluster_snr.npy')
+
+
+def select_spikes(spike_clusters, total_units, max_per_cluster):
+
+    """
+    Indices of up to max_per_cluster spikes for each cluster, evenly spaced
+    through each cluster's spike train (all spikes for smaller clusters)
+
+    """
+
+    spike_index = SpikeIndex(spike_clusters, total_units)
+
+    take = np.minimum(spike_index.counts, max_per_cluster)
+    labels = np.repeat(np.arange(total_units), take)
+    rank = np.arange(labels.size) - np.repeat(np.cumsum(take) - take, take)
+
+    # rank-th of take[c] evenly spaced positions among counts[c] spikes
+    position = (rank * spike_index.counts[labels]) // np.maximum(take[labels], 1)
+
+    return np.sort(spike_index.order[spike_index.offsets[labels] + position])
+
+
+def site_geometry(meta, num_ap_channels):
+
+    """ x, y (um) and shank index of each AP channel, from the .meta file """
+
+    if 'snsGeomMap' in meta:
+        nShank, shankWidth, shankPitch, shankInd, xCoord, yCoord, connected = geomMapToGeom(meta)
+    else:
+        nShank, shankWidth, shankPitch, shankInd, xCoord, yCoord, connected = shankMapToGeom(meta)
+
+    return np.asarray(xCoord)[:num_ap_channels], np.asarray(yCoord)[:num_ap_channels], np.asarray(shankInd)[:num_ap_channels]
+
+
+def snr_disk(peak_channel, site_x, site_y, site_shank, snr_radius, snr_radius_um = None):
+
+    """ Channels used for the SNR noise estimate of a unit with this peak channel """
+
+    if snr_radius_um is not None and snr_radius_um > 0:
+        distance = np.sqrt((site_x - site_x[peak_channel])**2 + (site_y - site_y[peak_channel])**2)
+        return np.where((distance <= snr_radius_um) * (site_shank == site_shank[peak_channel]))[0]
+
+    channels = np.arange(site_x.size)
+
+    return np.where(np.abs(channels - peak_channel) <= snr_radius)[0]
@@ -0,0 +1,182 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+import psutil
+
+
+# profilers that are currently recording, innermost last
+_active_profilers = []
+
+
+class StageProfiler():
+
+    """
+    Records wall time, CPU time and peak resident memory for named stages
+
+    Typical use in a module's main function:
+
+        profiler = StageProfiler()
+
+        with profiler:
+            with stage('load'):
+                ...
+            metrics = calculate_metrics(...)   # records its own stages
+
+        output['stage_profile'] = profiler.summary()
+
+    While the profiler is active (inside the with block), stage() and
+    @profiled record into it from anywhere in the call tree; with no active
+    profiler they do nothing. A stage that runs more than once (e.g. once per
+    epoch) accumulates its times.
+
+    CPU time is for this process only (worker processes are not included).
+    Peak RSS is sampled by one background thread every sample_interval
+    seconds while the profiler is active, and at the start and end of each
+    stage, so stages shorter than sample_interval can miss brief peaks.
+
+    """
+
+    def __init__(self, sample_interval = 0.05):
+
+        self.sample_interval = sample_interval
+        self.stages = OrderedDict()
+        self._process = psutil.Process(os.getpid())
+
+        # peak RSS of each stage that is currently running (stages can nest)
+        self._open_peaks = {}
+        self._lock = threading.Lock()
+        self._done = None
+        self._sampler = None
+
+
+    def __enter__(self):
+
+        _active_profilers.append(self)
+
+        self._done = threading.Event()
+        self._sampler = threading.Thread(target = self._sample, daemon = True)
+        self._sampler.start()
+
+        return self
+
+
+    def __exit__(self, *exc):
+
+        self._done.set()
+        self._sampler.join()
+
+        _active_profilers.remove(self)
+        return False
+
+
+    @contextmanager
+    def stage(self, name):
+
+        """ Context manager that records one run of the stage 'name' """
+
+        token = object()
+
+        with self._lock:
+            self._open_peaks[token] = self._rss()
+
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+
+        try:
+            yield
+        finally:
+            wall_time = time.perf_counter() - wall_start
+            cpu_time = time.process_time() - cpu_start
+
+            with self._lock:
+                peak = self._open_peaks.pop(token)
+
+            self._record(name, wall_time, cpu_time, max(peak, self._rss()))
+
+
+    def summary(self):
+
+        """ Returns a dict of stage name -> {wall_time, cpu_time, peak_rss_mb, calls} """
+
+        return OrderedDict((name, dict(entry)) for name, entry in self.stages.items())
+
+
+    def _rss(self):
+
+        return self._process.memory_info().rss
+
+
+    def _sample(self):
+
+        while not self._done.wait(self.sample_interval):
+            rss = self._rss()
+            with self._lock:
+                for token in self._open_peaks:
+                    self._open_peaks[token] = max(self._open_peaks[token], rss)
+
+
+    def _record(self, name, wall_time, cpu_time, peak_rss):
+
+        if name not in self.stages:
+            self.stages[name] = OrderedDict((('wall_time', 0.0), ('cpu_time', 0.0), ('peak_rss_mb', 0.0), ('calls', 0)))
+
+        entry = self.stages[name]
+        entry['wall_time'] += wall_time
+        entry['cpu_time'] += cpu_time
+        entry['peak_rss_mb'] = max(entry['peak_rss_mb'], peak_rss / 2**20)
+        entry['calls'] += 1
+
+
+@contextmanager
+def stage(name):
+
+    """ Records the enclosed block as stage 'name' of the active StageProfiler, if there is one """
+
+    if len(_active_profilers) == 0:
+        yield
+    else:
+        with _active_profilers[-1].stage(name):
+            yield
+
+
+def profiled(name):
+
+    """ Decorator version of stage() """
+
+    def decorator(func):
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def profile_stages(func):
+
+    """
+    Decorator for a module's main function (args -> output dict)
+
+    Runs the function under a new StageProfiler and adds the breakdown
+    to the output manifest as 'stage_profile'
+
+    """
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+
+        with StageProfiler() as profiler:
+            output = func(*args, **kwargs)
+
+        output['stage_profile'] = profiler.summary()
+
+        return output
+
+    return wrapper
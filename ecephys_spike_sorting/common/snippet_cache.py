@@ -0,0 +1,268 @@
+import os
+import glob
+import json
+import hashlib
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from .snippets import iter_snippets
+
+
+class SnippetCache():
+
+    """
+    On-disk cache of raw data snippets around spikes, shared by the mean
+    waveforms paths that read them from the AP band binary (the Python path
+    and the in-package C_Waves engine)
+
+    Spike time alignment in kilosort_postprocessing does not use it: that
+    module saves shifted, de-duplicated spike times, so a cache keyed on the
+    spike times before it ran could never be read again.
+
+    For each window, cache_dir holds:
+
+        snippets_<pre>_<samples>_<channels>.npy
+            int16 (num_cached x num_channels x samples_per_spike)
+        snippets_<pre>_<samples>_<channels>_index.npy
+            int64 index into spike_times of each cached snippet (sorted)
+        snippets_<pre>_<samples>_<channels>.json
+            key the cache was written with
+
+    The key is the binary's size and modification time and a hash of the
+    spike times; a cache with a different key is ignored and replaced.
+    Spikes are identified by their index into spike_times, which curation
+    does not change, so reruns after merges and splits in phy read from the
+    cache.
+
+    Cached snippets are read from a memory-mapped file. Snippets that are not
+    cached are read from the binary and staged in a pending file; by default
+    they are merged into the cache once the reading generator is exhausted.
+    Callers that read in several passes (e.g. one per batch of clusters)
+    pass merge = False and call merge_pending() once at the end, so the
+    cache file is rewritten once rather than once per pass.
+
+    """
+
+    def __init__(self, cache_dir, raw_data_file, spike_times, pre_samples, samples_per_spike, num_channels):
+
+        """
+        cache_dir : str
+            Created if needed
+        raw_data_file : str
+            AP band binary the snippets are read from
+        spike_times : numpy.ndarray (num_spikes x 0)
+            All spike times (samples)
+        pre_samples, samples_per_spike : int
+            Snippet window
+        num_channels : int
+            Channels per sample in raw_data_file
+
+        """
+
+        self.pre_samples = pre_samples
+        self.samples_per_spike = samples_per_spike
+        self.num_channels = num_channels
+
+        name = 'snippets_' + repr(pre_samples) + '_' + repr(samples_per_spike) + '_' + repr(num_channels)
+
+        self.snippets_file = os.path.join(cache_dir, name + '.npy')
+        self.index_file = os.path.join(cache_dir, name + '_index.npy')
+        self.key_file = os.path.join(cache_dir, name + '.json')
+        self.pending_prefix = os.path.join(cache_dir, name + '_pending_')
+
+        # (pending file, spike indices) of snippets read but not yet merged
+        self.pending = []
+
+        self.key = snippet_cache_key(raw_data_file, spike_times, pre_samples, samples_per_spike, num_channels)
+
+        self.index = np.zeros((0,), dtype = 'int64')
+        self.snippets = np.zeros((0, num_channels, samples_per_spike), dtype = 'int16')
+
+        os.makedirs(cache_dir, exist_ok = True)
+
+        # pending files left by an interrupted run are never merged
+        for leftover in glob.glob(self.pending_prefix + '*.npy'):
+            os.remove(leftover)
+
+        if os.path.exists(self.key_file):
+
+            with open(self.key_file) as f:
+                stored_key = json.load(f)
+
+            if stored_key == self.key and os.path.exists(self.snippets_file) and os.path.exists(self.index_file):
+                self.index = np.load(self.index_file)
+                self.snippets = np.load(self.snippets_file, mmap_mode = 'r')
+
+
+    def iter_snippets(self, raw_data, spike_times, spike_indices, chunk_bytes = 2**26, merge = True):
+
+        """
+        Snippets around spike_times[spike_indices], in blocks; same outputs as
+        snippets.iter_snippets, with positions indexing spike_indices
+
+        Cached snippets come first, in the order they are stored; the rest are
+        read from raw_data in time order and staged for the cache, then merged
+        into it at the end if merge is True (see merge_pending).
+
+        """
+
+        spike_indices = np.asarray(spike_indices).astype('int64')
+
+        rows = np.searchsorted(self.index, spike_indices)
+        hit = rows < self.index.size
+        hit[hit] = self.index[rows[hit]] == spike_indices[hit]
+
+        snippet_bytes = self.num_channels * self.samples_per_spike * 2
+        rows_per_read = max(chunk_bytes // snippet_bytes, 1)
+
+        hit_positions = np.where(hit)[0]
+        hit_positions = hit_positions[np.argsort(rows[hit_positions], kind = 'stable')]
+
+        for first in range(0, hit_positions.size, rows_per_read):
+            positions = hit_positions[first:first+rows_per_read]
+            yield positions, np.asarray(self.snippets[rows[positions]])
+
+        miss_positions = np.where(~hit)[0]
+
+        if miss_positions.size == 0:
+            return
+
+        # snippets read from the binary are staged on disk, then merged
+        pending_file = self.pending_prefix + repr(len(self.pending)) + '.npy'
+        pending = open_memmap(pending_file, mode = 'w+', dtype = 'int16',
+                              shape = (miss_positions.size, self.num_channels, self.samples_per_spike))
+        pending_indices = []
+        num_pending = 0
+
+        for positions, snippets in iter_snippets(raw_data,
+                                                 spike_times[spike_indices[miss_positions]],
+                                                 self.pre_samples,
+                                                 self.samples_per_spike,
+                                                 chunk_bytes):
+
+            yield miss_positions[positions], snippets
+
+            pending[num_pending:num_pending+positions.size] = snippets
+            pending_indices.append(spike_indices[miss_positions[positions]])
+            num_pending += positions.size
+
+        pending.flush()
+        del pending
+
+        if num_pending > 0:
+            self.pending.append((pending_file, np.concatenate(pending_indices)))
+        else:
+            os.remove(pending_file)
+
+        if merge:
+            self.merge_pending(chunk_bytes)
+
+
+    def read_snippets(self, raw_data, spike_times, spike_indices, chunk_bytes = 2**26, merge = True):
+
+        """
+        Snippets around spike_times[spike_indices], in that order; same outputs
+        as snippets.read_snippets
+
+        """
+
+        snippets = np.zeros((len(spike_indices), self.num_channels, self.samples_per_spike), dtype = 'int16')
+        valid = np.zeros((len(spike_indices),), dtype = 'bool')
+
+        for positions, block_snippets in self.iter_snippets(raw_data, spike_times, spike_indices, chunk_bytes, merge):
+            snippets[positions] = block_snippets
+            valid[positions] = True
+
+        return snippets, valid
+
+
+    def merge_pending(self, chunk_bytes = 2**26):
+
+        """
+        Rewrites the cache with all staged snippets merged in, in chunks, and
+        swaps the new files into place
+
+        """
+
+        if len(self.pending) == 0:
+            return
+
+        segments = [np.load(pending_file, mmap_mode = 'r') for pending_file, _ in self.pending]
+
+        new_indices = np.concatenate([indices for _, indices in self.pending])
+        new_segments = np.concatenate([np.full(indices.shape, k) for k, (_, indices) in enumerate(self.pending)])
+        new_rows = np.concatenate([np.arange(indices.size) for _, indices in self.pending])
+
+        new_indices, first_occurrence = np.unique(new_indices, return_index = True)
+        new_segments = new_segments[first_occurrence]
+        new_rows = new_rows[first_occurrence]
+
+        keep_new = ~np.isin(new_indices, self.index)
+        new_indices = new_indices[keep_new]
+        new_segments = new_segments[keep_new]
+        new_rows = new_rows[keep_new]
+
+        # source of each merged row: -1 for the existing cache, otherwise the pending segment
+        merged_index = np.concatenate((self.index, new_indices))
+        source = np.concatenate((np.full(self.index.shape, -1), new_segments))
+        source_rows = np.concatenate((np.arange(self.index.size), new_rows))
+
+        order = np.argsort(merged_index, kind = 'stable')
+
+        tmp_file = self.snippets_file + '.tmp.npy'
+        merged = open_memmap(tmp_file, mode = 'w+', dtype = 'int16',
+                             shape = (merged_index.size, self.num_channels, self.samples_per_spike))
+
+        rows_per_write = max(chunk_bytes // (self.num_channels * self.samples_per_spike * 2), 1)
+
+        for first in range(0, order.size, rows_per_write):
+
+            chunk = order[first:first+rows_per_write]
+            block = np.empty((chunk.size, self.num_channels, self.samples_per_spike), dtype = 'int16')
+
+            for segment in np.unique(source[chunk]):
+                from_segment = source[chunk] == segment
+                rows = source_rows[chunk[from_segment]]
+                block[from_segment] = self.snippets[rows] if segment < 0 else segments[segment][rows]
+
+            merged[first:first+chunk.size] = block
+
+        merged.flush()
+        del merged
+
+        # the key is removed first, so an interrupted swap leaves no valid cache
+        self.snippets = None
+
+        if os.path.exists(self.key_file):
+            os.remove(self.key_file)
+
+        np.save(self.index_file, merged_index[order])
+        os.replace(tmp_file, self.snippets_file)
+
+        with open(self.key_file, 'w') as f:
+            json.dump(self.key, f)
+
+        self.index = merged_index[order]
+        self.snippets = np.load(self.snippets_file, mmap_mode = 'r')
+
+        del segments
+
+        for pending_file, _ in self.pending:
+            os.remove(pending_file)
+
+        self.pending = []
+
+
+def snippet_cache_key(raw_data_file, spike_times, pre_samples, samples_per_spike, num_channels):
+
+    """ Identifies the binary, spike times and window a snippet cache was written for """
+
+    spike_times = np.ascontiguousarray(np.squeeze(spike_times), dtype = 'int64')
+
+    return {'raw_data_size' : os.path.getsize(raw_data_file),
+            'raw_data_mtime' : os.path.getmtime(raw_data_file),
+            'spike_times_sha1' : hashlib.sha1(spike_times).hexdigest(),
+            'pre_samples' : int(pre_samples),
+            'samples_per_spike' : int(samples_per_spike),
+            'num_channels' : int(num_channels)}
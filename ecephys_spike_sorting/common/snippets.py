@@ -0,0 +1,133 @@
+import numpy as np
+
+
+def snippet_starts(spike_times, pre_samples):
+
+    """ First sample of the snippet around each spike (int64) """
+
+    return np.asarray(spike_times).astype('int64') - pre_samples
+
+
+def plan_snippet_reads(spike_times, pre_samples, samples_per_spike, num_samples, chunk_samples):
+
+    """
+    Groups snippets into sequential reads
+
+    Spikes whose snippet would extend past either end of the data are dropped;
+    the rest are sorted by start time and split into blocks, each covering at
+    most chunk_samples samples (or one snippet, if that is longer).
+
+    Outputs:
+    --------
+    order : numpy.ndarray
+        Indices into spike_times of the readable snippets, in time order
+    sorted_starts : numpy.ndarray
+        First sample of each snippet, in time order
+    blocks : list of (first, last) tuples
+        Ranges of order / sorted_starts read together
+
+    """
+
+    starts = snippet_starts(spike_times, pre_samples)
+
+    valid = np.where((starts >= 0) * (starts + samples_per_spike <= num_samples))[0]
+    order = valid[np.argsort(starts[valid], kind = 'stable')]
+    sorted_starts = starts[order]
+
+    blocks = []
+    first = 0
+
+    while first < order.size:
+
+        # all snippets that end within chunk_samples of the first one
+        last = np.searchsorted(sorted_starts, sorted_starts[first] + chunk_samples - samples_per_spike, side = 'right')
+        last = max(last, first + 1)
+
+        blocks.append((first, last))
+        first = last
+
+    return order, sorted_starts, blocks
+
+
+def extract_block_snippets(block, offsets, samples_per_spike):
+
+    """ Snippets (num_snippets x num_channels x samples_per_spike) starting at offsets into a block of raw data """
+
+    snippets = block[offsets[:, np.newaxis] + np.arange(samples_per_spike), :]
+
+    return np.transpose(snippets, (0, 2, 1))
+
+
+def iter_snippets(raw_data, spike_times, pre_samples, samples_per_spike, chunk_bytes = 2**26):
+
+    """
+    Reads the raw data snippet around each spike, in order of spike time
+
+    The spikes are sorted by time and the file is read in large sequential
+    blocks, each covering as many consecutive snippets as fit in chunk_bytes,
+    instead of one small random read per spike. This matters for memory-mapped
+    files on spinning disks or network storage.
+
+    Spikes whose snippet would extend past either end of the data are skipped.
+
+    Inputs:
+    -------
+    raw_data : numpy.ndarray or numpy.memmap (num_samples x num_channels)
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Spike times in samples, in any order
+    pre_samples : int
+        Number of samples before the spike time
+    samples_per_spike : int
+        Snippet length
+    chunk_bytes : int
+        Approximate size of each sequential read
+
+    Yields:
+    -------
+    positions : numpy.ndarray
+        Indices into spike_times of the snippets in this block
+    snippets : numpy.ndarray (len(positions) x num_channels x samples_per_spike)
+        Raw data, same dtype as raw_data
+
+    """
+
+    num_samples, num_channels = raw_data.shape
+
+    chunk_samples = max(chunk_bytes // (num_channels * raw_data.dtype.itemsize), samples_per_spike)
+
+    order, sorted_starts, blocks = plan_snippet_reads(spike_times, pre_samples, samples_per_spike, num_samples, chunk_samples)
+
+    for first, last in blocks:
+
+        block_start = sorted_starts[first]
+        block_end = sorted_starts[last-1] + samples_per_spike
+        block = np.asarray(raw_data[block_start:block_end, :])
+
+        yield order[first:last], extract_block_snippets(block, sorted_starts[first:last] - block_start, samples_per_spike)
+
+
+def read_snippets(raw_data, spike_times, pre_samples, samples_per_spike, chunk_bytes = 2**26):
+
+    """
+    Reads the snippet around each spike with time-sorted sequential reads
+    (see iter_snippets), and returns them in the order of spike_times
+
+    Outputs:
+    --------
+    snippets : numpy.ndarray (num_spikes x num_channels x samples_per_spike)
+        Raw data, same dtype as raw_data; zeros where valid is False
+    valid : numpy.ndarray (boolean, num_spikes x 0)
+        False for spikes whose snippet extends past either end of the data
+
+    """
+
+    num_spikes = np.asarray(spike_times).size
+
+    snippets = np.zeros((num_spikes, raw_data.shape[1], samples_per_spike), dtype = raw_data.dtype)
+    valid = np.zeros((num_spikes,), dtype = 'bool')
+
+    for positions, block_snippets in iter_snippets(raw_data, spike_times, pre_samples, samples_per_spike, chunk_bytes):
+        snippets[positions] = block_snippets
+        valid[positions] = True
+
+    return snippets, valid
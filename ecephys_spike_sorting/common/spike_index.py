@@ -0,0 +1,82 @@
+import numpy as np
+
+
+class SpikeIndex():
+
+    """
+    Groups spikes by cluster ID, so that the spikes of each cluster can be
+    retrieved as a contiguous slice rather than with a boolean mask over
+    all spikes
+
+    Built with a single stable argsort of spike_clusters; within each cluster
+    spikes stay in their original (time) order
+
+    """
+
+    def __init__(self, spike_clusters, total_units = None):
+
+        """
+        spike_clusters : numpy.ndarray (num_spikes x 0)
+            Cluster IDs for each spike
+        total_units : int (optional)
+            Size of the cluster ID range; defaults to max(spike_clusters) + 1
+        """
+
+        spike_clusters = np.squeeze(spike_clusters).astype('int64')
+
+        if total_units is None:
+            total_units = np.max(spike_clusters) + 1 if spike_clusters.size > 0 else 0
+
+        self.total_units = total_units
+        self.num_spikes = spike_clusters.size
+        self.order = np.argsort(spike_clusters, kind = 'stable')
+        self.counts = np.bincount(spike_clusters, minlength = total_units)
+        self.offsets = np.concatenate(([0], np.cumsum(self.counts)))
+
+        # same as np.unique(spike_clusters)
+        self.cluster_ids = np.where(self.counts > 0)[0]
+
+
+    def indices(self, cluster_id):
+
+        """ Returns spike indices (in original order) for one cluster """
+
+        if cluster_id >= self.total_units:
+            return self.order[0:0]
+
+        return self.order[self.offsets[cluster_id]:self.offsets[cluster_id+1]]
+
+
+    def sorted_labels(self):
+
+        """ Returns the cluster ID of each spike, in grouped order """
+
+        return np.repeat(np.arange(self.total_units), self.counts)
+
+
+    def subset(self, spike_mask):
+
+        """ Returns a new SpikeIndex restricted to the spikes in spike_mask
+
+        Spike indices of the new SpikeIndex refer to the positions of
+        the spikes in the masked arrays (e.g. spike_times[spike_mask]),
+        and the grouping is carried over without re-sorting
+
+        Input:
+        ------
+        spike_mask : numpy.ndarray (boolean, num_spikes x 0)
+
+        """
+
+        new_positions = np.cumsum(spike_mask) - 1
+        keep = spike_mask[self.order]
+
+        sub = SpikeIndex.__new__(SpikeIndex)
+        sub.total_units = self.total_units
+        sub.num_spikes = int(np.sum(spike_mask))
+        sub.order = new_positions[self.order[keep]]
+        sub.counts = np.bincount(self.sorted_labels()[keep], minlength = self.total_units)
+        sub.offsets = np.concatenate(([0], np.cumsum(sub.counts)))
+        sub.cluster_ids = np.where(sub.counts > 0)[0]
+
+        return sub
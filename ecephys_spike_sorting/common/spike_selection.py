@@ -0,0 +1,251 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+
+from .spike_index import SpikeIndex
+
+
+class SpikeSelection():
+
+    """
+    Spikes chosen for the mean waveforms of each (cluster, epoch)
+
+    spike_indices index spike_times (sorted, each spike once), and
+    chosen[i, e] is True if spike_indices[i] is averaged for epoch e.
+    key records the inputs the selection was made from (see
+    spike_selection_key), so a saved selection is only reused for the same
+    spikes and settings.
+
+    """
+
+    def __init__(self, spike_indices, chosen, epoch_names, key = None):
+
+        self.spike_indices = np.asarray(spike_indices).astype('int64')
+        self.chosen = np.asarray(chosen).astype('bool').reshape(self.spike_indices.size, len(epoch_names))
+        self.epoch_names = list(epoch_names)
+        self.key = key
+
+
+    def for_epoch(self, epoch_name):
+
+        """ Spike indices chosen for one epoch (sorted) """
+
+        return self.spike_indices[self.chosen[:, self.epoch_names.index(epoch_name)]]
+
+
+    def by_cluster(self, spike_clusters):
+
+        """
+        The selection grouped by cluster: a list of (cluster_id, spike
+        indices, chosen) for each cluster with at least one chosen spike,
+        in cluster order, with each cluster's spikes in time order
+
+        """
+
+        labels = np.squeeze(spike_clusters).astype('int64')[self.spike_indices]
+        order = np.argsort(labels, kind = 'stable')
+        labels = labels[order]
+
+        starts = np.concatenate(([0], np.where(np.diff(labels) > 0)[0] + 1))
+        ends = np.concatenate((starts[1:], [labels.size]))
+
+        return [(labels[first], self.spike_indices[order[first:last]], self.chosen[order[first:last]])
+                for first, last in zip(starts, ends) if last > first]
+
+
+    def save(self, path):
+
+        np.savez(path,
+                 spike_indices = self.spike_indices,
+                 chosen = self.chosen,
+                 epoch_names = np.array(self.epoch_names),
+                 key = json.dumps(self.key))
+
+
+    @classmethod
+    def load(cls, path):
+
+        with np.load(path) as f:
+            return cls(f['spike_indices'], f['chosen'], [str(name) for name in f['epoch_names']], json.loads(str(f['key'])))
+
+
+def select_spikes_stratified(spike_times,
+                             spike_clusters,
+                             epochs,
+                             sample_rate,
+                             spikes_per_epoch,
+                             seed = 0,
+                             prefer_isolated = False,
+                             overlap_window = 82,
+                             spike_index = None):
+
+    """
+    Picks up to spikes_per_epoch spikes of each cluster in each epoch,
+    spread evenly through time
+
+    A cluster's m spikes in an epoch are split, in time order, into
+    k = min(m, spikes_per_epoch) strata of (nearly) equal size, and one spike
+    is drawn at random from each. The draws come from a generator seeded
+    with seed, so the selection is reproducible, and only k random numbers
+    are drawn per (cluster, epoch); the spike trains are never permuted or
+    copied.
+
+    With prefer_isolated, a spike with no other spike (of any cluster) within
+    overlap_window samples is drawn instead, if the stratum has one.
+
+    Inputs:
+    -------
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Spike times in samples, in time order
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+    epochs : list of Epoch objects
+        A spike is in an epoch if start_time < time < end_time (seconds)
+    sample_rate : float
+        Hz
+    spikes_per_epoch : int
+    seed : int
+    prefer_isolated : bool
+    overlap_window : int
+        Samples; usually the snippet length
+    spike_index : SpikeIndex (optional)
+        Grouped index of spike_clusters, if already built
+
+    Outputs:
+    --------
+    selection : SpikeSelection
+
+    """
+
+    spike_times = np.squeeze(spike_times)
+
+    if spike_index is None:
+        spike_index = SpikeIndex(spike_clusters)
+
+    rng = np.random.default_rng(seed)
+
+    grouped_times = spike_times[spike_index.order] / sample_rate
+
+    if prefer_isolated:
+        isolated = isolated_spikes(spike_times, overlap_window)[spike_index.order]
+
+    picks = []
+
+    for epoch_idx, epoch in enumerate(epochs):
+
+        in_epoch = (grouped_times > epoch.start_time) * (grouped_times < epoch.end_time)
+
+        # rank of each in-epoch spike among all in-epoch spikes, in grouped order
+        epoch_rank = np.concatenate(([0], np.cumsum(in_epoch)))
+        count = np.diff(epoch_rank[spike_index.offsets])
+
+        take = np.minimum(count, spikes_per_epoch)
+        stratum_labels = np.repeat(np.arange(take.size), take)
+        stratum = np.arange(stratum_labels.size) - np.repeat(np.cumsum(take) - take, take)
+
+        m = count[stratum_labels]
+        k = take[stratum_labels]
+        first_rank = epoch_rank[spike_index.offsets[stratum_labels]]
+
+        # stratum j holds the cluster's in-epoch spikes with ranks
+        # [j*m//k, (j+1)*m//k)
+        lo = first_rank + (stratum * m) // k
+        hi = first_rank + ((stratum + 1) * m) // k
+
+        rank = lo + np.floor(rng.random(lo.size) * (hi - lo)).astype('int64')
+        position = np.searchsorted(epoch_rank, rank + 1, side = 'left') - 1
+
+        if prefer_isolated:
+
+            isolated_rank = np.concatenate(([0], np.cumsum(in_epoch * isolated)))
+
+            first_position = np.searchsorted(epoch_rank, lo + 1, side = 'left') - 1
+            last_position = np.searchsorted(epoch_rank, hi, side = 'left')
+
+            num_isolated = isolated_rank[last_position] - isolated_rank[first_position]
+            draw = np.floor(rng.random(lo.size) * num_isolated).astype('int64')
+            isolated_position = np.searchsorted(isolated_rank, isolated_rank[first_position] + draw + 1, side = 'left') - 1
+
+            position = np.where(num_isolated > 0, isolated_position, position)
+
+        picks.append((spike_index.order[position], np.full(position.shape, epoch_idx)))
+
+    pick_spikes = np.concatenate([spikes for spikes, _ in picks]).astype('int64')
+    pick_epochs = np.concatenate([epoch_rows for _, epoch_rows in picks]).astype('int64')
+
+    spike_indices, rows = np.unique(pick_spikes, return_inverse = True)
+
+    chosen = np.zeros((spike_indices.size, len(epochs)), dtype = 'bool')
+    chosen[rows, pick_epochs] = True
+
+    return SpikeSelection(spike_indices, chosen, [epoch.name for epoch in epochs])
+
+
+def isolated_spikes(spike_times, overlap_window):
+
+    """ True for spikes with no other spike within overlap_window samples """
+
+    spike_times = np.squeeze(spike_times).astype('int64')
+
+    order = np.argsort(spike_times, kind = 'stable')
+    gaps = np.diff(spike_times[order])
+
+    isolated = np.ones(spike_times.shape, dtype = 'bool')
+    isolated[order[1:]] &= gaps > overlap_window
+    isolated[order[:-1]] &= gaps > overlap_window
+
+    return isolated
+
+
+def load_or_select_spikes(selection_file,
+                          spike_times,
+                          spike_clusters,
+                          epochs,
+                          sample_rate,
+                          spikes_per_epoch,
+                          seed = 0,
+                          prefer_isolated = False,
+                          overlap_window = 82,
+                          spike_index = None):
+
+    """
+    select_spikes_stratified, reusing the selection saved in selection_file
+    if it was made from the same spikes with the same settings, and saving
+    a new one otherwise (selection_file may be None to skip both)
+
+    """
+
+    key = spike_selection_key(spike_times, spike_clusters, epochs, spikes_per_epoch, seed, prefer_isolated, overlap_window)
+
+    if selection_file is not None and os.path.exists(selection_file):
+
+        selection = SpikeSelection.load(selection_file)
+
+        if selection.key == key:
+            return selection
+
+    selection = select_spikes_stratified(spike_times, spike_clusters, epochs, sample_rate, spikes_per_epoch,
+                                         seed, prefer_isolated, overlap_window, spike_index)
+    selection.key = key
+
+    if selection_file is not None:
+        selection.save(selection_file)
+
+    return selection
+
+
+def spike_selection_key(spike_times, spike_clusters, epochs, spikes_per_epoch, seed, prefer_isolated, overlap_window):
+
+    """ Identifies the spikes, epochs and settings a selection was made from """
+
+    spike_times = np.ascontiguousarray(np.squeeze(spike_times), dtype = 'int64')
+    spike_clusters = np.ascontiguousarray(np.squeeze(spike_clusters), dtype = 'int64')
+
+    return {'spike_times_sha1' : hashlib.sha1(spike_times).hexdigest(),
+            'spike_clusters_sha1' : hashlib.sha1(spike_clusters).hexdigest(),
+            'epochs' : [[epoch.name, float(epoch.start_time), float(epoch.end_time)] for epoch in epochs],
+            'spikes_per_epoch' : int(spikes_per_epoch),
+            'seed' : int(seed),
+            'prefer_isolated' : bool(prefer_isolated),
+            'overlap_window' : int(overlap_window)}
@@ -0,0 +1,266 @@
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.io import savemat
+
+
+def make_synthetic_dataset(output_dir,
+                           num_units = 32,
+                           num_channels = 64,
+                           duration = 60.0,
+                           firing_rate = 5.0,
+                           sample_rate = 30000.0,
+                           lfp_sample_rate = 2500.0,
+                           bit_volts = 0.195,
+                           noise_uv = 10.0,
+                           duplicate_fraction = 0.01,
+                           num_pcs = 3,
+                           num_pc_channels = 32,
+                           chunk_s = 1.0,
+                           seed = 0):
+
+    """
+    Writes a synthetic Kilosort/Phy output folder and matching SpikeGLX data
+
+    Units are point sources placed along a Neuropixels 1.0 style staggered
+    probe; each one fires as a Poisson process with a 2 ms refractory period
+    and its template decays with distance from the unit. A small fraction of
+    spikes are double counted (within the unit, and by a nearby unit) so that
+    duplicate removal has something to do.
+
+    Inputs:
+    -------
+    output_dir : String
+        Directory to write into (created if needed)
+    num_units : Int
+        Number of units (= templates = clusters)
+    num_channels : Int
+        Number of channels in the binary files
+    duration : float
+        Length of the recording in seconds
+    firing_rate : float
+        Median firing rate in Hz
+    sample_rate, lfp_sample_rate : float
+        AP and LFP band sample rates in Hz
+    bit_volts : float
+        Microvolts per int16 bit
+    noise_uv : float
+        RMS noise in microvolts
+    duplicate_fraction : float
+        Fraction of spikes that are double counted
+    num_pcs, num_pc_channels : Int
+        Dimensions of pc_features
+    chunk_s : float
+        Seconds of data generated at a time when writing the binary
+    seed : Int
+        Seed for the random number generator
+
+    Outputs:
+    --------
+    paths : dict
+        'kilosort_output_directory', 'ap_band_file', 'lfp_band_file', 'num_spikes'
+
+    """
+
+    rng = np.random.RandomState(seed)
+
+    ks_dir = os.path.join(output_dir, 'kilosort_output')
+    os.makedirs(ks_dir, exist_ok = True)
+
+    ap_band_file = os.path.join(output_dir, 'synthetic_g0_t0.imec0.ap.bin')
+    lfp_band_file = os.path.join(output_dir, 'synthetic_g0_t0.imec0.lf.bin')
+
+    num_samples = int(duration * sample_rate)
+    template_padding = 21
+    pre_samples = 20
+    template_samples = 61
+
+    # Neuropixels 1.0 staggered geometry
+    channel_pos = np.zeros((num_channels, 2))
+    channel_pos[:,0] = np.tile([43, 11, 59, 27], int(np.ceil(num_channels / 4)))[:num_channels]
+    channel_pos[:,1] = 20 * np.floor(np.arange(num_channels) / 2)
+
+    # unit locations and templates
+    unit_pos = np.zeros((num_units, 2))
+    unit_pos[:,0] = rng.uniform(0, 70, num_units)
+    unit_pos[:,1] = rng.uniform(0, np.max(channel_pos[:,1]), num_units)
+
+    t = np.arange(template_samples)
+    shape = -np.exp(-((t - pre_samples) / 3.0) ** 2) + 0.35 * np.exp(-((t - pre_samples - 10) / 6.0) ** 2)
+
+    distance = np.sqrt(np.sum((unit_pos[:,np.newaxis,:] - channel_pos[np.newaxis,:,:]) ** 2, 2))
+    spatial = np.exp(-distance ** 2 / (2 * 30.0 ** 2))
+
+    # unit x samples x channels, peak of -1 on the nearest channel
+    waveforms = shape[np.newaxis,:,np.newaxis] * (spatial / np.max(spatial, 1, keepdims = True))[:,np.newaxis,:]
+    templates = np.zeros((num_units, template_padding + template_samples, num_channels), dtype = 'float32')
+    templates[:,template_padding:,:] = waveforms
+
+    unit_amplitude = rng.uniform(60, 250, num_units)  # microvolts
+
+    # spike trains
+    rates = firing_rate * rng.lognormal(0, 0.5, num_units)
+    refractory = int(0.002 * sample_rate)
+
+    times = []
+    clusters = []
+
+    for unit in range(num_units):
+        intervals = rng.exponential(sample_rate / rates[unit], int(rates[unit] * duration * 1.5) + 10) + refractory
+        unit_times = np.cumsum(intervals).astype('int64')
+        unit_times = unit_times[unit_times < num_samples - template_samples]
+        times.append(unit_times)
+        clusters.append(np.zeros(unit_times.shape, dtype = 'int64') + unit)
+
+    times = np.concatenate(times)
+    clusters = np.concatenate(clusters)
+
+    # double-counted spikes: a few samples later, by the same unit or its nearest neighbor
+    nearest_unit = np.argsort(np.sum((unit_pos[:,np.newaxis,:] - unit_pos[np.newaxis,:,:]) ** 2, 2), 1)[:,min(1, num_units - 1)]
+    duplicates = rng.rand(times.size) < duplicate_fraction
+    duplicate_clusters = np.where(rng.rand(np.sum(duplicates)) < 0.5, clusters[duplicates], nearest_unit[clusters[duplicates]])
+    times = np.concatenate((times, times[duplicates] + rng.randint(1, 5, np.sum(duplicates))))
+    clusters = np.concatenate((clusters, duplicate_clusters))
+
+    order = np.argsort(times, kind = 'stable')
+    times = times[order]
+    clusters = clusters[order]
+    num_spikes = times.size
+
+    amplitudes = unit_amplitude[clusters] * rng.lognormal(0, 0.15, num_spikes)
+
+    # AP band, written a chunk at a time; spikes that extend past the end of
+    # a chunk are carried over to the next one
+    chunk_samples = int(chunk_s * sample_rate)
+    carry = np.zeros((template_samples, num_channels), dtype = 'float32')
+    sample_index = np.arange(template_samples)
+    spike_starts = times - pre_samples
+
+    with open(ap_band_file, 'wb') as f:
+
+        for start in range(0, num_samples, chunk_samples):
+
+            length = min(chunk_samples, num_samples - start)
+            buffer = np.zeros((length + template_samples, num_channels), dtype = 'float32')
+            buffer[:template_samples] += carry
+
+            first, last = np.searchsorted(spike_starts, [start, start + length])
+            offsets = spike_starts[first:last] - start
+            spikes = waveforms[clusters[first:last]] * (amplitudes[first:last] / bit_volts)[:,np.newaxis,np.newaxis]
+            np.add.at(buffer, offsets[:,np.newaxis] + sample_index[np.newaxis,:], spikes.astype('float32'))
+
+            buffer[:length] += rng.normal(0, noise_uv / bit_volts, (length, num_channels)).astype('float32')
+            carry = buffer[length:]
+
+            np.clip(buffer[:length], -32768, 32767).astype('int16').tofile(f)
+
+    # LFP band: noise with more low-frequency power deep in the "brain"
+    num_lfp_samples = int(duration * lfp_sample_rate)
+    lfp = rng.normal(0, 20, (num_lfp_samples, num_channels))
+    slow = np.cumsum(rng.normal(0, 5, (num_lfp_samples, 1)), 0)
+    slow -= np.mean(slow)
+    depth_gain = (channel_pos[:,1] < 0.7 * np.max(channel_pos[:,1])).astype('float')
+    lfp += slow * depth_gain[np.newaxis,:]
+    np.clip(lfp, -32768, 32767).astype('int16').tofile(lfp_band_file)
+
+    for band_file, rate, band in ((ap_band_file, sample_rate, 'ap'), (lfp_band_file, lfp_sample_rate, 'lf')):
+        write_meta(os.path.splitext(band_file)[0] + '.meta', channel_pos, rate, duration, os.path.getsize(band_file), band)
+
+    # channel map next to the data, as written by kilosort_helper
+    savemat(os.path.splitext(ap_band_file)[0] + '_chanMap.mat',
+            {'chanMap' : np.arange(1, num_channels + 1, dtype = 'float'),
+             'chanMap0ind' : np.arange(num_channels, dtype = 'float'),
+             'xcoords' : channel_pos[:,0],
+             'ycoords' : channel_pos[:,1],
+             'connected' : np.ones((num_channels,), dtype = 'bool'),
+             'kcoords' : np.ones((num_channels,)),
+             'fs' : sample_rate})
+
+    # PC features on the channels nearest to each template's peak
+    num_pc_channels = min(num_pc_channels, num_channels)
+    peak_channels = np.argmin(np.min(waveforms, 1), 1)
+    pc_feature_ind = np.argsort(np.sum((channel_pos[peak_channels][:,np.newaxis,:] - channel_pos[np.newaxis,:,:]) ** 2, 2), 1, kind = 'stable')[:,:num_pc_channels]
+
+    spike_spatial = spatial[clusters[:,np.newaxis], pc_feature_ind[clusters]]
+    pc_features = rng.normal(0, 1, (num_spikes, num_pcs, num_pc_channels)).astype('float32')
+    pc_features[:,0,:] += (amplitudes[:,np.newaxis] * spike_spatial / 10).astype('float32')
+
+    template_feature_ind = np.argsort(np.sum((unit_pos[:,np.newaxis,:] - unit_pos[np.newaxis,:,:]) ** 2, 2), 1, kind = 'stable')[:,:min(32, num_units)]
+    template_features = np.abs(rng.normal(0, 1, (num_spikes, template_feature_ind.shape[1]))).astype('float32')
+    template_features[:,0] += (amplitudes / 10).astype('float32')
+
+    # Kilosort / Phy output
+    np.save(os.path.join(ks_dir, 'spike_times.npy'), times.astype('uint64')[:,np.newaxis])
+    np.save(os.path.join(ks_dir, 'spike_clusters.npy'), clusters.astype('uint32'))
+    np.save(os.path.join(ks_dir, 'spike_templates.npy'), clusters.astype('uint32')[:,np.newaxis])
+    np.save(os.path.join(ks_dir, 'amplitudes.npy'), (amplitudes / 10)[:,np.newaxis])
+    np.save(os.path.join(ks_dir, 'templates.npy'), templates)
+    np.save(os.path.join(ks_dir, 'templates_ind.npy'), np.tile(np.arange(num_channels, dtype = 'float64'), (num_units, 1)))
+    np.save(os.path.join(ks_dir, 'whitening_mat.npy'), np.eye(num_channels))
+    np.save(os.path.join(ks_dir, 'whitening_mat_inv.npy'), np.eye(num_channels))
+    np.save(os.path.join(ks_dir, 'channel_map.npy'), np.arange(num_channels, dtype = 'int32'))
+    np.save(os.path.join(ks_dir, 'channel_positions.npy'), channel_pos)
+    np.save(os.path.join(ks_dir, 'pc_features.npy'), pc_features)
+    np.save(os.path.join(ks_dir, 'pc_feature_ind.npy'), pc_feature_ind.astype('uint32'))
+    np.save(os.path.join(ks_dir, 'template_features.npy'), template_features)
+    np.save(os.path.join(ks_dir, 'template_feature_ind.npy'), template_feature_ind.astype('uint32'))
+    np.save(os.path.join(ks_dir, 'similar_templates.npy'), np.exp(-np.sum((unit_pos[:,np.newaxis,:] - unit_pos[np.newaxis,:,:]) ** 2, 2) / 1e4).astype('float32'))
+
+    cluster_ids = np.arange(num_units)
+    labels = np.where(unit_amplitude > 80, 'good', 'mua')
+    pd.DataFrame(data={'cluster_id' : cluster_ids, 'Amplitude' : np.around(unit_amplitude / 10, 1)}).to_csv(
+        os.path.join(ks_dir, 'cluster_Amplitude.tsv'), sep='\t', index=False)
+    pd.DataFrame(data={'cluster_id' : cluster_ids, 'KSLabel' : labels}).to_csv(
+        os.path.join(ks_dir, 'cluster_KSLabel.tsv'), sep='\t', index=False)
+    pd.DataFrame(data={'cluster_id' : cluster_ids, 'group' : labels}).to_csv(
+        os.path.join(ks_dir, 'cluster_group.tsv'), sep='\t', index=False)
+
+    with open(os.path.join(ks_dir, 'params.py'), 'w') as f:
+        f.write("dat_path = '" + ap_band_file.replace('\\', '/') + "'\n")
+        f.write('n_channels_dat = ' + repr(num_channels) + '\n')
+        f.write("dtype = 'int16'\n")
+        f.write('offset = 0\n')
+        f.write('sample_rate = ' + repr(float(sample_rate)) + '\n')
+        f.write('hp_filtered = False\n')
+
+    return {'kilosort_output_directory' : ks_dir,
+            'ap_band_file' : ap_band_file,
+            'lfp_band_file' : lfp_band_file,
+            'num_spikes' : num_spikes}
+
+
+def write_meta(meta_file, channel_pos, sample_rate, duration, file_size, band = 'ap'):
+
+    """
+    Writes a minimal SpikeGLX .meta file for a synthetic imec binary
+
+    Only the entries read by SGLXMetaToCoords and the modules are included;
+    site positions are given as an snsGeomMap
+
+    """
+
+    num_channels = channel_pos.shape[0]
+    channel_counts = [num_channels, 0, 0] if band == 'ap' else [0, num_channels, 0]
+
+    geom_map = '(NP1010,1,0,70)' + ''.join(['(0:{:g}:{:g}:1)'.format(x, y) for x, y in channel_pos])
+    shank_map = '(1,2,480)' + ''.join(['(0:{:d}:{:d}:1)'.format(int(i % 2), int(i // 2)) for i in range(num_channels)])
+
+    entries = [('fileSizeBytes', repr(file_size)),
+               ('fileTimeSecs', repr(float(duration))),
+               ('imDatPrb_pn', 'NP1010'),
+               ('imDatPrb_type', '0'),
+               ('imSampRate', repr(float(sample_rate))),
+               ('imAiRangeMax', '0.6'),
+               ('imAiRangeMin', '-0.6'),
+               ('imMaxInt', '512'),
+               ('nSavedChans', repr(num_channels)),
+               ('snsApLfSy', ','.join([repr(n) for n in channel_counts])),
+               ('snsSaveChanSubset', 'all'),
+               ('typeThis', 'imec'),
+               ('~snsGeomMap', geom_map),
+               ('~snsShankMap', shank_map)]
+
+    with open(meta_file, 'w') as f:
+        for key, value in entries:
+            f.write(key + '=' + value + '\n')
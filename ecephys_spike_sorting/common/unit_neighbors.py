@@ -0,0 +1,126 @@
+import numpy as np
+
+from scipy.spatial import cKDTree
+
+
+class UnitNeighborIndex():
+
+    """
+    Finds the units within some distance of each unit, for the stages that
+    only compare nearby units (duplicate spike removal, PC-based metrics,
+    automerging)
+
+    Units are points (usually the position of their peak channel) in a
+    cKDTree, so the neighbours of every unit within a radius are found in
+    O(units x neighbours) rather than by measuring every pair. Distances at
+    the radius are checked exactly, so '<' and '<=' comparisons give the same
+    neighbours as computing all distances directly.
+
+    """
+
+    def __init__(self, unit_positions):
+
+        """
+        unit_positions : numpy.ndarray (num_units x num_dims)
+            Position of each unit in um (e.g. x and z of the peak channel, or
+            just depth)
+
+        """
+
+        self.unit_positions = np.asarray(unit_positions, dtype = 'float64').reshape(len(unit_positions), -1)
+        self.num_units = self.unit_positions.shape[0]
+        self.tree = cKDTree(self.unit_positions)
+
+
+    @classmethod
+    def from_templates(cls, templates, channel_map, channel_positions):
+
+        """
+        Index of units at the position of their template's peak channel
+
+        templates : numpy.ndarray (num_units x num_samples x num_channels)
+        channel_map : numpy.ndarray (num_channels x 0)
+            Original data channel of each template channel
+        channel_positions : numpy.ndarray (num_channels x 2)
+            X and Z of each template channel (um)
+
+        """
+
+        peak_channel_idx = np.squeeze(np.argmax(np.max(templates, 1) - np.min(templates, 1), 1))
+
+        index = cls(np.asarray(channel_positions)[peak_channel_idx, :2])
+        index.peak_channel_idx = peak_channel_idx
+        index.peak_channels = np.squeeze(channel_map)[peak_channel_idx]
+
+        return index
+
+
+    @classmethod
+    def from_peak_channels(cls, peak_channels, channel_positions):
+
+        """ Index of units at the position of the given peak channel (row of channel_positions) """
+
+        return cls(np.asarray(channel_positions)[np.asarray(peak_channels).astype('int64'), :2])
+
+
+    def neighbors(self, unit, radius, inclusive = False):
+
+        """
+        Units closer than radius to unit (or at radius, if inclusive),
+        including unit itself, in increasing order
+
+        """
+
+        candidates = np.sort(np.asarray(self.tree.query_ball_point(self.unit_positions[unit], _search_radius(radius)), dtype = 'int64'))
+
+        return candidates[self._within(unit, candidates, radius, inclusive) | (candidates == unit)]
+
+
+    def neighbor_lists(self, radius, inclusive = False):
+
+        """ neighbors() for every unit """
+
+        return [self.neighbors(unit, radius, inclusive) for unit in range(self.num_units)]
+
+
+    def pairs(self, radius, inclusive = False):
+
+        """
+        All pairs of distinct units within radius
+
+        Outputs:
+        --------
+        first, second : numpy.ndarray
+            Unit indices, with first < second, sorted by first then second
+
+        """
+
+        pairs = self.tree.query_pairs(_search_radius(radius), output_type = 'ndarray').astype('int64')
+
+        if pairs.size == 0:
+            return np.zeros((0,), dtype = 'int64'), np.zeros((0,), dtype = 'int64')
+
+        first = np.min(pairs, 1)
+        second = np.max(pairs, 1)
+
+        keep = self._within(first, second, radius, inclusive)
+        first = first[keep]
+        second = second[keep]
+
+        order = np.lexsort((second, first))
+
+        return first[order], second[order]
+
+
+    def _within(self, first, second, radius, inclusive):
+
+        distance = np.sqrt(np.sum(np.square(self.unit_positions[second] - self.unit_positions[first]), -1))
+
+        return distance <= radius if inclusive else distance < radius
+
+
+def _search_radius(radius):
+
+    # slightly larger than radius, so the tree's own rounding never drops a
+    # unit at the boundary; the exact test is applied afterwards
+    return radius * (1 + 1e-9) + 1e-9
@@ -221,7 +221,7 @@ def read_cluster_amplitude_tsv(filename):
 
     return cluster_amplitude
 
-def load(folder, filename):
+def load(folder, filename, mmap_mode = None):
 
     """
     Loads a numpy file from a folder.
@@ -232,6 +232,8 @@ def load(folder, filename):
         Directory containing the file to load
     filename : String
         Name of the numpy file
+    mmap_mode : String (optional)
+        Passed to numpy.load; 'r' opens the file as a read-only memory map
 
     Outputs:
     --------
@@ -240,7 +242,7 @@ def load(folder, filename):
 
     """
 
-    return np.load(os.path.join(folder, filename))
+    return np.load(os.path.join(folder, filename), mmap_mode = mmap_mode)
 
 
 def load_kilosort_data(folder, 
@@ -248,7 +250,8 @@ def load_kilosort_data(folder,
                        convert_to_seconds = True, 
                        use_master_clock = False, 
                        include_pcs = False,
-                       template_zero_padding= 21):
+                       template_zero_padding= 21,
+                       mmap_pcs = False):
 
     """
     Loads Kilosort output files from a directory
@@ -267,6 +270,9 @@ def load_kilosort_data(folder,
         Flags whether to load spike principal components (large file)
     template_zero_padding : int (default = 21)
         Number of zeros added to the beginning of each template
+    mmap_pcs : bool (optional)
+        Flags whether to open pc_features and template_features as read-only
+        memory maps instead of reading them into memory
 
     Outputs:
     --------
@@ -313,9 +319,10 @@ def load_kilosort_data(folder,
     channel_pos = load(folder, 'channel_positions.npy')
 
     if include_pcs:
-        pc_features = load(folder, 'pc_features.npy')
+        mmap_mode = 'r' if mmap_pcs else None
+        pc_features = load(folder, 'pc_features.npy', mmap_mode)
         pc_feature_ind = load(folder, 'pc_feature_ind.npy')
-        template_features = load(folder, 'template_features.npy') 
+        template_features = load(folder, 'template_features.npy', mmap_mode)
 
                 
     templates = templates[:,template_zero_padding:,:] # remove zeros
@@ -0,0 +1,74 @@
+import numpy as np
+
+
+class GroupedWelford():
+
+    """
+    Running mean and variance for many groups of equally shaped samples,
+    e.g. the snippets of each (cluster, epoch)
+
+    Samples arrive in blocks, in any order and mixed across groups. Each
+    block is reduced per group and merged into the running state with the
+    parallel form of Welford's algorithm (Chan et al., 1979), so memory is
+    two arrays of shape (num_groups, *shape) however many samples are added.
+
+    """
+
+    def __init__(self, num_groups, shape):
+
+        self.count = np.zeros((num_groups,), dtype = 'int64')
+        self.mean = np.zeros((num_groups,) + tuple(shape), dtype = 'float64')
+        self.m2 = np.zeros((num_groups,) + tuple(shape), dtype = 'float64')
+
+
+    def update(self, groups, samples, max_block_size = 256):
+
+        """
+        Adds a block of samples
+
+        Inputs:
+        -------
+        groups : numpy.ndarray (num_samples x 0)
+            Group index of each sample
+        samples : numpy.ndarray (num_samples x *shape)
+        max_block_size : int
+            Samples converted to float64 at a time
+
+        """
+
+        for first in range(0, len(groups), max_block_size):
+            self._merge(groups[first:first+max_block_size], samples[first:first+max_block_size])
+
+
+    def _merge(self, groups, samples):
+
+        order = np.argsort(groups, kind = 'stable')
+        groups = groups[order]
+        samples = samples[order].astype('float64')
+
+        starts = np.concatenate(([0], np.where(np.diff(groups) > 0)[0] + 1))
+        block_groups = groups[starts]
+        block_count = np.diff(np.concatenate((starts, [groups.size])))
+
+        expand = (slice(None),) + (np.newaxis,) * (samples.ndim - 1)
+
+        block_mean = np.add.reduceat(samples, starts, axis = 0) / block_count[expand]
+        deviations = samples - np.repeat(block_mean, block_count, axis = 0)
+        block_m2 = np.add.reduceat(deviations * deviations, starts, axis = 0)
+
+        count = self.count[block_groups]
+        total = count + block_count
+
+        delta = block_mean - self.mean[block_groups]
+
+        self.mean[block_groups] += delta * (block_count / total)[expand]
+        self.m2[block_groups] += block_m2 + delta * delta * (count * block_count / total)[expand]
+        self.count[block_groups] = total
+
+
+    def variance(self):
+
+        """ Population variance of each group (NaN for empty groups) """
+
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            return self.m2 / self.count[(slice(None),) + (np.newaxis,) * (self.m2.ndim - 1)]
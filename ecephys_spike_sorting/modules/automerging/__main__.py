@@ -7,24 +7,29 @@ import numpy as np
 from .automerging import automerging
 
 from ...common.utils import write_cluster_group_tsv, load_kilosort_data
+from ...common.instrumentation import profile_stages, stage
 
 
+@profile_stages
 def run_automerging(args):
 
     print('ecephys spike sorting: automerging module')
 
     start = time.time()
     
-    spike_times, spike_clusters, spike_templates, amplitudes, templates, \
-    channel_map, channel_pos, clusterIDs, cluster_quality, cluster_amplitude, template_features = \
-        load_kilosort_data(args['directories']['kilosort_output_directory'], \
-            args['ephys_params']['sample_rate'], \
-            convert_to_seconds = True)
+    with stage('load'):
+        spike_times, spike_clusters, spike_templates, amplitudes, templates, \
+        channel_map, channel_pos, clusterIDs, cluster_quality, cluster_amplitude, template_features = \
+            load_kilosort_data(args['directories']['kilosort_output_directory'], \
+                args['ephys_params']['sample_rate'], \
+                convert_to_seconds = True)
     
-    spike_clusters, cluster_index, cluster_quality = automerging(spike_times, spike_clusters, clusterIDs, templates, args['automerging_params'])
+    with stage('automerge'):
+        spike_clusters, cluster_index, cluster_quality = automerging(spike_times, spike_clusters, clusterIDs, templates, args['automerging_params'])
 
-    write_cluster_group_tsv(cluster_index, cluster_quality)
-    np.save(os.path.join(args['directories']['kilosort_output_directory'], 'spike_clusters.npy'), spike_clusters)
+    with stage('save'):
+        write_cluster_group_tsv(cluster_index, cluster_quality)
+        np.save(os.path.join(args['directories']['kilosort_output_directory'], 'spike_clusters.npy'), spike_clusters)
 
     execution_time = time.time() - start
 
@@ -5,6 +5,7 @@ import numpy as np
 from .metrics import compare_templates, make_interp_temp, compute_isi_score, compute_isi_score
 from .merges import compute_overall_score, ID_merge_groups, make_merges
 from ...common.spike_template_helpers import find_depth
+from ...common.unit_neighbors import UnitNeighborIndex
 
 def automerging(spike_times, spike_clusters, clusterIDs, cluster_quality, templates, params):
 
@@ -28,10 +29,9 @@ def automerging(spike_times, spike_clusters, clusterIDs, cluster_quality, templa
 
     comparison_matrix = np.zeros((depths.size, depths.size, 5))
         
-    for i in range(0,depths.size):
-        for j in range(i+1,depths.size):
-            if np.abs(depths[i] - depths[j]) <= params['distance_to_compare'] and is_good[i] and is_good[j]:
-                comparison_matrix[i,j,0] = 1
+    first, second = UnitNeighborIndex(depths[:,np.newaxis]).pairs(params['distance_to_compare'], inclusive=True)
+    both_good = is_good[first] * is_good[second]
+    comparison_matrix[first[both_good],second[both_good],0] = 1
             
     print('Total comparisons: ' + str(np.where(comparison_matrix[:,:,0] == 1)[0].size))
 
@@ -9,7 +9,9 @@ import numpy as np
 from ecephys_spike_sorting.modules.depth_estimation.depth_estimation import compute_channel_offsets, find_surface_channel
 from ecephys_spike_sorting.common.utils import write_probe_json
 from ecephys_spike_sorting.common.SGLXMetaToCoords import MetaToCoords
+from ecephys_spike_sorting.common.instrumentation import profile_stages, stage
 
+@profile_stages
 def run_depth_estimation(args):
 
     print('ecephys spike sorting: depth estimation module\n')
@@ -18,32 +20,35 @@ def run_depth_estimation(args):
 
     numChannels = args['ephys_params']['num_channels']
 
-    rawDataAp = np.memmap(args['ephys_params']['ap_band_file'], dtype='int16', mode='r')
-    dataAp = np.reshape(rawDataAp, (int(rawDataAp.size/numChannels), numChannels))
+    with stage('load'):
+        rawDataAp = np.memmap(args['ephys_params']['ap_band_file'], dtype='int16', mode='r')
+        dataAp = np.reshape(rawDataAp, (int(rawDataAp.size/numChannels), numChannels))
 
-    rawDataLfp = np.memmap(args['ephys_params']['lfp_band_file'], dtype='int16', mode='r')
-    dataLfp = np.reshape(rawDataLfp, (int(rawDataLfp.size/numChannels), numChannels))
+        rawDataLfp = np.memmap(args['ephys_params']['lfp_band_file'], dtype='int16', mode='r')
+        dataLfp = np.reshape(rawDataLfp, (int(rawDataLfp.size/numChannels), numChannels))
     
-    metaName, binExt = os.path.splitext(args['ephys_params']['ap_band_file'])
-    metaFullPath = Path(metaName + '.meta')  
+        metaName, binExt = os.path.splitext(args['ephys_params']['ap_band_file'])
+        metaFullPath = Path(metaName + '.meta')  
     
-    [xCoord, yCoord, shankInd] = MetaToCoords(metaFullPath, -1, badChan= np.zeros((0), dtype = 'int'), destFullPath = '', showPlot=False)
+        [xCoord, yCoord, shankInd, connected, NchanTOT] = MetaToCoords(metaFullPath, -1, badChan= np.zeros((0), dtype = 'int'), destFullPath = '', showPlot=False)
 
     print('Computing surface channel...')
 
-    info_lfp = find_surface_channel(dataLfp, 
-                                args['ephys_params'], 
-                                args['depth_estimation_params'],
-                                xCoord,
-                                yCoord,
-                                shankInd)
+    with stage('surface_channel'):
+        info_lfp = find_surface_channel(dataLfp, 
+                                    args['ephys_params'], 
+                                    args['depth_estimation_params'],
+                                    xCoord,
+                                    yCoord,
+                                    shankInd)
     
-    write_probe_json(args['common_files']['probe_json'], 
-                     info_lfp['surface_y'], 
-                     info_lfp['air_y'], 
-                     np.squeeze(yCoord), 
-                     np.squeeze(xCoord),
-                     np.squeeze(shankInd))
+    with stage('save'):
+        write_probe_json(args['common_files']['probe_json'], 
+                         info_lfp['surface_y'], 
+                         info_lfp['air_y'], 
+                         np.squeeze(yCoord), 
+                         np.squeeze(xCoord),
+                         np.squeeze(shankInd))
 
     execution_time = time.time() - start
 
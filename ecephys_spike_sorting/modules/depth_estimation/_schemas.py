@@ -45,4 +45,5 @@ class OutputParameters(OutputSchema):
     surface_channel = Int()
     air_channel = Int()
     probe_json = String()
-    execution_time = Float()  
\ No newline at end of file
+    execution_time = Float()  
+    stage_profile = Dict(required=False, help='Wall time, CPU time and peak RSS (MB) for each processing stage')
\ No newline at end of file
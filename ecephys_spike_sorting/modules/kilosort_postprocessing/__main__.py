@@ -7,10 +7,12 @@ import time
 import numpy as np
 
 from ...common.utils import load_kilosort_data, getSortResults
+from ...common.instrumentation import profile_stages, stage
 
-from .postprocessing import remove_double_counted_spikes
-from .postprocessing import align_spike_times
+from .postprocessing import remove_double_counted_spikes, replace_compacted_features
+from .postprocessing import align_spike_times, align_spike_times_to_peaks
 
+@profile_stages
 def run_postprocessing(args):
 
     print('ecephys spike sorting: kilosort postprocessing module')
@@ -23,34 +25,62 @@ def run_postprocessing(args):
     start = time.time()
     
     include_pcs = args['ks_postprocessing_params']['include_pcs']
+    mmap_pcs = args['ks_postprocessing_params'].get('mmap_pcs', False)
     
-    if include_pcs:
-        spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
-        channel_pos, clusterIDs, cluster_quality, cluster_amplitude, pc_features, pc_feature_ind, template_features = \
-                    load_kilosort_data(args['directories']['kilosort_output_directory'], \
-                        args['ephys_params']['sample_rate'], \
-                        convert_to_seconds = False, \
-                        use_master_clock = False, \
-                        include_pcs = include_pcs )
-    else:
-        spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
-        channel_pos, clusterIDs, cluster_quality, cluster_amplitude = \
-                    load_kilosort_data(args['directories']['kilosort_output_directory'], \
-                        args['ephys_params']['sample_rate'], \
-                        convert_to_seconds = False, \
-                        use_master_clock = False, \
-                        include_pcs = include_pcs )
-        # empty arrays to stand in for the missing variables
-        pc_features = []
-        pc_feature_ind = []
-        template_features = []
+    with stage('load'):
+
+        if include_pcs:
+            spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
+            channel_pos, clusterIDs, cluster_quality, cluster_amplitude, pc_features, pc_feature_ind, template_features = \
+                        load_kilosort_data(args['directories']['kilosort_output_directory'], \
+                            args['ephys_params']['sample_rate'], \
+                            convert_to_seconds = False, \
+                            use_master_clock = False, \
+                            include_pcs = include_pcs, \
+                            mmap_pcs = mmap_pcs )
+        else:
+            spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
+            channel_pos, clusterIDs, cluster_quality, cluster_amplitude = \
+                        load_kilosort_data(args['directories']['kilosort_output_directory'], \
+                            args['ephys_params']['sample_rate'], \
+                            convert_to_seconds = False, \
+                            use_master_clock = False, \
+                            include_pcs = include_pcs )
+            # empty arrays to stand in for the missing variables
+            pc_features = []
+            pc_feature_ind = []
+            template_features = []
         
     if args['ks_postprocessing_params']['align_avg_waveform']: 
-        spike_times = align_spike_times(spike_times,
-                                        spike_clusters,
-                                        args['ephys_params']['ap_band_file'], 
-                                        args['directories']['kilosort_output_directory'], 
-                                        args['ks_postprocessing_params']['cWaves_path'])
+        with stage('align'):
+
+            align_params = args['ks_postprocessing_params']
+
+            if align_params.get('align_engine', 'c_waves') == 'python':
+                rawData = np.memmap(args['ephys_params']['ap_band_file'], dtype='int16', mode='r')
+                data = np.reshape(rawData, (int(rawData.size/args['ephys_params']['num_channels']), args['ephys_params']['num_channels']))
+
+                spike_times = align_spike_times_to_peaks(spike_times,
+                                                         spike_clusters,
+                                                         data,
+                                                         templates,
+                                                         channel_map,
+                                                         args['ephys_params']['bit_volts'],
+                                                         align_params.get('align_samples_per_spike', 82),
+                                                         align_params.get('align_pre_samples', 20),
+                                                         align_params.get('align_spikes_per_unit', 5000),
+                                                         align_params.get('align_chunk_mb', 64) * 2**20)
+            else:
+                spike_times = align_spike_times(spike_times,
+                                                spike_clusters,
+                                                args['ephys_params']['ap_band_file'], 
+                                                args['directories']['kilosort_output_directory'], 
+                                                align_params.get('cWaves_path'),
+                                                align_params['c_waves_engine'],
+                                                args['ephys_params']['bit_volts'],
+                                                align_params.get('align_samples_per_spike', 82),
+                                                align_params.get('align_pre_samples', 20),
+                                                align_params.get('align_spikes_per_unit', 5000))
         
     if args['ks_postprocessing_params']['remove_duplicates']:
         spike_times, spike_clusters, spike_templates, amplitudes, pc_features, \
@@ -72,22 +102,31 @@ def run_postprocessing(args):
 
     print("Saving data...")
 
-    # save data -- it's fine to overwrite existing files, because the original outputs are stored in rez.mat
-    output_dir = args['directories']['kilosort_output_directory']
-    np.save(os.path.join(output_dir, 'spike_times.npy'), spike_times)
-    np.save(os.path.join(output_dir, 'amplitudes.npy'), amplitudes)
-    np.save(os.path.join(output_dir, 'spike_clusters.npy'), spike_clusters)
-    np.save(os.path.join(output_dir, 'spike_templates.npy'), spike_templates)
+    with stage('save'):
+
+        # save data -- it's fine to overwrite existing files, because the original outputs are stored in rez.mat
+        output_dir = args['directories']['kilosort_output_directory']
+        np.save(os.path.join(output_dir, 'spike_times.npy'), spike_times)
+        np.save(os.path.join(output_dir, 'amplitudes.npy'), amplitudes)
+        np.save(os.path.join(output_dir, 'spike_clusters.npy'), spike_clusters)
+        np.save(os.path.join(output_dir, 'spike_templates.npy'), spike_templates)
     
-    if args['ks_postprocessing_params']['include_pcs']:
-        np.save(os.path.join(output_dir, 'pc_features.npy'), pc_features)
-        np.save(os.path.join(output_dir, 'template_features.npy'), template_features)
+        if args['ks_postprocessing_params']['include_pcs'] and not mmap_pcs:
+            np.save(os.path.join(output_dir, 'pc_features.npy'), pc_features)
+            np.save(os.path.join(output_dir, 'template_features.npy'), template_features)
+        elif args['ks_postprocessing_params']['include_pcs']:
+            # remove_double_counted_spikes wrote compacted copies of the
+            # memory-mapped features; every map is closed before they replace
+            # the originals, which Windows requires
+            del pc_features, template_features
+            replace_compacted_features(os.path.join(output_dir, 'pc_features.npy'))
+            replace_compacted_features(os.path.join(output_dir, 'template_features.npy'))
     
-    if args['ks_postprocessing_params']['remove_duplicates']:
-        np.save(os.path.join(output_dir, 'overlap_matrix.npy'), overlap_matrix)
-        np.save(os.path.join(output_dir, 'overlap_summary.npy'), overlap_summary)
-        # save the overlap_summary as a text file -- allows user to easily understand what happened
-        np.savetxt(os.path.join(output_dir, 'overlap_summary.csv'), overlap_summary, fmt = '%d', delimiter = ',')
+        if args['ks_postprocessing_params']['remove_duplicates']:
+            np.save(os.path.join(output_dir, 'overlap_matrix.npy'), overlap_matrix)
+            np.save(os.path.join(output_dir, 'overlap_summary.npy'), overlap_summary)
+            # save the overlap_summary as a text file -- allows user to easily understand what happened
+            np.savetxt(os.path.join(output_dir, 'overlap_summary.csv'), overlap_summary, fmt = '%d', delimiter = ',')
 
     execution_time = time.time() - start
 
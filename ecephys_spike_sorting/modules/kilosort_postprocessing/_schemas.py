@@ -9,10 +9,19 @@ class PostprocessingParams(DefaultSchema):
     between_unit_overlap_window = Float(required=False, default=0.000166, help='Time window for removing overlapping spikes between two units.')
     between_unit_dist_um = Int(required=False, default=5, help='Number of channels (above and below peak channel) to search for overlapping spikes')
     deletion_mode = String(required=False, default='lowAmpCluster', help='lowAmpCluster or deleteFirst')
+    between_unit_engine = String(required=False, default='sweep', help="'sweep' to find between-unit overlaps in one pass over all spikes in time order, or 'pairwise' for the original loop over pairs of units (same results)")
     include_pcs = Boolean(required=False, default=True, help='Set to false if features were not saved with Phy output')
+    mmap_pcs = Boolean(required=False, default=False, help='Open pc_features and template_features as read-only memory maps; duplicate removal then rewrites them on disk in chunks instead of holding them in RAM')
+    compaction_chunk_mb = Int(required=False, default=256, help='With mmap_pcs: size of each chunk copied when removing spikes from pc_features and template_features')
     remove_duplicates = Boolean(required=False, default=True, help='Set to True for duplicate removal')
     align_avg_waveform = Boolean(required=False, default=True, help='Set to true to set spike times for mean waveform min = t0')
+    align_engine = String(required=False, default='c_waves', help="For align_avg_waveform: 'python' to average each unit's template peak channel directly from the AP band binary; 'c_waves' to compute full mean waveforms with C_Waves (see c_waves_engine) and read them back")
+    align_samples_per_spike = Int(required=False, default=82, help='For align_avg_waveform: number of samples in each snippet')
+    align_pre_samples = Int(required=False, default=20, help='For align_avg_waveform: samples before the spike time in each snippet; the waveform peak is aligned to pre_samples - 1')
+    align_spikes_per_unit = Int(required=False, default=5000, help='For align_avg_waveform: maximum number of spikes averaged per unit, evenly spaced through its spike train')
+    align_chunk_mb = Int(required=False, default=64, help="For align_avg_waveform with the 'python' align_engine: size of each sequential read from the AP band binary")
     cWaves_path = InputDir(require=False, help='directory containing the CWaves executable.')
+    c_waves_engine = String(required=False, default='executable', help="For align_avg_waveform with align_engine 'c_waves': 'executable' to run C_Waves from cWaves_path, or 'python' for the in-package multithreaded C_Waves implementation")
 
 class InputParameters(ArgSchema):
     
@@ -30,4 +39,5 @@ class OutputSchema(DefaultSchema):
 class OutputParameters(OutputSchema): 
 
     execution_time = Float()
+    stage_profile = Dict(required=False, help='Wall time, CPU time and peak RSS (MB) for each processing stage')
     
\ No newline at end of file
@@ -3,9 +3,15 @@ import os
 import sys
 import subprocess
 from collections import OrderedDict
+from numpy.lib.format import open_memmap
 
 from ...common.utils import printProgressBar
 from ...common.utils import getSortResults
+from ...common.instrumentation import stage
+from ...common.c_waves import c_waves, c_waves_executable, select_spikes
+from ...common.snippets import plan_snippet_reads
+from ...common.spike_index import SpikeIndex
+from ...common.unit_neighbors import UnitNeighborIndex
 
 def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates, 
                                  amplitudes, channel_map, channel_pos, templates, pc_features, 
@@ -31,7 +37,9 @@ def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates,
     templates : numpy.ndarray (num_units x num_channels x num_samples)
         Spike templates for each unit
     pc_features : numpy.ndarray (num_spikes x num_pcs x num_channels)
-        Pre-computed PCs for blocks of channels around each spike
+        Pre-computed PCs for blocks of channels around each spike; if this
+        and template_features are memory maps, compacted copies of their
+        files are written next to them (see compact_spikes)
     pc_feature_ind : numpy.ndarray (num_units x num_channels)
         Channel indices of PCs for each unit
     sample_rate : Float
@@ -39,8 +47,11 @@ def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates,
     params : dict of parameters
         'within_unit_overlap_window' : time window for removing overlapping spikes
         'between_unit_overlap_window' : time window for removing overlapping spikes
-        'between_unit_channel_distance' : number of channels over which to search for overlapping spikes
+        'between_unit_dist_um' : distance between peak channels over which to search for overlapping spikes
+        'deletion_mode' : 'lowAmpCluster' or 'deleteFirst' (see find_between_unit_overlap)
+        'between_unit_engine' : 'sweep' (default) or 'pairwise'; see find_between_unit_overlaps_sweep
         'include_pcs' : whether to update files pc_features and template_features. Should be 'true' unless these files are absent
+        'compaction_chunk_mb' : chunk size for compacting memory-mapped pc_features and template_features on disk (see compact_spikes)
     epochs : list of Epoch objects
         contains information on Epoch start and stop times
 
@@ -70,7 +81,10 @@ def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates,
     if templates.shape[0]>len(cluster_amplitude):
         templates = templates[0:len(cluster_amplitude),:,:]
 
-    peak_chan_idx = np.squeeze(np.argmax(np.max(templates,1) - np.min(templates,1),1))
+    # units are compared with the units whose template peak channels are nearby
+    neighbor_index = UnitNeighborIndex.from_templates(templates, channel_map, channel_pos)
+
+    peak_chan_idx = neighbor_index.peak_channel_idx
 
     # to accomdate case where matlab writes out chan map as (1,nchan) instead of (nchan,1)
     channel_map = np.squeeze(channel_map);
@@ -89,86 +103,352 @@ def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates,
     within_unit_overlap_samples = int(params['within_unit_overlap_window'] * sample_rate)
     between_unit_overlap_samples = int(params['between_unit_overlap_window'] * sample_rate)
 
+    # spikes removed by either pass are cleared from one mask, and the
+    # outputs are compacted once at the end
+    keep = np.ones((spike_times.size,), dtype = 'bool')
+
     print('Removing within-unit overlapping spikes...')
 
-    spikes_to_remove = np.zeros((0,), dtype = 'int')
+    with stage('within_unit'):
+
+        spikes_to_remove, removed_per_unit = find_within_unit_overlaps(spike_times,
+                                                                       spike_clusters,
+                                                                       num_clusters,
+                                                                       within_unit_overlap_samples)
+
+        overlap_matrix[np.arange(num_clusters), np.arange(num_clusters)] = removed_per_unit[sorted_unit_list]
+
+        keep[spikes_to_remove] = False
+
+    print('Removing between-unit overlapping spikes...')
+
+    with stage('between_unit'):
+
+        if params.get('between_unit_engine', 'sweep') == 'pairwise':
+            find_overlaps = find_between_unit_overlaps_pairwise
+        else:
+            find_overlaps = find_between_unit_overlaps_sweep
+
+        remaining = np.where(keep)[0]
+
+        spikes_to_remove = find_overlaps(spike_times[remaining],
+                                         spike_clusters[remaining],
+                                         sorted_unit_list,
+                                         neighbor_index,
+                                         cluster_amplitude,
+                                         between_unit_overlap_samples,
+                                         params['between_unit_dist_um'],
+                                         params['deletion_mode'],
+                                         overlap_matrix)
+
+        keep[remaining[spikes_to_remove]] = False
+
+    with stage('compact'):
+
+        spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features = compact_spikes(keep,
+                                                                             spike_times,
+                                                                             spike_clusters,
+                                                                             spike_templates,
+                                                                             amplitudes,
+                                                                             pc_features,
+                                                                             template_features,
+                                                                             include_pcs,
+                                                                             params.get('compaction_chunk_mb', 256) * 2**20)
 
+#   build overlap summary 
+    spike_counts = np.bincount(spike_clusters[spike_clusters < num_clusters].astype('int64'), minlength = num_clusters)
+    overlap_summary = np.zeros((num_clusters, 5), dtype=int )
     for idx1, unit_id1 in enumerate(sorted_unit_list):
+        overlap_summary[idx1,0] = unit_id1
+        overlap_summary[idx1,1] = spike_counts[unit_id1]
+        overlap_summary[idx1,2] = overlap_matrix[idx1,idx1]
+        overlap_summary[idx1,3] = np.sum(overlap_matrix[idx1,:]) - overlap_matrix[idx1,idx1]
+        overlap_summary[idx1,4] = sorted_unit_list[np.argmax(overlap_matrix[idx1,:])]     
+#   sort by label
+    new_order = np.argsort(overlap_summary[:,0])
+    overlap_summary = overlap_summary[new_order,:]
 
-        printProgressBar(idx1+1, len(unit_list))
+    return spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features, overlap_matrix, overlap_summary
 
-        for_unit1 = np.where(spike_clusters == unit_id1)[0]
 
-        to_remove = find_within_unit_overlap(spike_times[for_unit1], within_unit_overlap_samples)
 
-        overlap_matrix[idx1, idx1] = len(to_remove)
+def find_between_unit_overlaps_pairwise(spike_times, spike_clusters, sorted_unit_list, neighbor_index,
+                                        cluster_amplitude, overlap_window, max_dist_um, deletion_mode, overlap_matrix):
 
-        spikes_to_remove = np.concatenate((spikes_to_remove, for_unit1[to_remove]))
+    """
+    Finds overlapping spikes between every pair of units with peak channels
+    closer than max_dist_um, one pair at a time with find_between_unit_overlap
 
-    spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features = remove_spikes(spike_times, 
-                                                                        spike_clusters, 
-                                                                        spike_templates, 
-                                                                        amplitudes, 
-                                                                        pc_features, 
-                                                                        template_features, 
-                                                                        spikes_to_remove,
-                                                                        include_pcs)
+    Inputs:
+    ------
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Spike times in samples
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+    sorted_unit_list : numpy.ndarray (num_clusters x 0)
+        Unit IDs in order of peak channel; rows and columns of overlap_matrix
+    neighbor_index : UnitNeighborIndex
+        Units at the positions of their peak channels
+    cluster_amplitude : numpy.ndarray (num_clusters x 0)
+    overlap_window : int
+        Samples
+    max_dist_um : float
+    deletion_mode : 'lowAmpCluster' or 'deleteFirst'
+    overlap_matrix : numpy.ndarray (num_clusters x num_clusters)
+        The number of spikes removed from the unit in row idx1 for its
+        overlap with the unit in column idx2 is added here
 
-    print('Removing between-unit overlapping spikes...')
+    Outputs:
+    --------
+    spikes_to_remove : numpy.ndarray
+        Indices of spikes to remove (may repeat)
+
+    """
 
     spikes_to_remove = np.zeros((0,), dtype = 'int')
 
+    unit_rank = np.zeros((sorted_unit_list.size,), dtype = 'int64')
+    unit_rank[sorted_unit_list] = np.arange(sorted_unit_list.size)
+
     for idx1, unit_id1 in enumerate(sorted_unit_list):
 
-        printProgressBar(idx1+1, len(unit_list))
+        printProgressBar(idx1+1, len(sorted_unit_list))
 
         for_unit1 = np.where(spike_clusters == unit_id1)[0]
-        
-        for idx2, unit_id2 in enumerate(sorted_unit_list):
-            
-            deltaX = np.squeeze(channel_pos[peak_chan_idx[unit_id2],0] - channel_pos[peak_chan_idx[unit_id1],0])
-            deltaZ = np.squeeze(channel_pos[peak_chan_idx[unit_id2],1] - channel_pos[peak_chan_idx[unit_id1],1])
-            
-            dist = pow( (pow(deltaX,2) + pow(deltaZ,2)), 0.5 )
-            
-            if idx2 > idx1 and dist < params['between_unit_dist_um']:
-                
+
+        for unit_id2 in neighbor_index.neighbors(unit_id1, max_dist_um):
+
+            idx2 = unit_rank[unit_id2]
+
+            if idx2 > idx1:
+
                 amp1 = cluster_amplitude[unit_id1]
                 amp2 = cluster_amplitude[unit_id2]
-                
+
                 for_unit2 = np.where(spike_clusters == unit_id2)[0]
 
-                to_remove1, to_remove2 = find_between_unit_overlap(spike_times[for_unit1], spike_times[for_unit2], amp1, amp2, between_unit_overlap_samples, params['deletion_mode'] )
+                to_remove1, to_remove2 = find_between_unit_overlap(spike_times[for_unit1], spike_times[for_unit2], amp1, amp2, overlap_window, deletion_mode )
 
                 overlap_matrix[idx1, idx2] = overlap_matrix[idx1, idx2] + len(to_remove1) 
                 overlap_matrix[idx2, idx1] = overlap_matrix[idx2, idx1] + len(to_remove2)
 
                 spikes_to_remove = np.concatenate((spikes_to_remove, for_unit1[to_remove1], for_unit2[to_remove2]))
 
+    return spikes_to_remove
 
-    spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features = remove_spikes(spike_times, 
-                                                                         spike_clusters,
-                                                                         spike_templates, 
-                                                                         amplitudes, 
-                                                                         pc_features, 
-                                                                         template_features, 
-                                                                         np.unique(spikes_to_remove),
-                                                                         include_pcs)
-#   build overlap summary 
-    overlap_summary = np.zeros((num_clusters, 5), dtype=int )
-    for idx1, unit_id1 in enumerate(sorted_unit_list):
-        overlap_summary[idx1,0] = unit_id1
-        overlap_summary[idx1,1] = np.sum(spike_clusters == unit_id1)
-        overlap_summary[idx1,2] = overlap_matrix[idx1,idx1]
-        overlap_summary[idx1,3] = np.sum(overlap_matrix[idx1,:]) - overlap_matrix[idx1,idx1]
-        overlap_summary[idx1,4] = sorted_unit_list[np.argmax(overlap_matrix[idx1,:])]     
-#   sort by label
-    new_order = np.argsort(overlap_summary[:,0])
-    overlap_summary = overlap_summary[new_order,:]
 
-    return spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features, overlap_matrix, overlap_summary
+def find_between_unit_overlaps_sweep(spike_times, spike_clusters, sorted_unit_list, neighbor_index,
+                                     cluster_amplitude, overlap_window, max_dist_um, deletion_mode, overlap_matrix):
+
+    """
+    Same inputs and results as find_between_unit_overlaps_pairwise, from one
+    sweep over all spikes in time order
+
+    find_between_unit_overlap only looks at consecutive spikes of the merged
+    train of a pair of units, and only at gaps of up to a few samples (the
+    overlap window, or the edges of the lowAmpCluster histogram). So all
+    spikes are sorted by time once (ties by unit, as in the merged train),
+    and each spike is compared with the spikes that follow it within that
+    gap. Two spikes are consecutive in the merged train of their two units if
+    neither unit has a spike between them; spikes of the same unit are
+    consecutive in the train of every neighbour with no spike between them.
+    Only pairs of units whose peak channels are closer than max_dist_um,
+    from neighbor_index, are kept.
+
+    With deletion_mode 'lowAmpCluster', the histogram of gaps of each pair is
+    built from these consecutive spikes. When its peak lies next to the last
+    bin, find_between_unit_overlap also removes consecutive spikes with
+    longer gaps, so such pairs (rare) are passed to it directly.
+
+    """
+
+    num_clusters = sorted_unit_list.size
+
+    # position of each unit in sorted_unit_list (rows of overlap_matrix)
+    unit_rank = np.zeros((num_clusters,), dtype = 'int64')
+    unit_rank[sorted_unit_list] = np.arange(num_clusters)
+
+    # pairs of neighbouring units, as positions in sorted_unit_list, in
+    # order of pair_low_ids * num_clusters + pair_high_ids
+    first_ids, second_ids = neighbor_index.pairs(max_dist_um)
+    pair_low_ids = np.minimum(unit_rank[first_ids], unit_rank[second_ids])
+    pair_high_ids = np.maximum(unit_rank[first_ids], unit_rank[second_ids])
+    pair_keys = pair_low_ids * num_clusters + pair_high_ids
+
+    by_key = np.argsort(pair_keys)
+    pair_low_ids = pair_low_ids[by_key]
+    pair_high_ids = pair_high_ids[by_key]
+    pair_keys = pair_keys[by_key]
+
+    def pair_id(units1, units2):
+
+        # index of each (units1, units2) pair in the pair list, -1 if not neighbours
+        keys = np.minimum(units1, units2) * num_clusters + np.maximum(units1, units2)
+        found = np.minimum(np.searchsorted(pair_keys, keys), max(pair_keys.size - 1, 0))
+
+        if pair_keys.size == 0:
+            return np.full(keys.shape, -1, dtype = 'int64')
+
+        return np.where((pair_keys[found] == keys) & (units1 != units2), found, -1)
+
+    # all spikes of listed units, by time, then unit, then original order
+    spike_clusters = np.squeeze(spike_clusters).astype('int64')
+    positions = np.where(spike_clusters < num_clusters)[0]
+    units = unit_rank[spike_clusters[positions]]
+    times = np.squeeze(spike_times).astype('int64')[positions]
+
+    order = np.lexsort((units, times))
+    positions = positions[order]
+    units = units[order]
+    times = times[order]
+
+    num_spikes = positions.size
+
+    # previous and next spike of the same unit
+    by_unit = np.argsort(units, kind = 'stable')
+    same_unit = units[by_unit[1:]] == units[by_unit[:-1]]
+    next_same = np.full((num_spikes,), num_spikes, dtype = 'int64')
+    prev_same = np.full((num_spikes,), -1, dtype = 'int64')
+    next_same[by_unit[:-1][same_unit]] = by_unit[1:][same_unit]
+    prev_same[by_unit[1:][same_unit]] = by_unit[:-1][same_unit]
+
+    bin_edges = np.arange(0, (overlap_window+4), 2)
+    max_gap = bin_edges[-1]
+
+    # consecutive spikes (first, second) in the merged train of their units,
+    # at most max_gap samples apart
+    first = []
+    second = []
+    active = np.arange(num_spikes)
+    step = 1
+
+    while active.size > 0:
+
+        active = active[active + step < num_spikes]
+        active = active[times[active + step] - times[active] <= max_gap]
+        later = active + step
+
+        consecutive = (next_same[active] >= later) & (prev_same[later] <= active)
+
+        first.append(active[consecutive])
+        second.append(later[consecutive])
+        step += 1
+
+    first = np.concatenate(first)
+    second = np.concatenate(second)
+    gaps = times[second] - times[first]
+
+    is_pair = pair_id(units[first], units[second]) >= 0
+
+    pair_first = first[is_pair]
+    pair_second = second[is_pair]
+    pair_gaps = gaps[is_pair]
+    pair_low = np.minimum(units[pair_first], units[pair_second])
+    pair_high = np.maximum(units[pair_first], units[pair_second])
+
+    removed = []
+
+    if deletion_mode == 'deleteFirst':
+
+        # the later spike of each overlapping pair is removed
+        overlapping = pair_gaps < overlap_window
+        later = pair_second[overlapping]
+        other = pair_low[overlapping] + pair_high[overlapping] - units[later]
+
+        np.add.at(overlap_matrix, (units[later], other), 1)
+        removed.append(positions[later])
+
+    else:
+
+        num_bins = bin_edges.size - 1
+
+        gap_bins = np.minimum(np.digitize(gaps, bin_edges) - 1, num_bins - 1)
+
+        hist = np.zeros((pair_low_ids.size, num_bins), dtype = 'int64')
+        np.add.at(hist, (pair_id(pair_low, pair_high), gap_bins[is_pair]), 1)
+
+        # consecutive spikes of one unit count for each neighbour, unless the
+        # neighbour has a spike between them
+        is_same = units[first] == units[second]
+        same_first = first[is_same]
+        same_second = second[is_same]
+        same_bins = gap_bins[is_same]
+
+        same_hist = np.zeros((num_clusters, num_bins), dtype = 'int64')
+        np.add.at(same_hist, (units[same_first], same_bins), 1)
+        hist += same_hist[pair_low_ids] + same_hist[pair_high_ids]
+
+        # (event, neighbour) pairs where the neighbour has a spike in between
+        spans = same_second - same_first
+        blocked = [np.zeros((0,), dtype = 'int64')]
+
+        for step in range(1, int(np.max(spans, initial = 1))):
+            events = np.where(spans > step)[0]
+            between = units[same_first[events] + step]
+            is_neighbor = pair_id(units[same_first[events]], between) >= 0
+            blocked.append(events[is_neighbor] * num_clusters + between[is_neighbor])
+
+        blocked = np.unique(np.concatenate(blocked))
+        blocked_events = blocked // num_clusters
+        blocked_units = blocked % num_clusters
+        event_units = units[same_first[blocked_events]]
+
+        np.subtract.at(hist, (pair_id(event_units, blocked_units), same_bins[blocked_events]), 1)
+
+        # same peak test as find_between_unit_overlap
+        cent_max = np.max(hist, 1)
+        cent_max_ind = np.argmax(hist, 1)
+        has_peak = (cent_max_ind < num_bins - 1) & (cent_max > 10 * np.min(hist, 1)) & (cent_max > 20)
+
+        rem_range = 2
+        max_val = len(bin_edges)
+        peak_val = cent_max_ind + 1
+        min_rem = np.maximum(peak_val - rem_range, 1)
+        max_rem = np.minimum(peak_val + rem_range, max_val)
+
+        bounded = has_peak & (max_rem < max_val)
+
+        # gaps in the removal range of a bounded pair are all below max_gap
+        ids = pair_id(pair_low, pair_high)
+        gap_dig = np.digitize(pair_gaps, bin_edges)
+        overlapping = bounded[ids] & (gap_dig >= min_rem[ids]) & (gap_dig <= max_rem[ids])
+
+        # the spike of the lower amplitude unit is removed (the first unit of
+        # the pair, in the order of sorted_unit_list, if amplitudes are equal)
+        amp_low = cluster_amplitude[sorted_unit_list[pair_low]]
+        amp_high = cluster_amplitude[sorted_unit_list[pair_high]]
+        from_unit = np.where(amp_low <= amp_high, pair_low, pair_high)
+        to_unit = np.where(amp_low <= amp_high, pair_high, pair_low)
+        spike = np.where(units[pair_first] == from_unit, pair_first, pair_second)
+
+        np.add.at(overlap_matrix, (from_unit[overlapping], to_unit[overlapping]), 1)
+        removed.append(positions[spike[overlapping]])
+
+        unbounded = np.where(has_peak & (max_rem == max_val))[0]
+
+        if unbounded.size > 0:
+
+            spike_index = SpikeIndex(spike_clusters, max(num_clusters, np.max(spike_clusters) + 1))
+
+            for pair in unbounded:
+
+                idx1 = pair_low_ids[pair]
+                idx2 = pair_high_ids[pair]
+                for_unit1 = spike_index.indices(sorted_unit_list[idx1])
+                for_unit2 = spike_index.indices(sorted_unit_list[idx2])
+
+                to_remove1, to_remove2 = find_between_unit_overlap(spike_times[for_unit1], spike_times[for_unit2],
+                                                                   cluster_amplitude[sorted_unit_list[idx1]],
+                                                                   cluster_amplitude[sorted_unit_list[idx2]],
+                                                                   overlap_window, deletion_mode)
+
+                overlap_matrix[idx1, idx2] += len(to_remove1)
+                overlap_matrix[idx2, idx1] += len(to_remove2)
+                removed.append(for_unit1[to_remove1])
+                removed.append(for_unit2[to_remove2])
+
+    return np.concatenate([np.zeros((0,), dtype = 'int')] + removed)
+
 
-                
 def find_within_unit_overlap(spike_train, overlap_window = 5):
 
     """
@@ -194,6 +474,53 @@ def find_within_unit_overlap(spike_train, overlap_window = 5):
     return spikes_to_remove
 
 
+def find_within_unit_overlaps(spike_times, spike_clusters, num_clusters, overlap_window = 5):
+
+    """
+    find_within_unit_overlap for every unit at once
+
+    Spikes are sorted by (cluster, time) with one lexsort, and the gaps
+    between consecutive spikes are taken with one np.diff; gaps that cross
+    from one cluster to the next are ignored. As in find_within_unit_overlap,
+    the first spike of each pair closer than overlap_window is removed.
+
+    Parameters
+    ----------
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Spike times (in samples)
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike time; spikes of clusters >= num_clusters
+        are ignored
+    num_clusters : int
+    overlap_window : int
+        Number of samples to search for overlapping spikes
+
+    Outputs
+    -------
+    spikes_to_remove : numpy.ndarray
+        Indices of overlapping spikes in spike_times, in increasing order
+    removed_per_unit : numpy.ndarray (num_clusters x 0)
+        Number of spikes removed from each cluster
+
+    """
+
+    spike_clusters = np.squeeze(spike_clusters).astype('int64')
+    positions = np.where(spike_clusters < num_clusters)[0]
+
+    clusters = spike_clusters[positions]
+    times = np.squeeze(spike_times).astype('int64')[positions]
+
+    order = np.lexsort((times, clusters))
+    clusters = clusters[order]
+
+    overlapping = (np.diff(times[order]) < overlap_window) & (clusters[1:] == clusters[:-1])
+
+    spikes_to_remove = np.sort(positions[order[:-1][overlapping]])
+    removed_per_unit = np.bincount(clusters[:-1][overlapping], minlength = num_clusters)
+
+    return spikes_to_remove, removed_per_unit
+
+
 def find_between_unit_overlap(spike_train1, spike_train2, amp1, amp2, overlap_window = 5, deletionMode = 'lowAmpCluster'):
 
     """
@@ -226,7 +553,7 @@ def find_between_unit_overlap(spike_train1, spike_train2, amp1, amp2, overlap_wi
     original_inds = np.concatenate( (np.arange(len(spike_train1)), np.arange(len(spike_train2)) ) )
     cluster_ids = np.concatenate( (np.zeros((len(spike_train1),), dtype = 'int'), np.ones((len(spike_train2),),dtype = 'int')) )
 
-    order = np.argsort(spike_train)
+    order = np.argsort(spike_train, kind = 'stable')
     sorted_train = spike_train[order]
 #   trim off the first member of the array of cluster labels; means the later spike will be picked for any pair
     sorted_cluster_ids = cluster_ids[order][1:]
@@ -339,21 +666,128 @@ def remove_spikes(spike_times, spike_clusters, spike_templates, amplitudes, pc_f
 
     """
 
-    spike_times = np.delete(spike_times, spikes_to_remove, 0)
-    spike_clusters = np.delete(spike_clusters, spikes_to_remove, 0)
-    spike_templates = np.delete(spike_templates, spikes_to_remove, 0)
-    amplitudes = np.delete(amplitudes, spikes_to_remove, 0)
-    
+    keep = np.ones((np.squeeze(spike_times).size,), dtype = 'bool')
+    keep[spikes_to_remove] = False
+
+    return compact_spikes(keep, spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features, include_pcs)
+
+
+def compact_spikes(keep, spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features, include_pcs, chunk_bytes = 256 * 2**20):
+
+    """
+    Keeps only the spikes where keep is True, copying each array once
+
+    pc_features and template_features opened as memory maps (np.load with
+    mmap_mode) are compacted on disk instead: the kept rows are streamed,
+    chunk_bytes at a time, into a new .npy next to the original (see
+    compacted_features_path), so at most one chunk is held in memory. The
+    compacted files are returned as read-only memory maps. They do not
+    replace the originals here, because a file cannot be replaced on
+    Windows while it is mapped; once every map of both files is closed,
+    call replace_compacted_features.
+
+    Inputs:
+    ------
+    keep : numpy.ndarray (num_spikes x 0)
+        True for spikes to keep
+    spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features, include_pcs :
+        As for remove_spikes
+    chunk_bytes : int
+        Size of each read from a memory-mapped feature file
+
+    Outputs:
+    --------
+    The same arrays, with num_spikes = np.sum(keep)
+
+    """
+
+    spike_times = spike_times[keep]
+    spike_clusters = spike_clusters[keep]
+    spike_templates = spike_templates[keep]
+    amplitudes = amplitudes[keep]
+
     if include_pcs:
-        pc_features = np.delete(pc_features, spikes_to_remove, 0)
-        template_features = np.delete(template_features, spikes_to_remove, 0)
+        pc_features = compact_features(pc_features, keep, chunk_bytes)
+        template_features = compact_features(template_features, keep, chunk_bytes)
     # otherwise, just returns the input pc_fearures and template_features arrays
 
     return spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features
 
-def align_spike_times(spike_times, spike_clusters, spikeglx_bin, output_dir, cWaves_path):
+
+def compact_features(features, keep, chunk_bytes = 256 * 2**20):
+
+    """ Rows of features where keep is True; see compact_spikes """
+
+    if not isinstance(features, np.memmap) or features.filename is None:
+        return features[keep]
+
+    path = features.filename
+
+    # only a map of a whole .npy file is rewritten in place
+    on_disk = np.load(path, mmap_mode = 'r')
+
+    if on_disk.shape != features.shape or on_disk.dtype != features.dtype:
+        return np.asarray(features[keep])
+
+    del on_disk
+
+    tmp_file = compacted_features_path(path)
+
+    compacted = open_memmap(tmp_file, mode = 'w+', dtype = features.dtype,
+                            shape = (int(np.sum(keep)),) + features.shape[1:])
+
+    row_bytes = max(features.itemsize * int(np.prod(features.shape[1:])), 1)
+    rows_per_read = max(chunk_bytes // row_bytes, 1)
+
+    written = 0
+
+    for first in range(0, features.shape[0], rows_per_read):
+
+        block = np.asarray(features[first:first+rows_per_read])[keep[first:first+rows_per_read]]
+
+        compacted[written:written+block.shape[0]] = block
+        written += block.shape[0]
+
+    compacted.flush()
+    del compacted
+
+    return np.load(tmp_file, mmap_mode = 'r')
+
+
+def compacted_features_path(path):
+
+    """ Where compact_features writes the compacted copy of the .npy file at path """
+
+    return path + '.tmp.npy'
+
+
+def replace_compacted_features(path):
+
+    """
+    Moves the compacted copy written by compact_features over the original
+    .npy file at path (nothing to do if there is none)
+
+    Every memory map of both files must be closed first (del the arrays),
+    or the replace fails on Windows.
+
+    """
+
+    if os.path.exists(compacted_features_path(path)):
+        os.replace(compacted_features_path(path), path)
+
+def align_spike_times(spike_times, spike_clusters, spikeglx_bin, output_dir, cWaves_path, c_waves_engine = 'executable', bit_volts = 0.195,
+                      samples_per_spike = 82, pre_samples = 20, spikes_per_unit = 5000):
     
-    print('Calculating mean waveforms for aligh_spike_times using C_waves.')
+    """
+    Shifts each unit's spike times so the peak of its mean waveform falls at
+    pre_samples - 1, using mean waveforms from C_Waves (written to output_dir
+    as preprocess_mean_waveforms.npy and preprocess_cluster_snr.npy)
+
+    See align_spike_times_to_peaks for the same alignment without C_Waves.
+
+    """
+
+    print('Calculating mean waveforms for aligh_spike_times using C_waves (' + c_waves_engine + ').')
 
     # assume cluster table version = 0;
     getSortResults(output_dir, 0)
@@ -364,30 +798,21 @@ def align_spike_times(spike_times, spike_clusters, spikeglx_bin, output_dir, cWa
     clus_time_npy = os.path.join(output_dir, 'spike_times.npy' )
     clus_lbl_npy = os.path.join(output_dir, 'spike_clusters.npy' )
     
-    # path to the 'runit.bat' executable that calls C_Waves.
-    # Essential in linux where C_Waves executable is only callable through runit
-    if sys.platform.startswith('win'):
-        exe_path = os.path.join(cWaves_path, 'runit.bat')
-    elif sys.platform.startswith('linux'):
-        exe_path = os.path.join(cWaves_path, 'runit.sh')
+    if c_waves_engine == 'python':
+        c_waves(spikeglx_bin, clus_table_npy, clus_time_npy, clus_lbl_npy, output_dir,
+                samples_per_spike = samples_per_spike,
+                pre_samples = pre_samples,
+                num_spikes = spikes_per_unit,
+                snr_radius = 8,
+                prefix = 'preprocess',
+                bit_volts = bit_volts)
     else:
-        print('unknown system, cannot run C_Waves')
-    
-    cwaves_cmd = exe_path + ' -spikeglx_bin=' + spikeglx_bin + \
-                            ' -clus_table_npy=' + clus_table_npy + \
-                            ' -clus_time_npy=' + clus_time_npy + \
-                            ' -clus_lbl_npy=' + clus_lbl_npy + \
-                            ' -dest=' + output_dir + \
-                            ' -samples_per_spike=82' + \
-                            ' -pre_samples=20' + \
-                            ' -num_spikes=5000' + \
-                            ' -snr_radius=8' + \
-                            ' -prefix=preprocess'
-                            
-    print(cwaves_cmd)
-    
-    # make the C_Waves call
-    subprocess.call(cwaves_cmd)
+        c_waves_executable(cWaves_path, spikeglx_bin, clus_table_npy, clus_time_npy, clus_lbl_npy, output_dir,
+                           samples_per_spike = samples_per_spike,
+                           pre_samples = pre_samples,
+                           num_spikes = spikes_per_unit,
+                           snr_radius = 8,
+                           prefix = 'preprocess')
     
     # load snr and waveform arrays
     mean_waveform_fullpath = os.path.join(output_dir, 'preprocess_mean_waveforms.npy')
@@ -395,43 +820,151 @@ def align_spike_times(spike_times, spike_clusters, spikeglx_bin, output_dir, cWa
     
     mean_waveforms = np.load(mean_waveform_fullpath)
     snr_array = np.load(snr_fullpath)
-    (nClu, nChan, nt) = mean_waveforms.shape
-    
-    peak_t = 19   #because pre_samples in C_Waves set to 20
     
-    # Loop over units
-    for i in range(nClu):
-        nSpike = snr_array[i,1]
-        if nSpike > 10:
-            # only try to correct if we some spikes to average
-            curr_wave = mean_waveforms[i,:,:]
-            max_site = np.argmax(np.max(curr_wave,1) - np.min(curr_wave,1))
-            max_site_wave = curr_wave[max_site,:]
-            
-            min_v = abs(np.min(max_site_wave))
-            max_v = abs(np.max(max_site_wave))
-            min_t = np.argmin(max_site_wave)
-            max_t = np.argmax(max_site_wave)
-            
-            # align to min or max?
-            if min_v > 30 and max_v > 30:
-                # set spike to to earlier of the two
-                if min_t <= max_t:               
-                   mean_peak_time = min_t
-                else:
-                   mean_peak_time = max_t
-            else:
-                # only one substantial peak, align to larger
-                if min_v >= max_v:
-                   mean_peak_time = min_t
-                else:
-                    mean_peak_time = max_t
-               
-            deltat = peak_t - mean_peak_time
-            # print('nClu, deltat: ' + repr(i) + ', ' +  repr(deltat) )
-            clu_ind = (spike_clusters == i)
-            spike_times[clu_ind] = spike_times[clu_ind] - deltat
-            
-                
-    
-    return spike_times
\ No newline at end of file
+    # waveform on the site with the largest peak-to-peak amplitude
+    max_site = np.argmax(np.max(mean_waveforms, 2) - np.min(mean_waveforms, 2), 1)
+    peak_waveforms = mean_waveforms[np.arange(max_site.size), max_site, :]
+
+    shift = peak_alignment_shifts(peak_waveforms, snr_array[:,1], pre_samples)
+
+    return shift_spike_times(spike_times, spike_clusters, shift)
+
+
+def align_spike_times_to_peaks(spike_times, spike_clusters, raw_data, templates, channel_map,
+                               bit_volts = 0.195, samples_per_spike = 82, pre_samples = 20,
+                               spikes_per_unit = 5000, chunk_bytes = 2**26):
+
+    """
+    Shifts each unit's spike times so the peak of its mean waveform falls at
+    pre_samples - 1, without C_Waves
+
+    Only the peak channel of each unit's template is averaged, over up to
+    spikes_per_unit spikes evenly spaced through the unit's spike train. The
+    snippets are read from raw_data in time order, one block of about
+    chunk_bytes at a time, so memory is bounded by one block plus
+    num_units x samples_per_spike sums. Spikes of clusters without a
+    template are not shifted.
+
+    Inputs:
+    -------
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Spike times in samples
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike time
+    raw_data : numpy.memmap (num_samples x num_channels)
+        AP band data (int16)
+    templates : numpy.ndarray (num_units x num_samples x num_channels)
+        Spike templates for each unit
+    channel_map : numpy.ndarray (num_channels x 0)
+        Original data channel of each template channel
+    bit_volts : float
+        uV per bit of raw_data
+    samples_per_spike : int
+    pre_samples : int
+        Samples before the spike time in each snippet
+    spikes_per_unit : int
+        Maximum number of spikes averaged per unit
+    chunk_bytes : int
+        Approximate size of each read from raw_data
+
+    Outputs:
+    --------
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Shifted spike times, same dtype as the input
+
+    """
+
+    spike_clusters = np.squeeze(spike_clusters).astype('int64')
+    spike_times = np.squeeze(spike_times)
+
+    num_units = templates.shape[0]
+    num_samples, num_channels = raw_data.shape
+
+    peak_channels = np.squeeze(channel_map)[np.argmax(np.max(templates, 1) - np.min(templates, 1), 1)].astype('int64')
+
+    with_template = np.where((spike_clusters >= 0) * (spike_clusters < num_units))[0]
+    selected = with_template[select_spikes(spike_clusters[with_template], num_units, spikes_per_unit)]
+
+    chunk_samples = max(chunk_bytes // (num_channels * raw_data.dtype.itemsize), samples_per_spike)
+
+    order, sorted_starts, blocks = plan_snippet_reads(spike_times[selected], pre_samples, samples_per_spike, num_samples, chunk_samples)
+
+    sorted_clusters = spike_clusters[selected][order]
+
+    sums = np.zeros((num_units, samples_per_spike), dtype = 'float64')
+    counts = np.zeros((num_units,), dtype = 'int64')
+
+    for first, last in blocks:
+
+        block_start = sorted_starts[first]
+        block = np.asarray(raw_data[block_start:sorted_starts[last-1] + samples_per_spike, :])
+
+        labels = sorted_clusters[first:last]
+        offsets = sorted_starts[first:last] - block_start
+
+        traces = block[offsets[:, np.newaxis] + np.arange(samples_per_spike), peak_channels[labels][:, np.newaxis]]
+
+        np.add.at(sums, labels, traces)
+        counts += np.bincount(labels, minlength = num_units)
+
+    peak_waveforms = sums / np.maximum(counts, 1)[:, np.newaxis] * bit_volts
+
+    shift = peak_alignment_shifts(peak_waveforms, counts, pre_samples)
+
+    return shift_spike_times(spike_times, spike_clusters, shift)
+
+
+def peak_alignment_shifts(peak_waveforms, spike_counts, pre_samples, min_spikes = 10, min_peak_uV = 30):
+
+    """
+    Number of samples to subtract from each unit's spike times to move the
+    peak of its mean waveform to pre_samples - 1
+
+    If both the trough and the peak are larger than min_peak_uV, the
+    earlier of the two is used; otherwise the larger. Units with
+    min_spikes or fewer spikes averaged are not shifted.
+
+    Inputs:
+    -------
+    peak_waveforms : numpy.ndarray (num_units x samples_per_spike)
+        Mean waveform of each unit on its peak channel (uV)
+    spike_counts : numpy.ndarray (num_units x 0)
+        Number of spikes averaged for each unit
+    pre_samples : int
+
+    Outputs:
+    --------
+    shift : numpy.ndarray (num_units x 0)
+        int64
+
+    """
+
+    min_v = np.abs(np.min(peak_waveforms, 1))
+    max_v = np.abs(np.max(peak_waveforms, 1))
+    min_t = np.argmin(peak_waveforms, 1)
+    max_t = np.argmax(peak_waveforms, 1)
+
+    both_peaks = (min_v > min_peak_uV) * (max_v > min_peak_uV)
+
+    mean_peak_time = np.where(both_peaks, np.minimum(min_t, max_t), np.where(min_v >= max_v, min_t, max_t))
+
+    return np.where(np.asarray(spike_counts) > min_spikes, (pre_samples - 1) - mean_peak_time, 0).astype('int64')
+
+
+def shift_spike_times(spike_times, spike_clusters, shift):
+
+    """ spike_times - shift[spike_clusters], with no shift for clusters beyond the end of shift;
+    spikes that would be moved before the start of the recording are clipped to sample 0 """
+
+    spike_clusters = np.squeeze(spike_clusters).astype('int64')
+
+    cluster_shift = np.zeros((max(np.max(spike_clusters, initial = -1) + 1, shift.size),), dtype = 'int64')
+    cluster_shift[:shift.size] = shift
+
+    shifted = np.asarray(spike_times).astype('int64')
+    shifted -= cluster_shift[spike_clusters]
+
+    # negative times would wrap around when cast back to unsigned spike times
+    np.maximum(shifted, 0, out = shifted)
+
+    return shifted.astype(np.asarray(spike_times).dtype)
@@ -12,20 +12,30 @@ from scipy.io import loadmat
 from ...common.utils import load_kilosort_data, write_cluster_group_tsv, read_cluster_group_tsv
 from ...common.utils import getSortResults
 from ...common.utils import getFileVersion
+from ...common.instrumentation import profile_stages, stage
+from ...common.c_waves import c_waves, c_waves_executable
+from ...common.epoch import Epoch
+from ...common.snippet_cache import SnippetCache
 
 from .extract_waveforms import extract_waveforms, writeDataAsNpy
 from .waveform_metrics import calculate_waveform_metrics
 from .metrics_from_file import metrics_from_file
+from .waveform_store import write_waveform_store, write_waveform_store_from_c_waves, store_engine
 
+@profile_stages
 def calculate_mean_waveforms(args):
 
     print('ecephys spike sorting: mean waveforms module')
     
     start = time.time()
+
+    # fail before computing any waveforms if the store format can't be written
+    if args['mean_waveform_params'].get('mean_waveforms_store') is not None:
+        store_engine(args['mean_waveform_params']['mean_waveforms_store'])
     
     if args['mean_waveform_params']['use_C_Waves']:
         
-        print('Calculating mean waveforms using C_waves.')
+        print('Calculating mean waveforms using C_waves (' + args['mean_waveform_params']['c_waves_engine'] + ').')
         spikeglx_bin = args['ephys_params']['ap_band_file']
         # regenerate the clus_Table in case there has been manual curation of the data in phy
         output_dir = args['directories']['kilosort_output_directory']
@@ -71,30 +81,28 @@ def calculate_mean_waveforms(args):
             np.save(clus_lbl_npy,sc)
         
         
-        # path to the 'runit.bat' executable that calls C_Waves.
-        # Essential in linux where C_Waves executable is only callable through runit
-        if sys.platform.startswith('win'):
-            exe_path = os.path.join(args['mean_waveform_params']['cWaves_path'], 'runit.bat')
-        elif sys.platform.startswith('linux'):
-            exe_path = os.path.join(args['mean_waveform_params']['cWaves_path'], 'runit.sh')
+        if args['mean_waveform_params']['c_waves_engine'] == 'python':
+            with stage('c_waves'):
+                c_waves(spikeglx_bin, clus_table_npy, clus_time_npy, clus_lbl_npy, dest,
+                        samples_per_spike = args['mean_waveform_params']['samples_per_spike'],
+                        pre_samples = args['mean_waveform_params']['pre_samples'],
+                        num_spikes = args['mean_waveform_params']['spikes_per_epoch'],
+                        snr_radius = args['mean_waveform_params']['snr_radius'],
+                        snr_radius_um = args['mean_waveform_params']['snr_radius_um'],
+                        bit_volts = args['ephys_params']['bit_volts'],
+                        cache_dir = args['mean_waveform_params'].get('snippet_cache_dir'),
+                        spike_selection_file = args['mean_waveform_params'].get('spike_selection_file'),
+                        spike_selection_seed = args['mean_waveform_params'].get('spike_selection_seed', 0),
+                        prefer_isolated_spikes = args['mean_waveform_params'].get('prefer_isolated_spikes', False))
         else:
-            print('unknown system, cannot run C_Waves')
-        
-        cwaves_cmd = exe_path + ' -spikeglx_bin=' + spikeglx_bin + \
-                                ' -clus_table_npy=' + clus_table_npy + \
-                                ' -clus_time_npy=' + clus_time_npy + \
-                                ' -clus_lbl_npy=' + clus_lbl_npy + \
-                                ' -dest=' + dest + \
-                                ' -samples_per_spike=' + repr(args['mean_waveform_params']['samples_per_spike']) + \
-                                ' -pre_samples=' + repr(args['mean_waveform_params']['pre_samples']) + \
-                                ' -num_spikes=' + repr(args['mean_waveform_params']['spikes_per_epoch']) + \
-                                ' -snr_radius=' + repr(args['mean_waveform_params']['snr_radius']) + \
-                                ' -snr_radius_um=' + repr(args['mean_waveform_params']['snr_radius_um'])
-                                
-        print(cwaves_cmd)
-        
-        # make the C_Waves call
-        subprocess.Popen(cwaves_cmd,shell='False').wait()
+            with stage('c_waves'):
+                c_waves_executable(args['mean_waveform_params']['cWaves_path'],
+                                   spikeglx_bin, clus_table_npy, clus_time_npy, clus_lbl_npy, dest,
+                                   samples_per_spike = args['mean_waveform_params']['samples_per_spike'],
+                                   pre_samples = args['mean_waveform_params']['pre_samples'],
+                                   num_spikes = args['mean_waveform_params']['spikes_per_epoch'],
+                                   snr_radius = args['mean_waveform_params']['snr_radius'],
+                                   snr_radius_um = args['mean_waveform_params']['snr_radius_um'])
         
         # for first version, retain original names
         if clu_version == 0:
@@ -113,14 +121,15 @@ def calculate_mean_waveforms(args):
         # call version of calculate_waveform_metrics that will use these files
         
         # load in kilosort output needed for these calculations
-        spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
-        channel_pos, clusterIDs, cluster_quality, cluster_amplitude = \
-                load_kilosort_data(args['directories']['kilosort_output_directory'], \
-                    args['ephys_params']['sample_rate'], \
-                    convert_to_seconds = False)
+        with stage('load'):
+            spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
+            channel_pos, clusterIDs, cluster_quality, cluster_amplitude = \
+                    load_kilosort_data(args['directories']['kilosort_output_directory'], \
+                        args['ephys_params']['sample_rate'], \
+                        convert_to_seconds = False)
                 
-        # read in inverse of whitening matrix
-        w_inv = np.load((os.path.join(args['directories']['kilosort_output_directory'], 'whitening_mat_inv.npy')))
+            # read in inverse of whitening matrix
+            w_inv = np.load((os.path.join(args['directories']['kilosort_output_directory'], 'whitening_mat_inv.npy')))
         
         # the channel_pos loaded from the phy output omits any sites excluded
         # as noise by the kilosort_helper module, or excluded fow low spike rete
@@ -139,17 +148,18 @@ def calculate_mean_waveforms(args):
                 
 
                 
-        metrics = metrics_from_file(mean_waveform_fullpath, snr_fullpath, clus_table_npy, \
-                    spike_times, \
-                    spike_clusters, \
-                    templates, \
-                    channel_map, \
-                    args['ephys_params']['bit_volts'], \
-                    args['ephys_params']['sample_rate'], \
-                    args['ephys_params']['vertical_site_spacing'], \
-                    w_inv, \
-                    site_x, site_y, \
-                    args['mean_waveform_params'])
+        with stage('metrics_from_file'):
+            metrics = metrics_from_file(mean_waveform_fullpath, snr_fullpath, clus_table_npy, \
+                        spike_times, \
+                        spike_clusters, \
+                        templates, \
+                        channel_map, \
+                        args['ephys_params']['bit_volts'], \
+                        args['ephys_params']['sample_rate'], \
+                        args['ephys_params']['vertical_site_spacing'], \
+                        w_inv, \
+                        site_x, site_y, \
+                        args['mean_waveform_params'])
         
         wm_fullpath = (args['waveform_metrics']['waveform_metrics_file'])
 
@@ -157,7 +167,18 @@ def calculate_mean_waveforms(args):
            # save new metrics as _version number
            wm_fullpath = os.path.join(pathlib.Path(wm_fullpath).parent, pathlib.Path(wm_fullpath).stem + '_' + repr(clu_version) + '.csv')
     
-        metrics.to_csv(wm_fullpath, index=False)
+        with stage('save'):
+            metrics.to_csv(wm_fullpath, index=False)
+
+            if args['mean_waveform_params'].get('mean_waveforms_store') is not None:
+                store_path = args['mean_waveform_params']['mean_waveforms_store']
+                if clu_version > 0:
+                    store_stem, store_ext = os.path.splitext(store_path.rstrip(os.sep))
+                    store_path = store_stem + '_' + repr(clu_version) + store_ext
+                write_waveform_store_from_c_waves(mean_waveform_fullpath, snr_fullpath, clus_table_npy,
+                                                  args['mean_waveform_params']['pre_samples'],
+                                                  args['ephys_params']['sample_rate'],
+                                                  store_path)
         
     else:
         
@@ -169,23 +190,36 @@ def calculate_mean_waveforms(args):
         # we need the site locations for all sites.
         # load the channel map associated with this kilosort run; in kilosort_helper
         # a copy is made next to the data file
-        input_file = args['ephys_params']['ap_band_file']
-        dat_dir, dat_fname = os.path.split(input_file)
-        dat_name, dat_ext = os.path.splitext(dat_fname)
-        chanMapMat = os.path.join(dat_dir, (dat_name +'_chanMap.mat'))
-        site_x = np.squeeze(loadmat(chanMapMat)['xcoords'])
-        site_y = np.squeeze(loadmat(chanMapMat)['ycoords'])
+        with stage('load'):
+            input_file = args['ephys_params']['ap_band_file']
+            dat_dir, dat_fname = os.path.split(input_file)
+            dat_name, dat_ext = os.path.splitext(dat_fname)
+            chanMapMat = os.path.join(dat_dir, (dat_name +'_chanMap.mat'))
+            site_x = np.squeeze(loadmat(chanMapMat)['xcoords'])
+            site_y = np.squeeze(loadmat(chanMapMat)['ycoords'])
     
-        rawData = np.memmap(args['ephys_params']['ap_band_file'], dtype='int16', mode='r')
-        data = np.reshape(rawData, (int(rawData.size/args['ephys_params']['num_channels']), args['ephys_params']['num_channels']))
+            rawData = np.memmap(args['ephys_params']['ap_band_file'], dtype='int16', mode='r')
+            data = np.reshape(rawData, (int(rawData.size/args['ephys_params']['num_channels']), args['ephys_params']['num_channels']))
     
-        spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
-        channel_pos, clusterIDs, cluster_quality, cluster_amplitude = \
-                load_kilosort_data(args['directories']['kilosort_output_directory'], \
-                    args['ephys_params']['sample_rate'], \
-                    convert_to_seconds = False)
+            spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
+            channel_pos, clusterIDs, cluster_quality, cluster_amplitude = \
+                    load_kilosort_data(args['directories']['kilosort_output_directory'], \
+                        args['ephys_params']['sample_rate'], \
+                        convert_to_seconds = False)
     
         print("Calculating mean waveforms...")
+
+        epochs = [Epoch('complete_session', 0, np.inf)]
+
+        if args['mean_waveform_params'].get('snippet_cache_dir') is not None:
+            snippet_cache = SnippetCache(args['mean_waveform_params']['snippet_cache_dir'],
+                                         args['ephys_params']['ap_band_file'],
+                                         spike_times,
+                                         args['mean_waveform_params']['pre_samples'],
+                                         args['mean_waveform_params']['samples_per_spike'],
+                                         args['ephys_params']['num_channels'])
+        else:
+            snippet_cache = None
     
         waveforms, spike_counts, coords, labels, metrics = extract_waveforms(data, spike_times, \
                     spike_clusters,
@@ -196,10 +230,27 @@ def calculate_mean_waveforms(args):
                     args['ephys_params']['vertical_site_spacing'], \
                     site_x, \
                     site_y, \
-                    args['mean_waveform_params'])
+                    args['mean_waveform_params'],
+                    epochs,
+                    snippet_cache)
     
-        writeDataAsNpy(waveforms, args['mean_waveform_params']['mean_waveforms_file'])
-        metrics.to_csv(args['waveform_metrics']['waveform_metrics_file'], index=False)
+        with stage('save'):
+            writeDataAsNpy(waveforms, args['mean_waveform_params']['mean_waveforms_file'])
+
+            if args['mean_waveform_params'].get('mean_waveforms_store') is not None:
+                peak_channels = np.full((waveforms.shape[0],), -1)
+                if len(metrics) > 0:
+                    peak_channels[metrics['cluster_id'].values] = metrics['peak_channel'].values
+                write_waveform_store(waveforms, spike_counts, coords[0], peak_channels,
+                                     [epoch.name for epoch in epochs],
+                                     args['mean_waveform_params']['pre_samples'],
+                                     args['ephys_params']['sample_rate'],
+                                     args['mean_waveform_params']['mean_waveforms_store'])
+        
+            # no clus_Table versioning on this path
+            clu_version = 0
+            wm_fullpath = args['waveform_metrics']['waveform_metrics_file']
+            metrics.to_csv(wm_fullpath, index=False)
 
 
     # if the cluster metrics have already been run, merge the waveform metrics into that file
@@ -207,14 +258,15 @@ def calculate_mean_waveforms(args):
     metrics_args = args['cluster_metrics']['cluster_metrics_file']
     metrics_curr = os.path.join(pathlib.Path(metrics_args).parent, pathlib.Path(metrics_args).stem + '_' + repr(clu_version) + '.csv')
 
-    if os.path.exists(metrics_curr):
-        qmetrics = pd.read_csv(metrics_curr)
-        qmetrics = qmetrics.drop(qmetrics.columns[0], axis='columns')
-        qmetrics = qmetrics.merge(pd.read_csv(wm_fullpath, index_col=0),
-                     on='cluster_id',
-                     suffixes=('_quality_metrics','_waveform_metrics'))  
-        print("Saving merged quality metrics ...")
-        qmetrics.to_csv(metrics_curr, index=False)
+    with stage('save'):
+        if os.path.exists(metrics_curr):
+            qmetrics = pd.read_csv(metrics_curr)
+            qmetrics = qmetrics.drop(qmetrics.columns[0], axis='columns')
+            qmetrics = qmetrics.merge(pd.read_csv(wm_fullpath, index_col=0),
+                         on='cluster_id',
+                         suffixes=('_quality_metrics','_waveform_metrics'))  
+            print("Saving merged quality metrics ...")
+            qmetrics.to_csv(metrics_curr, index=False)
         
     execution_time = time.time() - start
 
@@ -13,9 +13,20 @@ class MeanWaveformParams(DefaultSchema):
     site_range = Int(require=False, default=16, help='Number of sites to use for 2D waveform metrics')
     cWaves_path = InputDir(require=False, help='directory containing the TPrime executable.')
     use_C_Waves = Bool(require=False, default=False, help='Use faster C routine to calculate mean waveforms')
+    c_waves_engine = String(required=False, default='executable', help="With use_C_Waves: 'executable' to run C_Waves from cWaves_path, or 'python' for the in-package multithreaded implementation")
     snr_radius = Int(require=False, default=8, help='disk radius (chans) about pk-chan for snr calculation in C_waves')
     snr_radius_um = Int(require=False, default=8, help='disk radius (um) about pk-chan for snr calculation in C_waves')
+    spike_selection_file = String(required=False, help='Path (.npz) where the spikes selected for each cluster and epoch are saved, and reused by both the Python and C_Waves (python engine) paths while spike times, clusters and selection settings are unchanged')
+    spike_selection_seed = Int(required=False, default=0, help='Seed for the stratified-in-time spike selection')
+    prefer_isolated_spikes = Bool(required=False, default=False, help='Prefer spikes with no other spike within samples_per_spike samples when selecting spikes for mean waveforms')
+    snippet_buffer_mb = Int(required=False, default=1024, help='Memory for raw snippets read in one sequential pass over the data file (Python path)')
+    read_chunk_mb = Int(required=False, default=64, help='Size of each sequential read from the data file (Python path)')
+    snippet_cache_dir = String(required=False, help='Directory for a persistent cache of raw data snippets (snippets_*.npy plus index), shared by the Python path and the python C_Waves engine, and reused while the binary and spike_times.npy are unchanged')
+    streaming_mean_waveforms = Bool(required=False, default=False, help='Accumulate running mean and variance per cluster and epoch as snippets are read, instead of holding every snippet (Python path)')
+    n_jobs = Int(required=False, default=1, help='Number of worker processes for the 2D waveform features; -1 uses all cores')
+    parallel_backend = String(required=False, default='loky', help='joblib backend for the 2D waveform features: loky, multiprocessing or threading')
     mean_waveforms_file = String(required=True, help='Path to mean waveforms file (.npy)')
+    mean_waveforms_store = String(required=False, help='Path to chunked, compressed mean waveforms store (.zarr, or .nc for NetCDF4) with one chunk per unit; a <name>_unit_index.csv of peak channel and spike count is written next to it')
 
 
 class InputParameters(ArgSchema):
@@ -36,4 +47,5 @@ class OutputParameters(OutputSchema):
 
     execution_time = Float()
     mean_waveforms_file = String()
+    stage_profile = Dict(required=False, help='Wall time, CPU time and peak RSS (MB) for each processing stage')
     
\ No newline at end of file
@@ -7,9 +7,14 @@ import pandas as pd
 
 import warnings
 
-from .waveform_metrics import calculate_waveform_metrics
+from .waveform_metrics import calculate_snr, calculate_waveform_metrics_batch, Upsampler
 from ...common.epoch import Epoch
 from ...common.utils import printProgressBar
+from ...common.instrumentation import stage
+from ...common.spike_index import SpikeIndex
+from ...common.spike_selection import load_or_select_spikes
+from ...common.snippets import read_snippets, iter_snippets
+from ...common.welford import GroupedWelford
 
 def extract_waveforms(raw_data, 
                       spike_times, 
@@ -22,7 +27,8 @@ def extract_waveforms(raw_data,
                       site_x,
                       site_y,
                       params, 
-                      epochs=None):
+                      epochs=None,
+                      snippet_cache=None):
     
     """
     Calculate mean waveforms for sorted units.
@@ -36,6 +42,11 @@ def extract_waveforms(raw_data,
     cluster_quality : 'noise' or 'good'
     sample_rate : Hz
     site_spacing : m
+    epochs : list of Epoch objects (optional)
+        Each selected spike is read once and shared by every epoch it falls
+        in; a 'complete_session' epoch is added at the end if not present
+    snippet_cache : SnippetCache (optional)
+        Snippets are read from (and added to) this cache instead of raw_data
 
     Outputs:
     -------
@@ -58,6 +69,19 @@ def extract_waveforms(raw_data,
     pre_samples : number of samples prior to peak
     num_epochs : number of epochs to calculate mean waveforms
     spikes_per_epoch : max number of spikes to generate average for epoch
+    spike_selection_file : if given, the selected spikes are saved here
+        (.npz) and reused while the spikes and settings are unchanged
+    spike_selection_seed : seed for the spike selection
+    prefer_isolated_spikes : if True, spikes with no other spike within
+        samples_per_spike samples are preferred
+    snippet_buffer_mb : memory for raw snippets held at once; clusters are read
+        in batches of this size, each in one time-ordered pass over the file
+    read_chunk_mb : size of each sequential read from raw_data
+    streaming_mean_waveforms : if True, snippets are folded into a running
+        mean and variance per (cluster, epoch) as they are read (Welford), so
+        snippet_buffer_mb bounds the accumulator state rather than the raw
+        snippets and memory does not grow with spikes_per_epoch; SNR is then
+        computed from the running variance on the peak channel
 
     """
 
@@ -70,14 +94,24 @@ def extract_waveforms(raw_data,
     upsampling_factor = params['upsampling_factor']
     spread_threshold = params['spread_threshold']
     site_range = params['site_range']
+    snippet_buffer_bytes = params['snippet_buffer_mb'] * 2**20
+    read_chunk_bytes = params['read_chunk_mb'] * 2**20
+    streaming = params.get('streaming_mean_waveforms', False)
 
     # #############################################
 
-    metrics = pd.DataFrame()
+    metrics = []
+
+    # one upsampler for the metrics of every batch
+    upsampler = Upsampler(samples_per_spike, upsampling_factor, sample_rate)
 
     if epochs is None:
         epochs = [Epoch('complete_session', 0, np.inf)]
 
+    # the complete session is always averaged, alongside any other epochs
+    if 'complete_session' not in [epoch.name for epoch in epochs]:
+        epochs = list(epochs) + [Epoch('complete_session', 0, np.inf)]
+
     cluster_ids = np.arange(np.max(spike_clusters) + 1)
     total_units = len(cluster_ids)
     total_epochs = len(epochs)
@@ -89,73 +123,189 @@ def extract_waveforms(raw_data,
 
     peak_channels = np.squeeze(channel_map[np.argmax(np.max(templates,1) - np.min(templates,1),1)])
 
-    for epoch_idx, epoch in enumerate(epochs):
+    # up to spikes_per_epoch spikes of each cluster in each epoch, spread
+    # through the epoch (see select_spikes_stratified); each spike in the
+    # union over epochs is read once and shared by all the epochs that chose it
+    spike_index = SpikeIndex(spike_clusters, total_units)
+
+    selection = load_or_select_spikes(params.get('spike_selection_file'),
+                                      spike_times,
+                                      spike_clusters,
+                                      epochs,
+                                      sample_rate,
+                                      spikes_per_epoch,
+                                      params.get('spike_selection_seed', 0),
+                                      params.get('prefer_isolated_spikes', False),
+                                      samples_per_spike,
+                                      spike_index)
+
+    selected = selection.by_cluster(spike_clusters)
+
+    print("Epochs: " + ", ".join([epoch.name for epoch in epochs]))
+
+    # the raw snippets (or, when streaming, the running mean and variance)
+    # for a batch of clusters are held in memory together; each batch is one
+    # sequential pass over the file
+    selected_sizes = np.array([spikes.size for _, spikes, _ in selected], dtype = 'int64')
+
+    if streaming:
+        item_bytes = np.full(selected_sizes.shape, total_epochs * 2 * raw_data.shape[1] * samples_per_spike * 8, dtype = 'int64')
+    else:
+        item_bytes = selected_sizes * raw_data.shape[1] * samples_per_spike * raw_data.dtype.itemsize
+
+    batch_ids = np.cumsum(item_bytes) // max(snippet_buffer_bytes, 1)
+    batch_bounds = np.concatenate((np.where(np.diff(batch_ids) > 0)[0] + 1, [len(selected)]))
+
+    metric_epochs = []
+    batch_first = 0
+
+    for batch_last in batch_bounds:
+
+        if batch_last == batch_first:
+            continue
+
+        batch = selected[batch_first:batch_last]
+        batch_spikes = np.concatenate([spikes for _, spikes, _ in batch])
+        batch_chosen = np.concatenate([chosen for _, _, chosen in batch])
+
+        if streaming:
 
-        print("Epoch: " + epoch.name)
+            # one accumulator per (cluster, epoch); spikes at the start or end
+            # of the dataset are never read, so they do not contribute
+            accumulator = GroupedWelford(len(batch) * total_epochs, (raw_data.shape[1], samples_per_spike))
+            item_labels = np.repeat(np.arange(len(batch)), selected_sizes[batch_first:batch_last])
 
-        in_epoch = ((spike_times / sample_rate) > epoch.start_time) * ((spike_times / sample_rate) < epoch.end_time)
+            if snippet_cache is None:
+                snippet_source = iter_snippets(raw_data, spike_times[batch_spikes], pre_samples, samples_per_spike, read_chunk_bytes)
+            else:
+                snippet_source = snippet_cache.iter_snippets(raw_data, spike_times, batch_spikes, read_chunk_bytes, merge = False)
 
-        spike_times_in_epoch = spike_times[in_epoch]
+            with stage('read_snippets'):
+                for positions, block_snippets in snippet_source:
 
-        for cluster_idx, cluster_id in enumerate(cluster_ids):
+                    # each snippet goes to every epoch that chose it
+                    for epoch_idx in range(total_epochs):
+                        rows = batch_chosen[positions, epoch_idx]
+                        if np.any(rows):
+                            accumulator.update(item_labels[positions[rows]] * total_epochs + epoch_idx, block_snippets[rows])
+
+            variances = accumulator.variance()
+
+        else:
+
+            with stage('read_snippets'):
+                if snippet_cache is None:
+                    snippets, valid = read_snippets(raw_data,
+                                                    spike_times[batch_spikes],
+                                                    pre_samples,
+                                                    samples_per_spike,
+                                                    read_chunk_bytes)
+                else:
+                    snippets, valid = snippet_cache.read_snippets(raw_data, spike_times, batch_spikes, read_chunk_bytes, merge = False)
+
+            snippet_offsets = np.concatenate(([0], np.cumsum(selected_sizes[batch_first:batch_last])))
+
+        # mean waveforms before offset removal and SNR, for the metrics
+        batch_means = np.zeros((len(batch), total_epochs, raw_data.shape[1], samples_per_spike))
+        batch_snr = np.zeros((len(batch), total_epochs))
+        batch_items = []
+
+        for item_idx, (cluster_idx, spikes_for_cluster, chosen) in enumerate(batch):
 
             printProgressBar(cluster_idx+1, total_units)
 
-            in_cluster = (spike_clusters[in_epoch] == cluster_id)
+            peak_channel = peak_channels[cluster_idx]
+
+            for epoch_idx in np.where(np.any(chosen, 0))[0]:
 
-            if np.sum(in_cluster) > 0:
+                total_waveforms = np.sum(chosen[:, epoch_idx])
 
-                times_for_cluster = spike_times_in_epoch[in_cluster]
+                if streaming:
 
-                waveforms = np.empty(
-                    (spikes_per_epoch, raw_data.shape[1], samples_per_spike))
-                waveforms[:] = np.nan
+                    group = item_idx * total_epochs + epoch_idx
 
-                np.random.shuffle(times_for_cluster)
+                    with warnings.catch_warnings(), stage('mean_std'):
 
-                total_waveforms = np.min(
-                    [times_for_cluster.size, spikes_per_epoch])
+                        warnings.simplefilter("ignore", category=RuntimeWarning)
 
-                for wv_idx, peak_time in enumerate(times_for_cluster[:total_waveforms]):
-                    start = int(peak_time-pre_samples)
-                    end = start + samples_per_spike
-                    rawWaveform = raw_data[start:end, :].T
+                        if accumulator.count[group] > 0:
+                            batch_means[item_idx, epoch_idx] = accumulator.mean[group] * bit_volts
+                        else:
+                            batch_means[item_idx, epoch_idx] = np.nan
 
-                    # in case spike was at start or end of dataset
-                    if rawWaveform.shape[1] == samples_per_spike:
-                        waveforms[wv_idx, :, :] = rawWaveform * bit_volts
+                        variance = variances[group] * bit_volts**2
+                        std_2D_waveform = np.sqrt(variance)
 
-                # concatenate to existing dataframe
-                metrics = pd.concat([metrics, calculate_waveform_metrics(waveforms[:total_waveforms, :, :],
-                                                                         cluster_id, 
-                                                                         peak_channels[cluster_idx], 
-                                                                         channel_map,
-                                                                         sample_rate, 
-                                                                         upsampling_factor,
-                                                                         spread_threshold,
-                                                                         site_range,
-                                                                         site_spacing,
-                                                                         site_x,
-                                                                         site_y,
-                                                                         epoch.name
-                                                                         )])
+                        # same as calculate_snr: the residuals about the mean are
+                        # pooled over time on the peak channel
+                        batch_snr[item_idx, epoch_idx] = (np.max(batch_means[item_idx, epoch_idx, peak_channel, :]) - np.min(batch_means[item_idx, epoch_idx, peak_channel, :])) / \
+                                                         (2 * np.sqrt(np.mean(variance[peak_channel, :])))
 
-                with warnings.catch_warnings():
+                else:
 
-                    warnings.simplefilter("ignore", category=RuntimeWarning)
-                    mean_waveforms[cluster_idx, epoch_idx,
-                                   0, :, :] = np.nanmean(waveforms, 0)
-                    mean_waveforms[cluster_idx, epoch_idx,
-                                   1, :, :] = np.nanstd(waveforms, 0)
+                    rows = snippet_offsets[item_idx] + np.where(chosen[:, epoch_idx])[0]
 
-                    # remove offset
-                    for channel in range(0, mean_waveforms.shape[3]):
-                        mean_waveforms[cluster_idx, epoch_idx, 0, channel, :] = \
-                            mean_waveforms[cluster_idx, epoch_idx, 0, channel, :] - \
-                            mean_waveforms[cluster_idx, epoch_idx, 0, channel, 0]
+                    waveforms = np.empty(
+                        (spikes_per_epoch, raw_data.shape[1], samples_per_spike))
+                    waveforms[:] = np.nan
+
+                    # spikes at the start or end of the dataset are left as NaN
+                    read_ok = valid[rows]
+                    waveforms[:total_waveforms][read_ok] = snippets[rows][read_ok] * bit_volts
+
+                    with warnings.catch_warnings(), stage('mean_std'):
+
+                        warnings.simplefilter("ignore", category=RuntimeWarning)
+                        batch_means[item_idx, epoch_idx] = np.nanmean(waveforms, 0)
+                        std_2D_waveform = np.nanstd(waveforms, 0)
+                        batch_snr[item_idx, epoch_idx] = calculate_snr(waveforms[:total_waveforms, peak_channel, :])
+
+                mean_waveforms[cluster_idx, epoch_idx, 0, :, :] = batch_means[item_idx, epoch_idx]
+                mean_waveforms[cluster_idx, epoch_idx, 1, :, :] = std_2D_waveform
+
+                # remove offset
+                mean_waveforms[cluster_idx, epoch_idx, 0, :, :] -= mean_waveforms[cluster_idx, epoch_idx, 0, :, :1]
 
                 spike_count[cluster_idx, epoch_idx] = total_waveforms
 
+                batch_items.append((item_idx, epoch_idx))
+
+        item_rows, epoch_rows = np.array(batch_items, dtype = 'int64').reshape(-1, 2).T
+        batch_clusters = np.array([cluster_idx for cluster_idx, _, _ in batch])[item_rows]
+
+        metrics.append(calculate_waveform_metrics_batch(batch_means[item_rows, epoch_rows],
+                                                        batch_snr[item_rows, epoch_rows],
+                                                        batch_clusters,
+                                                        peak_channels[batch_clusters],
+                                                        channel_map,
+                                                        sample_rate,
+                                                        upsampling_factor,
+                                                        spread_threshold,
+                                                        site_range,
+                                                        site_x,
+                                                        site_y,
+                                                        [epochs[epoch_idx].name for epoch_idx in epoch_rows],
+                                                        params.get('n_jobs', 1),
+                                                        params.get('parallel_backend', 'loky'),
+                                                        upsampler
+                                                        ))
+        metric_epochs.append(epoch_rows)
+
+        batch_first = batch_last
+
+    # snippets read in every batch are added to the cache in one rewrite
+    if snippet_cache is not None:
+        with stage('read_snippets'):
+            snippet_cache.merge_pending(read_chunk_bytes)
+
+    # one table for all batches, ordered by epoch and then cluster
+    if len(metrics) > 0:
+        metrics = pd.concat(metrics, ignore_index=True)
+        order = np.lexsort((metrics['cluster_id'].values, np.concatenate(metric_epochs)))
+        metrics = metrics.iloc[order].reset_index(drop=True)
+    else:
+        metrics = pd.DataFrame()
+
     dimCoords, dimLabels = generateDimLabels(
         cluster_ids, total_epochs, pre_samples, samples_per_spike, raw_data.shape[1], sample_rate)
 
@@ -7,7 +7,7 @@ import pandas as pd
 
 import warnings
 
-from .waveform_metrics import calculate_waveform_metrics_from_avg
+from .waveform_metrics import calculate_waveform_metrics_batch
 from ...common.epoch import Epoch
 from ...common.utils import printProgressBar
 
@@ -80,8 +80,6 @@ def metrics_from_file(mean_waveform_fullpath,
 
     # #############################################
 
-    metrics = pd.DataFrame()
-
     cluster_ids = np.arange(np.max(spike_clusters) + 1)
     total_units = len(cluster_ids)
     
@@ -105,27 +103,21 @@ def metrics_from_file(mean_waveform_fullpath,
 #        currdiff = np.max(curr_unwh,1) - np.min(curr_unwh,1)
 #        peak_channels[i] = channel_map[np.argmax(currdiff)]
     
-    for cluster_idx, cluster_id in enumerate(cluster_ids):
-
-        printProgressBar(cluster_idx+1, total_units)
-
-        snr = snr_array[cluster_idx,0]
-        nSpike = snr_array[cluster_idx,1]
-        # if at least one spike, calculate metrics and concatenate to existing dataframe
-        if nSpike > 0:
-            metrics = pd.concat([metrics, calculate_waveform_metrics_from_avg(mean_waveforms[cluster_idx,:],
-                                                                     snr,
-                                                                     cluster_id, 
-                                                                     peak_channels[cluster_idx], 
-                                                                     channel_map,
-                                                                     sample_rate, 
-                                                                     upsampling_factor,
-                                                                     spread_threshold,
-                                                                     site_range,
-                                                                     site_x, site_y                                                                    
-                                                                     )])
-
-
+    # metrics for every cluster with at least one spike, in one batch
+    has_spikes = np.where(snr_array[:total_units,1] > 0)[0]
+
+    metrics = calculate_waveform_metrics_batch(mean_waveforms[has_spikes],
+                                               snr_array[has_spikes,0],
+                                               cluster_ids[has_spikes],
+                                               peak_channels[has_spikes],
+                                               channel_map,
+                                               sample_rate,
+                                               upsampling_factor,
+                                               spread_threshold,
+                                               site_range,
+                                               site_x, site_y,
+                                               n_jobs = params.get('n_jobs', 1),
+                                               parallel_backend = params.get('parallel_backend', 'loky'))
 
     return metrics
 
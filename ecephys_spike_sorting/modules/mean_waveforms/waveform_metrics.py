@@ -2,9 +2,16 @@ import numpy as np
 import random
 import pandas as pd
 
+from functools import lru_cache
+
+from scipy import fft as sp_fft
 from scipy.stats import linregress
-from scipy.signal import resample
+from scipy.signal import get_window
+from joblib import Parallel, delayed, effective_n_jobs
+
+from ...common.instrumentation import profiled
 
+@profiled('waveform_metrics')
 def calculate_waveform_metrics(waveforms, 
                                cluster_id, 
                                peak_channel, 
@@ -16,7 +23,8 @@ def calculate_waveform_metrics(waveforms,
                                site_spacing,
                                site_x,
                                site_y,
-                               epoch_name):
+                               epoch_name,
+                               upsampler=None):
     
     """
     Calculate metrics for an array of waveforms.
@@ -49,6 +57,8 @@ def calculate_waveform_metrics(waveforms,
         Average vertical distance between sites (m)
     site_x, site_y : float
         Channel positions (um)
+    upsampler : Upsampler
+        Reused for waveforms with the same length (optional)
 
     Outputs:
     -------
@@ -70,13 +80,12 @@ def calculate_waveform_metrics(waveforms,
     mean_2D_waveform = np.squeeze(np.nanmean(waveforms, 0))
     local_peak = peak_channel
 
-    num_samples = waveforms.shape[2]
-    new_sample_count = int(num_samples * upsampling_factor)
+    if upsampler is None:
+        upsampler = get_upsampler(waveforms.shape[2], upsampling_factor, sample_rate)
 
-    mean_1D_waveform = resample(
-        mean_2D_waveform[local_peak, :], new_sample_count)
+    mean_1D_waveform = upsampler.resample(mean_2D_waveform[local_peak, :])
 
-    timestamps = np.linspace(0, num_samples / sample_rate, new_sample_count)
+    timestamps = upsampler.timestamps
 
     duration = calculate_waveform_duration(mean_1D_waveform, timestamps)
     halfwidth = calculate_waveform_halfwidth(mean_1D_waveform, timestamps)
@@ -87,7 +96,7 @@ def calculate_waveform_metrics(waveforms,
         mean_1D_waveform, timestamps)
 
     amplitude, spread, velocity_above, velocity_below = calculate_2D_features(
-        mean_2D_waveform, timestamps, local_peak, site_x, site_y, spread_threshold, site_range, site_spacing)
+        mean_2D_waveform, timestamps, local_peak, site_x, site_y, spread_threshold, site_range)
 
     data = [[cluster_id, epoch_name, peak_channel, snr, duration, halfwidth, PT_ratio, repolarization_slope,
               recovery_slope, amplitude, spread, velocity_above, velocity_below]]
@@ -99,6 +108,7 @@ def calculate_waveform_metrics(waveforms,
 
     return metrics
 
+@profiled('waveform_metrics')
 def calculate_waveform_metrics_from_avg(avg_waveform,
                                         snr,
                                         cluster_id, 
@@ -108,7 +118,9 @@ def calculate_waveform_metrics_from_avg(avg_waveform,
                                         upsampling_factor, 
                                         spread_threshold,
                                         site_range,
-                                        site_x, site_y):
+                                        site_x, site_y,
+                                        epoch_name='complete_session',
+                                        upsampler=None):
 
     """
     Calculate metrics for an array of waveforms for a single cluster.
@@ -122,8 +134,8 @@ def calculate_waveform_metrics_from_avg(avg_waveform,
     Inputs:
     -------
     avg_waveform : numpy.ndarray (num_channels x num_samples)
-        from C_waves output
-    snr : from C_waves output
+        from C_waves output, or a streamed mean waveform
+    snr : from C_waves output, or computed alongside the streamed mean
     cluster_id : int
         ID for cluster
     peak_channel : int
@@ -139,6 +151,10 @@ def calculate_waveform_metrics_from_avg(avg_waveform,
     site_range : float
         Number of sites to use for 2D waveform metrics
     site_x, site_y : channel positions in um
+    epoch_name : str
+        Epoch the average was drawn from (default is the whole session)
+    upsampler : Upsampler
+        Reused for waveforms with the same length (optional)
 
     Outputs:
     -------
@@ -149,9 +165,6 @@ def calculate_waveform_metrics_from_avg(avg_waveform,
 
     # snr = calculate_snr(waveforms[:, peak_channel, :])
     
-    # calulating from average waveforms drawn from whole session
-    epoch_name = 'complete_session'
-    
     # all metric calculations are restricted to the channesl in the map
     # jic removed this -- we need to sample all channels for 2D calculations
     # moreover, this is assumed in the stnadard Allen calculation
@@ -160,13 +173,12 @@ def calculate_waveform_metrics_from_avg(avg_waveform,
     mean_2D_waveform = avg_waveform
     local_peak = peak_channel
 
-    num_samples = mean_2D_waveform.shape[1]
-    new_sample_count = int(num_samples * upsampling_factor)
+    if upsampler is None:
+        upsampler = get_upsampler(mean_2D_waveform.shape[1], upsampling_factor, sample_rate)
 
-    mean_1D_waveform = resample(
-        mean_2D_waveform[local_peak, :], new_sample_count)
+    mean_1D_waveform = upsampler.resample(mean_2D_waveform[local_peak, :])
 
-    timestamps = np.linspace(0, num_samples / sample_rate, new_sample_count)
+    timestamps = upsampler.timestamps
 
     duration = calculate_waveform_duration(mean_1D_waveform, timestamps)
     halfwidth = calculate_waveform_halfwidth(mean_1D_waveform, timestamps)
@@ -189,6 +201,231 @@ def calculate_waveform_metrics_from_avg(avg_waveform,
 
     return metrics
 
+
+@profiled('waveform_metrics')
+def calculate_waveform_metrics_batch(avg_waveforms,
+                                     snr,
+                                     cluster_ids,
+                                     peak_channels,
+                                     channel_map,
+                                     sample_rate,
+                                     upsampling_factor,
+                                     spread_threshold,
+                                     site_range,
+                                     site_x, site_y,
+                                     epoch_names='complete_session',
+                                     n_jobs=1,
+                                     parallel_backend='loky',
+                                     upsampler=None):
+
+    """
+    Calculate metrics for the mean waveforms of many clusters at once.
+
+    Same metrics as calculate_waveform_metrics_from_avg, but the peak channel
+    waveforms of all clusters are upsampled with one FFT along the sample axis
+    (see Upsampler),
+    the 1D features are computed with array operations along the unit axis
+    (see calculate_1D_features), and the table is built once.
+
+    Inputs:
+    -------
+    avg_waveforms : numpy.ndarray (num_units x num_channels x num_samples)
+        Mean waveform of each cluster
+    snr : numpy.ndarray (num_units x 0)
+    cluster_ids : numpy.ndarray (num_units x 0)
+    peak_channels : numpy.ndarray (num_units x 0)
+    channel_map : numpy.ndarray
+        Channels used for spike sorting
+    sample_rate : float
+        Sample rate in Hz
+    upsampling_factor : float
+        Relative rate at which to upsample the spike waveform
+    spread_threshold : float
+        Threshold for computing spread of 2D waveform
+    site_range : float
+        Number of sites to use for 2D waveform metrics
+    site_x, site_y : channel positions in um
+    epoch_names : str or list of str
+        Epoch each average was drawn from (one name for all, or one per unit)
+    n_jobs : int
+        Number of workers for the 2D features; -1 uses all cores
+    parallel_backend : str
+        joblib backend for the workers
+    upsampler : Upsampler
+        Reused for waveforms with the same length (optional)
+
+    Outputs:
+    -------
+    metrics : pandas.DataFrame
+        One row per unit, in the order of avg_waveforms
+
+    """
+
+    columns = ['cluster_id', 'epoch_name', 'peak_channel', 'snr', 'duration', 'halfwidth',
+               'PT_ratio', 'repolarization_slope', 'recovery_slope', 'amplitude',
+               'spread', 'velocity_above', 'velocity_below']
+
+    num_units, num_channels, num_samples = avg_waveforms.shape
+
+    if num_units == 0:
+        return pd.DataFrame(columns=columns)
+
+    peak_channels = np.asarray(peak_channels)
+
+    if upsampler is None:
+        upsampler = get_upsampler(num_samples, upsampling_factor, sample_rate)
+
+    mean_1D_waveforms = upsampler.resample(
+        avg_waveforms[np.arange(num_units), peak_channels.astype('int64'), :])
+
+    timestamps = upsampler.timestamps
+
+    duration, halfwidth, PT_ratio, repolarization_slope, recovery_slope = calculate_1D_features(
+        mean_1D_waveforms, timestamps)
+
+    if n_jobs == 1:
+
+        features_2D = features_2D_for_units(avg_waveforms, timestamps, peak_channels,
+                                            site_x, site_y, spread_threshold, site_range)
+
+    else:
+
+        # units with the same peak channel go to the same worker, so each
+        # worker's site selection cache is reused as much as possible
+        by_peak = np.argsort(peak_channels, kind='stable')
+        num_workers = effective_n_jobs(n_jobs)
+        chunks = np.array_split(by_peak, min(num_units, 4 * num_workers))
+        chunks = [chunk for chunk in chunks if chunk.size > 0]
+
+        chunk_features = Parallel(n_jobs=n_jobs, backend=parallel_backend, max_nbytes='1M', mmap_mode='r')(
+                             delayed(features_2D_for_units)(avg_waveforms[chunk], timestamps, peak_channels[chunk],
+                                                            site_x, site_y, spread_threshold, site_range)
+                             for chunk in chunks)
+
+        features_2D = np.zeros((num_units, 4))
+        features_2D[np.concatenate(chunks)] = np.concatenate(chunk_features, 0)
+
+    metrics = pd.DataFrame({'cluster_id': np.asarray(cluster_ids),
+                            'epoch_name': epoch_names,
+                            'peak_channel': peak_channels,
+                            'snr': np.asarray(snr),
+                            'duration': duration,
+                            'halfwidth': halfwidth,
+                            'PT_ratio': PT_ratio,
+                            'repolarization_slope': repolarization_slope,
+                            'recovery_slope': recovery_slope,
+                            'amplitude': features_2D[:, 0],
+                            'spread': features_2D[:, 1],
+                            'velocity_above': features_2D[:, 2],
+                            'velocity_below': features_2D[:, 3]},
+                           columns=columns)
+
+    return metrics
+
+# ==========================================================
+
+# UPSAMPLING
+
+# ==========================================================
+
+
+class Upsampler():
+
+    """
+    Fourier resampling of waveforms with a fixed number of samples, built once
+    and reused for every unit
+
+    Gives the same output as scipy.signal.resample(waveforms, new_sample_count,
+    axis=-1, window=window) for real waveforms, but the output spectrum layout
+    (the bins kept, the Nyquist bin split and the folded window) is worked out
+    once, and a whole batch of waveforms goes through a single rfft / irfft
+    pair. scipy.fft keeps the FFT plans for the two lengths in its own cache,
+    so repeated calls with the same shape do not re-plan.
+
+    """
+
+    def __init__(self, num_samples, upsampling_factor, sample_rate, window=None):
+
+        """
+        num_samples : int
+            Samples per input waveform
+        upsampling_factor : float
+            Relative rate of the output; new_sample_count = int(num_samples * upsampling_factor)
+        sample_rate : float
+            Sample rate of the input in Hz, for the timestamps
+        window : str, tuple or numpy.ndarray
+            Spectral window, as in scipy.signal.resample (default is none)
+
+        """
+
+        self.num_samples = num_samples
+        self.new_sample_count = int(num_samples * upsampling_factor)
+
+        self.timestamps = np.linspace(0, num_samples / sample_rate, self.new_sample_count)
+        self.timestamps.flags.writeable = False
+
+        # bins of the input spectrum that are copied, including Nyquist if present
+        N = min(self.new_sample_count, num_samples)
+        self.num_bins = N // 2 + 1
+
+        gain = np.ones((self.num_bins,))
+
+        if window is not None:
+            if isinstance(window, np.ndarray):
+                W = window.astype('float64')
+            else:
+                W = sp_fft.ifftshift(get_window(window, num_samples))
+            # fold the window back on itself, as for real input in resample
+            W_real = W.copy()
+            W_real[1:] += W_real[-1:0:-1]
+            W_real[1:] *= 0.5
+            gain *= W_real[:self.num_bins]
+
+        # split or join the Nyquist component
+        if N % 2 == 0:
+            if self.new_sample_count < num_samples:
+                gain[N // 2] *= 2.
+            elif num_samples < self.new_sample_count:
+                gain[N // 2] *= 0.5
+
+        self.gain = gain
+        self.scale = float(self.new_sample_count) / float(num_samples)
+
+
+    def resample(self, waveforms):
+
+        """
+        Upsampled waveforms
+
+        Inputs:
+        -------
+        waveforms : numpy.ndarray (... x num_samples)
+
+        Outputs:
+        --------
+        upsampled : numpy.ndarray (... x new_sample_count)
+
+        """
+
+        X = sp_fft.rfft(waveforms, axis=-1)
+
+        Y = np.zeros(X.shape[:-1] + (self.new_sample_count // 2 + 1,), X.dtype)
+        Y[..., :self.num_bins] = X[..., :self.num_bins] * self.gain
+
+        upsampled = sp_fft.irfft(Y, self.new_sample_count, axis=-1)
+        upsampled *= self.scale
+
+        return upsampled
+
+
+@lru_cache(maxsize=16)
+def get_upsampler(num_samples, upsampling_factor, sample_rate):
+
+    """ Shared Upsampler for waveforms of this length """
+
+    return Upsampler(num_samples, upsampling_factor, sample_rate)
+
+
 # ==========================================================
 
 # EXTRACTING 1D FEATURES
@@ -373,6 +610,98 @@ def calculate_waveform_recovery_slope(waveform, timestamps, window=20):
     return recovery_slope * 1e-6
 
 
+def calculate_1D_features(waveforms, timestamps, window=20):
+
+    """
+    Duration, halfwidth, peak-to-trough ratio, repolarization slope and
+    recovery slope of many 1D waveforms at once
+
+    Row i of each output is the value of the corresponding single-waveform
+    function above for waveforms[i], computed with masked argmin / argmax and
+    least-squares sums along the sample axis instead of a loop over units.
+
+    Inputs:
+    ------
+    waveforms : numpy.ndarray (M waveforms x N samples)
+    timestamps : numpy.ndarray (N samples)
+    window : int
+        Window (in samples) for the slope regressions
+
+    Outputs:
+    --------
+    duration : milliseconds
+    halfwidth : milliseconds (NaN if the half-amplitude crossings are missing)
+    PT_ratio : peak-to-trough ratio
+    repolarization_slope : V / s
+    recovery_slope : V / s
+
+    """
+
+    units = np.arange(waveforms.shape[0])
+    samples = np.arange(waveforms.shape[1])[np.newaxis, :]
+
+    trough_idx = np.argmin(waveforms, 1)
+    peak_idx = np.argmax(waveforms, 1)
+    trough = waveforms[units, trough_idx]
+    peak = waveforms[units, peak_idx]
+
+    # to avoid detecting peak before trough, start from the larger extremum
+    peak_first = peak > np.abs(trough)
+    start = np.where(peak_first, peak_idx, trough_idx)[:, np.newaxis]
+    sign = np.where(peak_first, 1, -1)[:, np.newaxis]
+
+    after = samples >= start
+    end = np.argmin(np.where(after, sign * waveforms, np.inf), 1)
+
+    duration = (timestamps[end] - timestamps[start[:, 0]]) * 1e3
+
+    # flipping the sign of trough-first waveforms makes both cases
+    # "above threshold before, below threshold after"
+    threshold = sign * np.where(peak_first, peak, trough)[:, np.newaxis] * 0.5
+    crossing_1 = (samples < start) & (sign * waveforms > threshold)
+    crossing_2 = after & (sign * waveforms < threshold)
+
+    found = np.any(crossing_1, 1) & np.any(crossing_2, 1)
+    halfwidth = np.where(found,
+                         timestamps[np.argmax(crossing_2, 1)] - timestamps[np.argmax(crossing_1, 1)],
+                         np.nan) * 1e3
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        PT_ratio = np.abs(peak / trough)
+
+    max_point = np.argmax(np.abs(waveforms), 1)
+    inverted = - waveforms * np.sign(waveforms[units, max_point])[:, np.newaxis]
+
+    recovery_idx = np.argmax(np.where(samples >= max_point[:, np.newaxis], inverted, -np.inf), 1)
+
+    repolarization_slope = window_slopes(inverted, timestamps, max_point, window) * 1e-6
+    recovery_slope = window_slopes(inverted, timestamps, recovery_idx, window) * 1e-6
+
+    return duration, halfwidth, PT_ratio, repolarization_slope, recovery_slope
+
+
+def window_slopes(waveforms, timestamps, starts, window):
+
+    """
+    Least-squares slope of each waveform against timestamps over the samples
+    starts[i]:starts[i]+window (as linregress; NaN for a single sample)
+
+    """
+
+    samples = np.arange(waveforms.shape[1])[np.newaxis, :]
+    in_window = (samples >= starts[:, np.newaxis]) & (samples < starts[:, np.newaxis] + window)
+    count = np.sum(in_window, 1)
+
+    t_mean = np.sum(np.where(in_window, timestamps, 0), 1) / count
+    w_mean = np.sum(np.where(in_window, waveforms, 0), 1) / count
+
+    t_dev = np.where(in_window, timestamps - t_mean[:, np.newaxis], 0)
+    w_dev = np.where(in_window, waveforms - w_mean[:, np.newaxis], 0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.sum(t_dev * w_dev, 1) / np.sum(t_dev * t_dev, 1)
+
+
 # ==========================================================
 
 # EXTRACTING 2D FEATURES
@@ -380,7 +709,8 @@ def calculate_waveform_recovery_slope(waveform, timestamps, window=20):
 # ==========================================================
 
 
-def calculate_2D_features(waveform, timestamps, peak_channel, site_x, site_y, spread_threshold = 0.12, site_range=16):
+def calculate_2D_features(waveform, timestamps, peak_channel, site_x, site_y, spread_threshold = 0.12, site_range=16,
+                          site_neighborhoods=None):
     
     """ 
     Compute features of 2D waveform (channels x samples)
@@ -393,6 +723,8 @@ def calculate_2D_features(waveform, timestamps, peak_channel, site_x, site_y, sp
     spread_threshold : float
     site_range: int
     site_x, site_y : float
+    site_neighborhoods : SiteNeighborhoods (optional)
+        Site selection cache for this probe geometry, shared between units
 
     Outputs:
     --------
@@ -404,54 +736,17 @@ def calculate_2D_features(waveform, timestamps, peak_channel, site_x, site_y, sp
     """
 
     assert site_range % 2 == 0 # must be even
-    
-    # sample sites that are in the same "column" as the peak channel
-    # first find nn with y ~= y_peak
-    # x = x_peak or x_nn. For NP 1.0, this will select either the 
-    # two left or two right hand columns.
-    
-    dist = np.sqrt(( pow((site_x - site_x[peak_channel]),2) + pow((site_y - site_y[peak_channel]),2)))
-    ydiff = ( site_y != site_y[peak_channel])
-    n_channel = site_x.size
-    min_dist = 1e6   # a value larger than the  distance to nn
-    x_nn = -1
-    amp_nn = 0
-    x_peak = site_x[peak_channel]
-    
-    for i in range(n_channel):
-        if ydiff[i] and dist[i] <= min_dist:  #only consider nn at diff y
-            min_dist = dist[i]
-            # to break ties between columns at the same distance, pick nn with
-            # largest amplitude
-            currAmp = np.max(waveform[i,:]) - np.min(waveform[i,:])
-            if currAmp > amp_nn:
-                x_nn = site_x[i]
-            
-    # select among sites with x = x_peak and x_nn for sites to sample
-    inCol = (site_x == x_peak) | (site_x == x_nn)   
-    sort_dist_ind = np.argsort(dist)
-    sites_to_sample = np.zeros(site_range+1, dtype='int32')
-    
-    nfound = 0
-    i = 0
-    # walk over all sites in order of distance from the peak_channel, add to
-    # list of channels to sample
-    while nfound < site_range and i < n_channel:
-        curr_chan = sort_dist_ind[i]
-        if inCol[curr_chan]:
-            sites_to_sample[nfound] = curr_chan
-            nfound = nfound + 1           
-            # print('site, dist: ' + repr(curr_chan) + ',' + repr(dist[curr_chan]))
-        i = i+1
-            
-    
+
+    if site_neighborhoods is None:
+        site_neighborhoods = SiteNeighborhoods(site_x, site_y)
+
+    sites_to_sample = site_neighborhoods.sites_to_sample(waveform, peak_channel, site_range)
+
     # original implentation for NP 1.0, assuming all sites in one bank, pick 
     # even or odd sites 
     # sites_to_sample = np.arange(-site_range, site_range+1, 2) + peak_channel
     # sites_to_sample = sites_to_sample[(sites_to_sample > 0) * (sites_to_sample < waveform.shape[0])]
 
-    # take only as many sites as we "found"
-    sites_to_sample = sites_to_sample[0:nfound]
     wv = waveform[sites_to_sample, :]
 
     #smoothed_waveform = np.zeros((wv.shape[0]-1,wv.shape[1]))
@@ -500,6 +795,96 @@ def calculate_2D_features(waveform, timestamps, peak_channel, site_x, site_y, sp
     return amplitude, spread, velocity_above, velocity_below
 
 
+class SiteNeighborhoods():
+
+    """
+    Sites sampled by calculate_2D_features, cached for one probe geometry
+
+    The sites are those in the same "column" as the peak channel: find the
+    nearest neighbour with y != y_peak, then take the site_range sites closest
+    to the peak with x = x_peak or x = x_nn. This depends on the waveform only
+    through which nearest-neighbour candidates have a non-zero amplitude, so
+    the candidates are cached per peak channel and the selected sites per
+    (peak_channel, site_range, x_nn). Units that share a peak channel (common
+    on multi-shank probes) reuse the same neighbourhood.
+
+    """
+
+    def __init__(self, site_x, site_y):
+
+        self.site_x = np.asarray(site_x)
+        self.site_y = np.asarray(site_y)
+
+        self._distances = {}
+        self._candidates = {}
+        self._sites = {}
+
+
+    def sites_to_sample(self, waveform, peak_channel, site_range):
+
+        """ Channels to sample for a unit with this (channels x samples) waveform """
+
+        dist, candidates = self._neighbors(peak_channel)
+
+        # to break ties between columns at the same distance, the last
+        # candidate with a non-zero amplitude is the nearest neighbour
+        amplitude = np.max(waveform[candidates, :], 1) - np.min(waveform[candidates, :], 1)
+        with_signal = candidates[amplitude > 0]
+        x_nn = self.site_x[with_signal[-1]] if with_signal.size > 0 else -1
+
+        key = (peak_channel, site_range, x_nn)
+
+        if key not in self._sites:
+
+            # walk over all sites in order of distance from the peak_channel
+            inCol = (self.site_x == self.site_x[peak_channel]) | (self.site_x == x_nn)
+            sort_dist_ind = np.argsort(dist)
+
+            self._sites[key] = sort_dist_ind[inCol[sort_dist_ind]][:site_range]
+
+        return self._sites[key]
+
+
+    def _neighbors(self, peak_channel):
+
+        """
+        Distance of every site from the peak channel, and the sites that would
+        become the nearest neighbour (at a different y) when scanned in
+        channel order
+
+        """
+
+        if peak_channel not in self._candidates:
+
+            dist = np.sqrt(( pow((self.site_x - self.site_x[peak_channel]),2) + pow((self.site_y - self.site_y[peak_channel]),2)))
+
+            # only consider nn at diff y; a site is a candidate if it is at
+            # least as close as every earlier one
+            ydiff = np.where(self.site_y != self.site_y[peak_channel])[0]
+            closest_so_far = np.minimum.accumulate(np.concatenate(([1e6], dist[ydiff])))[:-1]
+
+            self._distances[peak_channel] = dist
+            self._candidates[peak_channel] = ydiff[dist[ydiff] <= closest_so_far]
+
+        return self._distances[peak_channel], self._candidates[peak_channel]
+
+
+def features_2D_for_units(avg_waveforms, timestamps, peak_channels, site_x, site_y, spread_threshold, site_range):
+
+    """ calculate_2D_features for each unit, sharing one SiteNeighborhoods (num_units x 4) """
+
+    site_neighborhoods = SiteNeighborhoods(site_x, site_y)
+
+    features = np.zeros((len(peak_channels), 4))
+
+    for unit_idx, peak_channel in enumerate(peak_channels):
+        features[unit_idx, :] = calculate_2D_features(avg_waveforms[unit_idx], timestamps, peak_channel,
+                                                      site_x, site_y, spread_threshold, site_range,
+                                                      site_neighborhoods)
+
+    return features
+
+
 # ==========================================================
 
 # HELPER FUNCTIONS:
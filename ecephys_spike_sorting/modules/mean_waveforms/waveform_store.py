@@ -0,0 +1,223 @@
+import os
+import importlib.util
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+try:
+    import dask
+    HAS_DASK = True
+except ModuleNotFoundError:
+    HAS_DASK = False
+
+
+def write_waveform_store(mean_waveforms,
+                         spike_count,
+                         cluster_ids,
+                         peak_channels,
+                         epoch_names,
+                         pre_samples,
+                         sample_rate,
+                         output_path,
+                         complevel=4):
+
+    """
+    Saves mean waveforms in a chunked, compressed store with one chunk per unit,
+    plus a small unit index (see unit_index_path)
+
+    The format follows the extension of output_path: '.zarr' for a Zarr
+    directory store (needs zarr), otherwise NetCDF4/HDF5 (needs netCDF4 or
+    h5netcdf); both are in the 'store' extra, and store_engine checks for
+    them. Either can be opened lazily with open_waveform_store, and one
+    unit read with load_unit_waveform without touching the other units.
+
+    Inputs:
+    -------
+    mean_waveforms : numpy.ndarray (units x epochs x 2 x channels x samples)
+        Mean (0) and std (1) waveforms in uV, as returned by extract_waveforms
+    spike_count : numpy.ndarray (units x epochs, or more columns)
+        Number of spikes averaged; extra columns are ignored
+    cluster_ids : numpy.ndarray (units x 0)
+    peak_channels : numpy.ndarray (units x 0)
+        Peak channel of each unit, -1 if unknown
+    epoch_names : list of str
+    pre_samples : int
+        Number of samples before the spike time
+    sample_rate : float
+        Hz
+    output_path : str
+    complevel : int
+        zlib compression level (NetCDF only; Zarr uses its default codec)
+
+    Outputs:
+    --------
+    index_path : str
+        Path of the unit index written next to the store
+
+    """
+
+    engine = store_engine(output_path)
+
+    num_units, num_epochs, _, num_channels, num_samples = mean_waveforms.shape
+
+    spike_count = np.asarray(spike_count)[:, :num_epochs]
+
+    ds = xr.Dataset({'waveforms': (('clusterID', 'epoch', 'mean_or_std', 'channel', 'time'),
+                                   mean_waveforms.astype('float32')),
+                     'spike_count': (('clusterID', 'epoch'), spike_count.astype('int64')),
+                     'peak_channel': (('clusterID',), np.asarray(peak_channels).astype('int64'))},
+                    coords={'clusterID': np.asarray(cluster_ids),
+                            'epoch': list(epoch_names),
+                            'mean_or_std': ['mean', 'std'],
+                            'channel': np.arange(num_channels),
+                            'time': (np.arange(num_samples) - pre_samples) / sample_rate})
+
+    chunks = (1, num_epochs, 2, num_channels, num_samples)
+
+    if is_zarr_path(output_path):
+        ds.to_zarr(output_path, mode='w', encoding={'waveforms': {'chunks': chunks}})
+    else:
+        ds.to_netcdf(output_path, engine=engine, encoding={'waveforms': {'zlib': True,
+                                                          'complevel': complevel,
+                                                          'chunksizes': chunks}})
+
+    # the last epoch is the complete session unless epochs were given
+    index = pd.DataFrame({'cluster_id': ds['clusterID'].values,
+                          'peak_channel': ds['peak_channel'].values,
+                          'spike_count': ds['spike_count'].values[:, -1]})
+
+    index_path = unit_index_path(output_path)
+    index.to_csv(index_path, index=False)
+
+    return index_path
+
+
+def write_waveform_store_from_c_waves(mean_waveform_file,
+                                      snr_file,
+                                      clus_table_file,
+                                      pre_samples,
+                                      sample_rate,
+                                      output_path):
+
+    """
+    Saves C_Waves output (mean_waveforms.npy, cluster_snr.npy and clus_Table.npy)
+    with write_waveform_store; C_Waves has no std or epochs, so the std is NaN
+    and the only epoch is the complete session
+
+    """
+
+    mean_waveforms = np.load(mean_waveform_file)
+    cluster_snr = np.load(snr_file)
+    clus_table = np.load(clus_table_file)
+
+    num_units, num_channels, num_samples = mean_waveforms.shape
+
+    waveforms = np.full((num_units, 1, 2, num_channels, num_samples), np.nan, dtype='float32')
+    waveforms[:, 0, 0, :, :] = mean_waveforms
+
+    return write_waveform_store(waveforms,
+                                cluster_snr[:, 1:2],
+                                np.arange(num_units),
+                                clus_table[:num_units, 1],
+                                ['complete_session'],
+                                pre_samples,
+                                sample_rate,
+                                output_path)
+
+
+def open_waveform_store(store_path):
+
+    """
+    Opens a store written by write_waveform_store without loading the waveforms
+
+    With dask installed the waveforms are a dask array with one chunk per
+    unit; otherwise they are read from disk on indexing.
+
+    """
+
+    chunks = {'clusterID': 1} if HAS_DASK else None
+
+    if is_zarr_path(store_path):
+        return xr.open_zarr(store_path, chunks=chunks)
+    else:
+        return xr.open_dataset(store_path, engine=store_engine(store_path), chunks=chunks, cache=False)
+
+
+def load_unit_waveform(store_path, cluster_id, epoch=None):
+
+    """
+    Reads the mean and std waveforms of one unit
+
+    Inputs:
+    -------
+    store_path : str
+    cluster_id : int
+    epoch : str
+        Epoch name; default is the last epoch (the complete session)
+
+    Outputs:
+    --------
+    waveform : numpy.ndarray (2 x channels x samples)
+        Mean (0) and std (1) in uV
+
+    """
+
+    ds = open_waveform_store(store_path)
+
+    unit = ds['waveforms'].sel(clusterID=cluster_id)
+
+    if epoch is None:
+        unit = unit.isel(epoch=-1)
+    else:
+        unit = unit.sel(epoch=epoch)
+
+    waveform = np.asarray(unit.values)
+
+    ds.close()
+
+    return waveform
+
+
+def read_unit_index(store_path):
+
+    """ Unit index (cluster_id, peak_channel, spike_count) of a waveform store """
+
+    return pd.read_csv(unit_index_path(store_path))
+
+
+def unit_index_path(store_path):
+
+    """ <store name>_unit_index.csv, next to the store """
+
+    return os.path.splitext(store_path.rstrip(os.sep))[0] + '_unit_index.csv'
+
+
+def store_engine(store_path):
+
+    """
+    xarray engine for a store at store_path: 'zarr' for '.zarr', otherwise
+    'netcdf4' or 'h5netcdf', whichever is installed
+
+    Raises ImportError if the package the format needs is missing, so this
+    can be called before any waveforms are computed. (xarray's fallback,
+    the scipy netCDF3 writer, cannot write compressed, chunked stores.)
+
+    """
+
+    if is_zarr_path(store_path):
+        candidates = ['zarr']
+    else:
+        candidates = ['netCDF4', 'h5netcdf']
+
+    for module in candidates:
+        if importlib.util.find_spec(module) is not None:
+            return module.lower()
+
+    raise ImportError('Writing ' + store_path + ' needs ' + ' or '.join(candidates) + 
+                      "; install it, e.g. with pip install ecephys_spike_sorting[store]")
+
+
+def is_zarr_path(store_path):
+
+    return os.path.splitext(store_path.rstrip(os.sep))[1] == '.zarr'
@@ -8,38 +8,42 @@ import numpy as np
 from .id_noise_templates import id_noise_templates, id_noise_templates_rf
 
 from ...common.utils import write_cluster_group_tsv, load_kilosort_data, read_cluster_group_tsv
+from ...common.instrumentation import profile_stages, stage
 
 
+@profile_stages
 def classify_noise_templates(args):
 
     print('ecephys spike sorting: noise templates module')
     
     start = time.time()
 
-    spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
-    channel_pos, cluster_ids, cluster_quality, cluster_amplitude = \
-            load_kilosort_data(args['directories']['kilosort_output_directory'], \
-                args['ephys_params']['sample_rate'], \
-                convert_to_seconds = True)
-
-    if args['noise_waveform_params']['use_random_forest']:
-        # use random forest classifier
-        cluster_ids, is_noise = id_noise_templates_rf(spike_times, spike_clusters, \
-                    cluster_ids, templates, args['noise_waveform_params'])
-    else:
-        # use heuristics to identify templates that look like noise
-        if args['noise_waveform_params']['use_preclustered']:
-            cluster_ids, is_noise = id_noise_templates(cluster_ids, templates, np.squeeze(channel_map), \
-                                args['noise_waveform_params'])
+    with stage('load'):
+        spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
+        channel_pos, cluster_ids, cluster_quality, cluster_amplitude = \
+                load_kilosort_data(args['directories']['kilosort_output_directory'], \
+                    args['ephys_params']['sample_rate'], \
+                    convert_to_seconds = True)
+
+    with stage('classify'):
+        if args['noise_waveform_params']['use_random_forest']:
+            # use random forest classifier
+            cluster_ids, is_noise = id_noise_templates_rf(spike_times, spike_clusters, \
+                        cluster_ids, templates, args['noise_waveform_params'])
         else:
-            try:
-                cluster_ids = np.unique(spike_clusters)
+            # use heuristics to identify templates that look like noise
+            if args['noise_waveform_params']['use_preclustered']:
                 cluster_ids, is_noise = id_noise_templates(cluster_ids, templates, np.squeeze(channel_map), \
                                     args['noise_waveform_params'])
-            except:
-                cluster_ids = np.unique(spike_templates)
-                cluster_ids, is_noise = id_noise_templates(cluster_ids, templates, np.squeeze(channel_map), \
-                                args['noise_waveform_params'])
+            else:
+                try:
+                    cluster_ids = np.unique(spike_clusters)
+                    cluster_ids, is_noise = id_noise_templates(cluster_ids, templates, np.squeeze(channel_map), \
+                                        args['noise_waveform_params'])
+                except:
+                    cluster_ids = np.unique(spike_templates)
+                    cluster_ids, is_noise = id_noise_templates(cluster_ids, templates, np.squeeze(channel_map), \
+                                    args['noise_waveform_params'])
 
     #mapping = {False: 'good', True: 'noise'}
     #labels = [mapping[value] for value in is_noise]
@@ -62,10 +66,11 @@ def classify_noise_templates(args):
     #                        args['ephys_params']['cluster_group_file_name'])
     print(f"{sum([x=='good' for x in labels])} remaining good units")
 
-    write_cluster_group_tsv(ci_tmp, 
-                            labels, 
-                            args['directories']['kilosort_output_directory'], 
-                            args['ephys_params']['cluster_group_file_name'])
+    with stage('save'):
+        write_cluster_group_tsv(ci_tmp, 
+                                labels, 
+                                args['directories']['kilosort_output_directory'], 
+                                args['ephys_params']['cluster_group_file_name'])
     
     execution_time = time.time() - start
 
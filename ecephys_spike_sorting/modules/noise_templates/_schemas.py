@@ -48,4 +48,5 @@ class OutputSchema(DefaultSchema):
 class OutputParameters(OutputSchema): 
 
     execution_time = Float()
+    stage_profile = Dict(required=False, help='Wall time, CPU time and peak RSS (MB) for each processing stage')
     
\ No newline at end of file
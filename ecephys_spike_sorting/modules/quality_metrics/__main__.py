@@ -11,10 +11,12 @@ import pandas as pd
 from ...common.utils import load_kilosort_data, write_cluster_group_tsv, read_cluster_group_tsv
 from ...common.utils import getFileVersion
 from ...common.epoch import get_epochs_from_nwb_file
+from ...common.instrumentation import profile_stages, stage
 
-from .metrics import calculate_metrics
+from .metrics import calculate_metrics, cluster_fingerprints, find_changed_clusters
 
 
+@profile_stages
 def calculate_quality_metrics(args):
 
     print('ecephys spike sorting: quality metrics module')
@@ -35,24 +37,40 @@ def calculate_quality_metrics(args):
 
 
     try:
-        if include_pcs:
-            spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
-            channel_pos, clusterIDs, cluster_quality, cluster_amplitude, pc_features, pc_feature_ind, template_features = \
-                    load_kilosort_data(args['directories']['kilosort_output_directory'], \
-                        args['ephys_params']['sample_rate'], \
-                        use_master_clock = False,
-                        include_pcs = include_pcs)
-        else:
-            spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
-            channel_pos, clusterIDs, cluster_quality, cluster_amplitude = \
-            load_kilosort_data(args['directories']['kilosort_output_directory'], \
-                        args['ephys_params']['sample_rate'], \
-                        use_master_clock = False,
-                        include_pcs = include_pcs)
-            pc_features = []
-            pc_feature_ind = []
+        with stage('load'):
+            if include_pcs:
+                spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
+                channel_pos, clusterIDs, cluster_quality, cluster_amplitude, pc_features, pc_feature_ind, template_features = \
+                        load_kilosort_data(args['directories']['kilosort_output_directory'], \
+                            args['ephys_params']['sample_rate'], \
+                            use_master_clock = False,
+                            include_pcs = include_pcs,
+                            mmap_pcs = args['quality_metrics_params']['mmap_pcs'])
+            else:
+                spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
+                channel_pos, clusterIDs, cluster_quality, cluster_amplitude = \
+                load_kilosort_data(args['directories']['kilosort_output_directory'], \
+                            args['ephys_params']['sample_rate'], \
+                            use_master_clock = False,
+                            include_pcs = include_pcs)
+                pc_features = []
+                pc_feature_ind = []
+
+        # spike counts, index hashes and PC peak channels for each cluster are 
+        # saved next to the metrics file, so a rerun after curation only needs 
+        # to recompute PC-based metrics near the clusters that changed
+        fingerprint_file = os.path.join(pathlib.Path(output_file).parent, pathlib.Path(output_file).stem + '_fingerprint.npz')
+        
+        with stage('load_previous'):
+            previous_metrics, changed_clusters, previous_peak_channels = \
+                load_previous_metrics(output_file, fingerprint_file, spike_clusters) \
+                if include_pcs and args['quality_metrics_params']['incremental'] else (None, None, None)
                     
-        metrics = calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes, channel_map, channel_pos, templates, pc_features, pc_feature_ind, args['quality_metrics_params'])
+        metrics, peak_channels = calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes, channel_map, channel_pos, templates, pc_features, pc_feature_ind, args['quality_metrics_params'],
+                                    previous_metrics = previous_metrics, 
+                                    changed_clusters = changed_clusters, 
+                                    previous_peak_channels = previous_peak_channels,
+                                    return_peak_channels = True)
 
     except FileNotFoundError:
         
@@ -78,7 +96,14 @@ def calculate_quality_metrics(args):
 
     print("Saving data...")
    
-    metrics.to_csv(output_file, index=False )
+    with stage('save'):
+        metrics.to_csv(output_file, index=False )
+
+        if include_pcs:
+            counts, hashes = cluster_fingerprints(spike_clusters)
+            np.savez(fingerprint_file, counts = counts, hashes = hashes, 
+                     epoch_names = np.array(list(peak_channels.keys())),
+                     peak_channels = np.array(list(peak_channels.values())))
     
     execution_time = time.time() - start
     print('total time: ' + str(np.around(execution_time,2)) + ' seconds')
@@ -88,6 +113,38 @@ def calculate_quality_metrics(args):
             "quality_metrics_output_file" : output_file} # output manifest
 
 
+def load_previous_metrics(metrics_file, fingerprint_file, spike_clusters):
+
+    """ Loads metrics and cluster fingerprints saved by an earlier run
+
+    Outputs:
+    --------
+    previous_metrics : pandas.DataFrame, or None if there is no earlier run
+    changed_clusters : numpy.ndarray
+        IDs of clusters whose spikes changed since the earlier run
+    previous_peak_channels : dict
+        epoch name -> PC peak channel of each unit in the earlier run
+
+    """
+
+    if not (os.path.exists(metrics_file) and os.path.exists(fingerprint_file)):
+        print("No previous metrics found; calculating all metrics")
+        return None, None, None
+
+    previous_metrics = pd.read_csv(metrics_file)
+
+    # the epoch_name column is renamed when waveform metrics are merged in
+    previous_metrics = previous_metrics.rename(columns={'epoch_name_quality_metrics':'epoch_name'})
+
+    fingerprint = np.load(fingerprint_file)
+    changed_clusters = find_changed_clusters(fingerprint['counts'], fingerprint['hashes'], spike_clusters)
+    previous_peak_channels = dict(zip(fingerprint['epoch_names'], fingerprint['peak_channels']))
+
+    print(repr(changed_clusters.size) + " clusters changed since " + metrics_file)
+
+    return previous_metrics, changed_clusters, previous_peak_channels
+
+
 def main():
 
     from ._schemas import InputParameters, OutputParameters
@@ -13,10 +13,15 @@ class QualityMetricsParams(DefaultSchema):
     max_spikes_for_nn = Int(required=False, default=10000, help='Further subsampling for NearestNeighbor calculation')
     n_neighbors = Int(required=False, default=4, help='Number of neighbors to use for NearestNeighbor calculation')
     n_silhouette = Int(required=False, default=10000, help='Number of spikes to use for calculating silhouette score')
+    silhouette_seed = Int(required=False, allow_none=True, default=None, help='Seed for sampling spikes for the silhouette score; if not set, uses the global numpy random state')
 
     drift_metrics_min_spikes_per_interval = Int(required=False, default=10, help='Minimum number of spikes for computing depth')
     drift_metrics_interval_s = Float(required=False, default=100, help='Interval length is seconds for computing spike depth')
     include_pcs = Boolean(required=False, default=True, help='Set to false if features were not saved with Phy output')
+    n_jobs = Int(required=False, default=1, help='Number of worker processes for PC-based metrics; -1 uses all cores')
+    parallel_backend = String(required=False, default='loky', help='joblib backend for PC-based metrics: loky, multiprocessing or threading')
+    mmap_pcs = Boolean(required=False, default=False, help='Open pc_features and template_features as read-only memory maps instead of loading them into RAM')
+    incremental = Boolean(required=False, default=False, help='Only recompute PC-based metrics for clusters whose spikes changed since the previous metrics file, and their neighbors')
 
 class InputParameters(ArgSchema):
     
@@ -36,4 +41,5 @@ class OutputParameters(OutputSchema):
 
     execution_time = Float()
     quality_metrics_output_file = String()
+    stage_profile = Dict(required=False, help='Wall time, CPU time and peak RSS (MB) for each processing stage')
     
\ No newline at end of file
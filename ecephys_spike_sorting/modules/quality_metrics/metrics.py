@@ -7,18 +7,29 @@ import warnings
 
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis as LDA
 from sklearn.neighbors import NearestNeighbors
-from sklearn.metrics import silhouette_score
+
+from joblib import Parallel, delayed, effective_n_jobs
 
 from scipy.spatial.distance import cdist
 from scipy.stats import chi2
 from scipy.ndimage.filters import gaussian_filter1d
 from scipy import special
 
+try:
+    import numba
+    HAS_NUMBA = True
+except ModuleNotFoundError:
+    HAS_NUMBA = False
+
 from ...common.epoch import Epoch
 from ...common.utils import printProgressBar, get_spike_depths
+from ...common.spike_index import SpikeIndex
+from ...common.unit_neighbors import UnitNeighborIndex
+from ...common.instrumentation import profiled
 
 
-def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes, channel_map, channel_pos, templates, pc_features, pc_feature_ind, params, epochs = None):
+def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes, channel_map, channel_pos, templates, pc_features, pc_feature_ind, params, epochs = None,
+                      previous_metrics = None, changed_clusters = None, previous_peak_channels = None, return_peak_channels = False):
 
     """ Calculate metrics for all units on one probe
 
@@ -40,6 +51,7 @@ def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes,
         Templates to which the spikes are assigned
     pc_features : numpy.ndarray (num_spikes x num_pcs x num_channels)
         Pre-computed PCs for blocks of channels around each spike
+        (can be a read-only numpy.memmap; only the rows needed are read)
     pc_feature_ind : numpy.ndarray (num_units x num_channels)
         Channel indices of PCs for each unit
     params : dict of parameters
@@ -47,6 +59,16 @@ def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes,
         'tbin_sec' : time bin for ccg for contam_rate
     epochs : list of Epoch objects
         contains information on Epoch start and stop times
+    previous_metrics : pandas.DataFrame (optional)
+        metrics from an earlier run on the same spikes; if given, PC-based 
+        metrics (except silhouette score) are only recomputed for 
+        changed_clusters and the units near them, and copied for all others
+    changed_clusters : numpy.ndarray (optional)
+        IDs of clusters whose spikes changed since previous_metrics (see find_changed_clusters)
+    previous_peak_channels : dict (optional)
+        epoch name -> PC peak channel of each unit in the earlier run (-1 if absent)
+    return_peak_channels : bool (optional)
+        also return the PC peak channel of each unit, as a dict by epoch name
 
     
     Outputs:
@@ -83,72 +105,118 @@ def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes,
     
     total_epochs = len(epochs)
 
+    epoch_peak_channels = {}
+
     for epoch in epochs:
 
         in_epoch = (spike_times > epoch.start_time) * (spike_times < epoch.end_time)
+        
+        # rows of pc_features for the spikes in this epoch; pc_features
+        # itself is never copied, so it can stay memory-mapped
+        epoch_rows = np.where(in_epoch)[0]
+
+        # group spikes by cluster once; shared by all of the per-cluster loops
+        spike_index = SpikeIndex(spike_clusters[in_epoch], total_units)
 
         print("Calculating isi violations")
-        isi_viol, num_viol = calculate_isi_violations(spike_times[in_epoch], spike_clusters[in_epoch], total_units, params['isi_threshold'], params['min_isi'])
+        isi_viol, num_viol = calculate_isi_violations(spike_times[in_epoch], spike_clusters[in_epoch], total_units, params['isi_threshold'], params['min_isi'], spike_index)
         
         print("Calculating contamination rate")
-        contam_rate = calculate_contam_rate(spike_times[in_epoch], spike_clusters[in_epoch], total_units, params['tbin_sec'], params['isi_threshold'])
+        contam_rate = calculate_contam_rate(spike_times[in_epoch], spike_clusters[in_epoch], total_units, params['tbin_sec'], params['isi_threshold'], spike_index)
 
         print("Calculating presence ratio")
-        presence_ratio = calculate_presence_ratio(spike_times[in_epoch], spike_clusters[in_epoch], total_units)
+        presence_ratio = calculate_presence_ratio(spike_times[in_epoch], spike_clusters[in_epoch], total_units, spike_index)
 
         print("Calculating firing rate")
-        firing_rate = calculate_firing_rate(spike_times[in_epoch], spike_clusters[in_epoch], total_units)
+        firing_rate = calculate_firing_rate(spike_times[in_epoch], spike_clusters[in_epoch], total_units, spike_index)
         
         print("Calculating amplitude cutoff")
-        amplitude_cutoff = calculate_amplitude_cutoff(spike_clusters[in_epoch], amplitudes[in_epoch], total_units)
+        amplitude_cutoff = calculate_amplitude_cutoff(spike_clusters[in_epoch], amplitudes[in_epoch], total_units, spike_index)
         
         if include_pcs:
             
             # determine template this is the best match for each cluster id
             # initialize template ids
             template_ids = template_ids + total_units + 10  # unassinged template_ids out of range
-            curr_spike_clusters = spike_clusters[in_epoch]
             curr_spike_templates = spike_templates[in_epoch]
-            curr_cluster_ids = np.unique(curr_spike_clusters)
+            curr_cluster_ids = spike_index.cluster_ids
             for cid in curr_cluster_ids:
-                cluster_templates = curr_spike_templates[np.where(curr_spike_clusters==cid)]
+                cluster_templates = curr_spike_templates[spike_index.indices(cid)]
                 template_ids[cid] = np.argmax(np.bincount(cluster_templates)) 
 
+            peak_channels = calculate_pc_peak_channels(spike_clusters[in_epoch], total_units, curr_cluster_ids, template_ids, 
+                                                       pc_features, pc_feature_ind, spike_index, epoch_rows)
+
+            epoch_peak_channels[epoch.name] = np.zeros((total_units,), dtype = 'int64') - 1
+            epoch_peak_channels[epoch.name][curr_cluster_ids] = peak_channels[curr_cluster_ids]
+
+            units_to_compute = curr_cluster_ids
+            
+            if previous_metrics is not None:
+                previous = previous_metrics[previous_metrics['epoch_name'] == epoch.name].set_index('cluster_id')
+                units_to_compute = find_units_to_update(curr_cluster_ids, 
+                                                        changed_clusters, 
+                                                        epoch_peak_channels[epoch.name], 
+                                                        previous_peak_channels.get(epoch.name) if previous_peak_channels is not None else None, 
+                                                        previous.index.values,
+                                                        channel_pos, 
+                                                        params['max_radius_um'])
+                print('Recomputing PC-based metrics for ' + repr(len(units_to_compute)) + ' of ' + repr(len(curr_cluster_ids)) + ' units')
+
             print("Calculating PC-based metrics")
             isolation_distance, l_ratio, d_prime, nn_hit_rate, nn_miss_rate = calculate_pc_metrics(spike_clusters[in_epoch],
                                                                                                 spike_templates[in_epoch],
                                                                                                 total_units,
                                                                                                 curr_cluster_ids,
                                                                                                 template_ids,
-                                                                                                pc_features[in_epoch,:,:],
+                                                                                                pc_features,
                                                                                                 pc_feature_ind,
                                                                                                 channel_pos,
                                                                                                 params['max_radius_um'],
                                                                                                 params['max_spikes_for_unit'],
                                                                                                 params['max_spikes_for_nn'],
-                                                                                                params['n_neighbors'])
+                                                                                                params['n_neighbors'],
+                                                                                                spike_index,
+                                                                                                params['n_jobs'],
+                                                                                                params['parallel_backend'],
+                                                                                                epoch_rows,
+                                                                                                peak_channels,
+                                                                                                units_to_compute)
+
+            if previous_metrics is not None:
+                # copy metrics for the units that were not recomputed
+                reused = np.setdiff1d(curr_cluster_ids, units_to_compute)
+                isolation_distance[reused] = previous.loc[reused, 'isolation_distance'].values
+                l_ratio[reused] = previous.loc[reused, 'l_ratio'].values
+                d_prime[reused] = previous.loc[reused, 'd_prime'].values
+                nn_hit_rate[reused] = previous.loc[reused, 'nn_hit_rate'].values
+                nn_miss_rate[reused] = previous.loc[reused, 'nn_miss_rate'].values
   
             print("Calculating silhouette score")
             nSpikes = spike_times[in_epoch].size
             the_silhouette_score = calculate_silhouette_score(spike_clusters[in_epoch], 
                                                        spike_templates[in_epoch],
                                                        total_units,                                                      
-                                                       pc_features[in_epoch,:,:],
+                                                       pc_features,
                                                        pc_feature_ind,
-                                                       min(nSpikes, params['n_silhouette']))
+                                                       min(nSpikes, params['n_silhouette']),
+                                                       epoch_rows,
+                                                       params['silhouette_seed'])
 
 
             print("Calculating drift metrics")
             max_drift, cumulative_drift = calculate_drift_metrics(spike_times[in_epoch],
                                                        spike_clusters[in_epoch], 
-                                                       spike_templates,
+                                                       spike_templates[in_epoch],
                                                        template_ids,
                                                        total_units,
-                                                       pc_features[in_epoch,:,:],
+                                                       pc_features,
                                                        pc_feature_ind,
                                                        channel_pos,
                                                        params['drift_metrics_interval_s'],
-                                                       params['drift_metrics_min_spikes_per_interval'])
+                                                       params['drift_metrics_min_spikes_per_interval'],
+                                                       spike_index,
+                                                       epoch_rows)
         else:
             # fill in empty arrays for dataframe            
             isolation_distance = np.zeros((total_units,))
@@ -183,78 +251,259 @@ def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes,
                                 ('epoch_name' , epoch_name),
                                 )))))
 
+    if return_peak_channels:
+        return metrics, epoch_peak_channels
+
     return metrics 
 
+def cluster_fingerprints(spike_clusters, total_units = None):
+
+    """ Summarizes the spikes assigned to each cluster, to detect curation changes
+
+    The hash is the sum (mod 2**64) of a mixed hash of each spike's index, so 
+    it depends only on which spikes belong to the cluster, not their order
+
+    Inputs:
+    -------
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike
+    total_units : Int (optional)
+        Size of the cluster ID range
+
+    Outputs:
+    --------
+    counts : numpy.ndarray (total_units x 0)
+        Number of spikes in each cluster
+    hashes : numpy.ndarray (total_units x 0, uint64)
+        Hash of the spike indices in each cluster
+
+    """
+
+    spike_index = SpikeIndex(spike_clusters, total_units)
+
+    # splitmix64 finalizer of (index + 1); uint64 arithmetic wraps around
+    spike_hash = np.arange(1, spike_index.num_spikes + 1, dtype = 'uint64') * np.uint64(0x9E3779B97F4A7C15)
+    spike_hash ^= spike_hash >> np.uint64(30)
+    spike_hash *= np.uint64(0xBF58476D1CE4E5B9)
+    spike_hash ^= spike_hash >> np.uint64(27)
+    spike_hash *= np.uint64(0x94D049BB133111EB)
+    spike_hash ^= spike_hash >> np.uint64(31)
+
+    hashes = np.zeros((spike_index.total_units,), dtype = 'uint64')
+    cluster_ids = spike_index.cluster_ids
+    if cluster_ids.size > 0:
+        hashes[cluster_ids] = np.add.reduceat(spike_hash[spike_index.order], spike_index.offsets[cluster_ids])
+
+    return spike_index.counts, hashes
+
+
+def find_changed_clusters(previous_counts, previous_hashes, spike_clusters):
+
+    """ IDs of clusters whose spikes differ from an earlier cluster_fingerprints """
+
+    total_units = max(np.max(spike_clusters) + 1, previous_counts.size)
+    counts, hashes = cluster_fingerprints(spike_clusters, total_units)
+
+    old_counts = np.zeros((total_units,), dtype = counts.dtype)
+    old_counts[:previous_counts.size] = previous_counts
+    old_hashes = np.zeros((total_units,), dtype = 'uint64')
+    old_hashes[:previous_hashes.size] = previous_hashes
+
+    return np.where((counts != old_counts) | (hashes != old_hashes))[0]
+
+
+def find_units_to_update(cluster_ids, changed_clusters, peak_channels, previous_peak_channels, previous_ids, channel_pos, max_radius_um):
+
+    """ Units whose PC-based metrics can be affected by the changed clusters
+
+    A unit is compared with the units whose peak channels are within 
+    max_radius_um of its own, so it is recomputed if it changed, if a changed
+    cluster is (or was) that close, or if it has no earlier metrics
+
+    Inputs:
+    -------
+    cluster_ids : numpy.ndarray
+        IDs of the units in this epoch
+    changed_clusters : numpy.ndarray
+        IDs of the clusters whose spikes changed
+    peak_channels : numpy.ndarray (total_units x 0)
+        PC peak channel of each unit (-1 if absent)
+    previous_peak_channels : numpy.ndarray (optional)
+        PC peak channel of each unit in the earlier run (-1 if absent); if None,
+        all units are recomputed
+    previous_ids : numpy.ndarray
+        IDs of the units with earlier metrics
+    channel_pos : numpy.ndarray (num_channels x 2)
+        Channel positions in um
+    max_radius_um : float
+        Radius used to select neighboring units
+
+    Output:
+    -------
+    units_to_compute : numpy.ndarray
+
+    """
+
+    if previous_peak_channels is None:
+        return cluster_ids
+
+    changed_peaks = []
+
+    for peaks in (peak_channels, previous_peak_channels):
+        changed = changed_clusters[changed_clusters < peaks.size]
+        changed_peaks.append(peaks[changed][peaks[changed] >= 0])
+
+    changed_peaks = np.unique(np.concatenate(changed_peaks))
+
+    unit_pos = channel_pos[peak_channels[cluster_ids],:]
+    near_changed = np.zeros((cluster_ids.size,), dtype = 'bool')
+
+    if changed_peaks.size > 0:
+        near_changed = np.min(cdist(unit_pos, channel_pos[changed_peaks,:]), 1) < max_radius_um
+
+    update = near_changed | np.isin(cluster_ids, changed_clusters) | ~np.isin(cluster_ids, previous_ids)
+
+    return cluster_ids[update]
+
+
 # ===============================================================
 
 # HELPER FUNCTIONS TO LOOP THROUGH CLUSTERS:
 
 # ===============================================================
 
-def calculate_isi_violations(spike_times, spike_clusters, total_units, isi_threshold, min_isi):
+@profiled('isi')
+def calculate_isi_violations(spike_times, spike_clusters, total_units, isi_threshold, min_isi, spike_index = None):
 
-    cluster_ids = np.unique(spike_clusters)
+    # batched version of isi_violations, computed for all clusters at once
+
+    if spike_index is None:
+        spike_index = SpikeIndex(spike_clusters, total_units)
+
+    cluster_ids = spike_index.cluster_ids
 
     viol_rates = np.zeros((total_units,))
     
     num_viol =np.zeros((total_units,))
 
-    for idx, cluster_id in enumerate(cluster_ids):
+    min_time = np.min(spike_times)
+    max_time = np.max(spike_times)
+
+    times, labels = group_spike_times(spike_times, spike_clusters, spike_index)
+
+    # remove duplicate spikes: the later spike of any pair from the same
+    # cluster separated by <= min_isi
+    is_duplicate = np.zeros((times.size,), dtype = 'bool')
+    is_duplicate[1:] = (labels[1:] == labels[:-1]) & (np.diff(times) <= min_isi)
+    times = times[~is_duplicate]
+    labels = labels[~is_duplicate]
+
+    # flag each spike that follows a spike from the same cluster within isi_threshold
+    is_violation = np.zeros((times.size,), dtype = 'int64')
+    is_violation[1:] = (labels[1:] == labels[:-1]) & (np.diff(times) < isi_threshold)
+
+    cluster_starts = np.searchsorted(labels, cluster_ids)
+    num_violations = np.add.reduceat(is_violation, cluster_starts) if cluster_ids.size > 0 else is_violation[:0]
+    num_spikes = np.bincount(labels, minlength = total_units)[cluster_ids]
+
+    violation_time = 2*num_spikes*(isi_threshold - min_isi)
+    total_rate = num_spikes / (max_time - min_time)
 
-        printProgressBar(idx+1, len(cluster_ids))
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        c = num_violations/(violation_time*total_rate)
 
-        for_this_cluster = (spike_clusters == cluster_id)
-        viol_rates[cluster_id], num_viol[cluster_id] = isi_violations(spike_times[for_this_cluster], 
-                                                               min_time = np.min(spike_times), 
-                                                               max_time = np.max(spike_times), 
-                                                               isi_threshold=isi_threshold, 
-                                                               min_isi = min_isi)
+    # valid solution to quadratic eq. for fpRate when c < 0.25, otherwise fpRate = 1
+    fpRate = np.ones(c.shape)
+    valid = c < 0.25
+    fpRate[valid] = (1 - np.sqrt(1-4*c[valid]))/2
+
+    viol_rates[cluster_ids] = fpRate
+    num_viol[cluster_ids] = num_violations
 
     return viol_rates, num_viol
 
-def calculate_presence_ratio(spike_times, spike_clusters, total_units):
+@profiled('presence_ratio')
+def calculate_presence_ratio(spike_times, spike_clusters, total_units, spike_index = None, num_bins = 100):
 
-    cluster_ids = np.unique(spike_clusters)
+    # batched version of presence_ratio, computed for all clusters at once
 
-    ratios = np.zeros((total_units,))
+    if spike_index is None:
+        spike_index = SpikeIndex(spike_clusters, total_units)
 
-    for idx, cluster_id in enumerate(cluster_ids):
+    min_time = np.min(spike_times)
+    max_time = np.max(spike_times)
 
-        printProgressBar(idx + 1, len(cluster_ids))
+    # same bins as np.histogram in presence_ratio; the last bin includes max_time
+    bin_edges = np.linspace(min_time, max_time, num_bins)
+    time_bins = np.searchsorted(bin_edges, spike_times, side = 'right') - 1
+    time_bins = np.minimum(time_bins, num_bins - 2)
+
+    # count spikes in each (cluster, time bin)
+    num_time_bins = num_bins - 1
+    h = np.bincount(np.squeeze(spike_clusters).astype('int64') * num_time_bins + time_bins,
+                    minlength = total_units * num_time_bins)
+    h = np.reshape(h, (total_units, num_time_bins))
 
-        for_this_cluster = (spike_clusters == cluster_id)
-        ratios[cluster_id] = presence_ratio(spike_times[for_this_cluster], 
-                                                       min_time = np.min(spike_times), 
-                                                       max_time = np.max(spike_times))
+    ratios = np.sum(h > 0, 1) / num_bins
 
     return ratios
 
 
 
-def calculate_firing_rate(spike_times, spike_clusters, total_units):
+@profiled('firing_rate')
+def calculate_firing_rate(spike_times, spike_clusters, total_units, spike_index = None):
 
-    cluster_ids = np.unique(spike_clusters)
+    # batched version of firing_rate, computed for all clusters at once
 
-    firing_rates = np.zeros((total_units,))
+    if spike_index is None:
+        spike_index = SpikeIndex(spike_clusters, total_units)
 
     min_time = np.min(spike_times)
     max_time = np.max(spike_times)
 
-    for idx, cluster_id in enumerate(cluster_ids):
+    firing_rates = spike_index.counts / (max_time - min_time)
 
-        printProgressBar(idx + 1, len(cluster_ids))
+    return firing_rates
 
-        for_this_cluster = (spike_clusters == cluster_id)
-        firing_rates[cluster_id] = firing_rate(spike_times[for_this_cluster], 
-                                        min_time = np.min(spike_times),
-                                        max_time = np.max(spike_times))
 
-    return firing_rates
+def group_spike_times(spike_times, spike_clusters, spike_index):
 
+    """ Sort spike times by cluster, and by time within each cluster
 
-def calculate_amplitude_cutoff(spike_clusters, amplitudes, total_units):
+    Inputs:
+    -------
+    spike_times : numpy.ndarray (num_spikes x 0)
+        Spike times in seconds
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike time
+    spike_index : SpikeIndex
+        Spikes grouped by cluster
+
+    Outputs:
+    --------
+    times : numpy.ndarray (num_spikes x 0)
+        Spike times, grouped by cluster
+    labels : numpy.ndarray (num_spikes x 0)
+        Cluster ID for each entry in times (non-decreasing)
 
-    cluster_ids = np.unique(spike_clusters)
+    """
+
+    if np.all(np.diff(spike_times) >= 0):
+        # grouping is stable, so spikes stay in time order within each cluster
+        order = spike_index.order
+    else:
+        order = np.lexsort((spike_times, np.squeeze(spike_clusters)))
+
+    return spike_times[order], spike_index.sorted_labels()
+
+
+@profiled('amplitude_cutoff')
+def calculate_amplitude_cutoff(spike_clusters, amplitudes, total_units, spike_index = None):
+
+    if spike_index is None:
+        spike_index = SpikeIndex(spike_clusters, total_units)
+
+    cluster_ids = spike_index.cluster_ids
 
     amplitude_cutoffs = np.zeros((total_units,))
 
@@ -263,15 +512,19 @@ def calculate_amplitude_cutoff(spike_clusters, amplitudes, total_units):
         printProgressBar(idx + 1, len(cluster_ids))
 
 
-        for_this_cluster = (spike_clusters == cluster_id)
+        for_this_cluster = spike_index.indices(cluster_id)
         amplitude_cutoffs[cluster_id] = amplitude_cutoff(amplitudes[for_this_cluster])
 
     return amplitude_cutoffs
 
 
-def calculate_contam_rate(spike_times, spike_clusters, total_units, tbin_sec, refPer_sec):
+@profiled('contam')
+def calculate_contam_rate(spike_times, spike_clusters, total_units, tbin_sec, refPer_sec, spike_index = None):
+
+    if spike_index is None:
+        spike_index = SpikeIndex(spike_clusters, total_units)
 
-    cluster_ids = np.unique(spike_clusters)
+    cluster_ids = spike_index.cluster_ids
 
     contam_rate = np.ones((total_units,))
 
@@ -279,7 +532,7 @@ def calculate_contam_rate(spike_times, spike_clusters, total_units, tbin_sec, re
 
         printProgressBar(idx + 1, len(cluster_ids))
 
-        curr_st_sec = spike_times[spike_clusters == cluster_id]
+        curr_st_sec = spike_times[spike_index.indices(cluster_id)]
         
         if len(curr_st_sec) > 10: 
             contam_rate[cluster_id] = contamination_rate(curr_st_sec, tbin_sec, refPer_sec)           
@@ -287,6 +540,7 @@ def calculate_contam_rate(spike_times, spike_clusters, total_units, tbin_sec, re
     return contam_rate
 
 
+@profiled('pc_metrics')
 def calculate_pc_metrics(spike_clusters,
                          spike_templates,
                          total_units,
@@ -298,39 +552,169 @@ def calculate_pc_metrics(spike_clusters,
                          max_radius_um, 
                          max_spikes_for_cluster, 
                          max_spikes_for_nn, 
-                         n_neighbors):
+                         n_neighbors,
+                         spike_index = None,
+                         n_jobs = 1,
+                         parallel_backend = 'loky',
+                         pc_feature_rows = None,
+                         peak_channels = None,
+                         units_to_compute = None):
 
 # OLDER calculatioon assuming linear array and using a number of channels instead of max_radius
 #    assert(num_channels_to_compare % 2 == 1)
 #    half_spread = int((num_channels_to_compare - 1) / 2)
 
 
-    peak_channels = np.zeros((total_units,), dtype='uint16')
     isolation_distances = np.zeros((total_units,))
     l_ratios = np.zeros((total_units,))
     d_primes = np.zeros((total_units,))
     nn_hit_rates = np.zeros((total_units,))
     nn_miss_rates = np.zeros((total_units,))
     
+    if spike_index is None:
+        spike_index = SpikeIndex(spike_clusters, total_units)
 
-# pc_feature_ind is NOT updated by phy during manual clustering
+    # spike i is in row pc_feature_rows[i] of pc_features
+    if pc_feature_rows is None:
+        pc_feature_rows = np.arange(spike_clusters.size)
+
+    # peak channels are needed for all clusters, because they define the 
+    # neighbors of each unit, even if only some units are computed
+    if peak_channels is None:
+        peak_channels = calculate_pc_peak_channels(spike_clusters, total_units, cluster_ids, template_ids, 
+                                                   pc_features, pc_feature_ind, spike_index, pc_feature_rows)
+
+    # each unit draws its spike subsamples from its own seed, indexed by cluster id, so results
+    # do not depend on the number of workers, the order units are processed, or which units are recomputed
+    unit_seeds = np.random.randint(0, 2**31 - 1, size = total_units)
+
+    if units_to_compute is not None:
+        cluster_ids = np.asarray(units_to_compute)
+
+    unit_seeds = unit_seeds[np.asarray(cluster_ids, dtype = 'int64')]
+
+    # units are compared with the units whose peak channels are within max_radius_um
+    neighbor_index = UnitNeighborIndex.from_peak_channels(peak_channels, channel_pos)
+
+    unit_args = (spike_clusters, spike_templates, template_ids, peak_channels, pc_features, pc_feature_ind, 
+                 channel_pos, max_radius_um, max_spikes_for_cluster, max_spikes_for_nn, n_neighbors, spike_index, 
+                 pc_feature_rows, neighbor_index)
+
+    if n_jobs == 1:
+
+        results = pc_metrics_for_units(cluster_ids, unit_seeds, *unit_args, show_progress = True)
+
+    else:
+
+        # arrays larger than max_nbytes (pc_features in particular) are shared 
+        # with the workers as read-only memory maps rather than pickled for each task
+        num_workers = effective_n_jobs(n_jobs)
+        chunks = np.array_split(np.arange(len(cluster_ids)), min(len(cluster_ids), 4 * num_workers))
+        chunks = [chunk for chunk in chunks if chunk.size > 0]
+
+        print('Dispatching ' + repr(len(cluster_ids)) + ' units to ' + repr(num_workers) + ' workers')
+
+        chunk_results = Parallel(n_jobs = n_jobs, backend = parallel_backend, max_nbytes = '1M', mmap_mode = 'r')(
+                            delayed(pc_metrics_for_units)(cluster_ids[chunk], unit_seeds[chunk], *unit_args) 
+                            for chunk in chunks)
+
+        # Parallel returns results in the order tasks were submitted
+        results = np.concatenate(chunk_results, 0) if len(chunk_results) > 0 else np.zeros((0, 5))
 
+    cluster_ids = np.asarray(cluster_ids, dtype = 'int64')
+
+    isolation_distances[cluster_ids] = results[:,0]
+    l_ratios[cluster_ids] = results[:,1]
+    d_primes[cluster_ids] = results[:,2]
+    nn_hit_rates[cluster_ids] = results[:,3]
+    nn_miss_rates[cluster_ids] = results[:,4]
+
+    return isolation_distances, l_ratios, d_primes, nn_hit_rates, nn_miss_rates 
+
+
+@profiled('pc_peak_channels')
+def calculate_pc_peak_channels(spike_clusters,
+                               total_units,
+                               cluster_ids,
+                               template_ids,
+                               pc_features,
+                               pc_feature_ind,
+                               spike_index = None,
+                               pc_feature_rows = None):
+
+    """ Peak channel of each cluster, from the mean of the first PC of its spikes
+
+    Output:
+    -------
+    peak_channels : numpy.ndarray (total_units x 0)
+        Channel index for each unit (zero for units not in cluster_ids)
+
+    """
+
+    peak_channels = np.zeros((total_units,), dtype='uint16')
+
+    if spike_index is None:
+        spike_index = SpikeIndex(spike_clusters, total_units)
+
+    if pc_feature_rows is None:
+        pc_feature_rows = np.arange(spike_clusters.size)
+
+# pc_feature_ind is NOT updated by phy during manual clustering
     for idx, cluster_id in enumerate(cluster_ids):
             
         # individual pcs are stored for each spike, independent of cluster id
-        for_unit = np.squeeze(spike_clusters == cluster_id)
-        pc_max = np.argmax(np.mean(pc_features[for_unit, 0, :],0))
+        for_unit = spike_index.indices(cluster_id)
+        pc_max = np.argmax(np.mean(pc_features[pc_feature_rows[for_unit], 0, :],0))
         
         # pc_feature_ind are stored according to template, using the 
         # most common template for spikes in this cluster in this epoch
         peak_channels[cluster_id] = pc_feature_ind[template_ids[cluster_id], pc_max]
 
-    for idx, cluster_id in enumerate(cluster_ids):
+    return peak_channels
 
-        
-        printProgressBar(idx + 1, len(cluster_ids))
 
-            
+def pc_metrics_for_units(unit_ids,
+                         unit_seeds,
+                         spike_clusters,
+                         spike_templates,
+                         template_ids,
+                         peak_channels,
+                         pc_features,
+                         pc_feature_ind,
+                         channel_pos,
+                         max_radius_um,
+                         max_spikes_for_cluster,
+                         max_spikes_for_nn,
+                         n_neighbors,
+                         spike_index,
+                         pc_feature_rows,
+                         neighbor_index = None,
+                         show_progress = False):
+
+    """ Calculate PC-based metrics for a list of units
+
+    Each unit is independent once its neighborhood PCs are gathered; this
+    function is the unit of work dispatched to each worker by calculate_pc_metrics
+
+    Outputs:
+    --------
+    results : numpy.ndarray (num_units x 5)
+        isolation_distance, l_ratio, d_prime, nn_hit_rate, nn_miss_rate for each unit
+
+    """
+
+    results = np.zeros((len(unit_ids), 5))
+
+    if neighbor_index is None:
+        neighbor_index = UnitNeighborIndex.from_peak_channels(peak_channels, channel_pos)
+
+    for idx, cluster_id in enumerate(unit_ids):
+
+        if show_progress:
+            printProgressBar(idx + 1, len(unit_ids))
+
+        random_state = np.random.RandomState(unit_seeds[idx])
+
         peak_channel = peak_channels[cluster_id]
         
         # calculate distances from all channels to peak channel
@@ -346,15 +730,14 @@ def calculate_pc_metrics(spike_clusters,
 #            if peak_channel + half_spread > np.max(pc_feature_ind) \
 #            else half_spread
 
-        # which templates have pcs on the peak channel of the current unit?
-        # channel index -- which of the channel swithin the set for a single template -- i snot used
-        templates_for_channel, channel_index = np.unravel_index(np.where(pc_feature_ind.flatten() == peak_channel)[0], pc_feature_ind.shape)
-
-
-        # which units have these templates?       
-        units_for_channel = np.zeros((0,),dtype='uint16')
-        for j in templates_for_channel:
-            units_for_channel = np.append(units_for_channel, np.where(template_ids==j))
+        # which units have templates with pcs on the peak channel of the current unit?
+        # only units with their peak channel in range can be used, so just
+        # those are checked; they are listed by template, then unit ID
+        units_for_channel = neighbor_index.neighbors(cluster_id, max_radius_um)
+        units_for_channel = units_for_channel[units_for_channel < template_ids.size]
+        units_for_channel = units_for_channel[template_ids[units_for_channel] < pc_feature_ind.shape[0]]
+        units_for_channel = units_for_channel[np.any(pc_feature_ind[template_ids[units_for_channel]] == peak_channel, 1)]
+        units_for_channel = units_for_channel[np.argsort(template_ids[units_for_channel], kind = 'stable')]
                   
                
 # OLDER calculatioon assuming linear array        
@@ -374,20 +757,17 @@ def calculate_pc_metrics(spike_clusters,
 
             units_for_channel = np.asarray(units_for_channel[units_in_range])
                     
-    
+
 # OLDER calculatioon assuming linear array
 #           channels_to_use = np.arange(peak_channel - half_spread_down, peak_channel + half_spread_up + 1)
             
             channels_to_use = np.where(chan_dist < max_radius_um)[0]
 
-    
-            spike_counts = np.zeros(units_for_channel.shape, dtype = 'int')
-    
-            for idx2, cluster_id2 in enumerate(units_for_channel):
-                spike_counts[idx2] = np.sum(spike_clusters == cluster_id2)
+
+            spike_counts = spike_index.counts[units_for_channel].astype('int')
                 
             this_unit_idx = np.where(units_for_channel == cluster_id)[0]
-    
+
             # calculate how many spikes from this unit will be used
             if spike_counts[this_unit_idx] > max_spikes_for_cluster:
                 relative_counts = spike_counts / spike_counts[this_unit_idx] * max_spikes_for_cluster
@@ -398,7 +778,7 @@ def calculate_pc_metrics(spike_clusters,
             all_labels = np.zeros((0,), dtype = 'int')
                 
             for idx2, cluster_id2 in enumerate(units_for_channel):
-    
+
 # if any manual curation as been done, the cluster ids are no longer identical to the template ids
 # That means we can't use a universal channelmask. Rather, we have to check for each spike what
 # channels are there (recorded in pc_feature_ind) and take those that are included in 
@@ -420,9 +800,9 @@ def calculate_pc_metrics(spike_clusters,
 #                    all_labels = np.concatenate((all_labels, labels),0)
                 
                 subsample = int(relative_counts[idx2]) # how many spikes to use from this unit
-                index_mask = make_index_mask(spike_clusters, cluster_id2, min_num = 0, max_num = subsample)
+                unit_inds = subsample_unit_spikes(spike_index, cluster_id2, min_num = 0, max_num = subsample, random_state = random_state)
                 
-                pcs = get_unit_pcs(pc_features, index_mask, spike_templates, channels_to_use, pc_feature_ind)
+                pcs = get_unit_pcs(pc_features, unit_inds, spike_templates, channels_to_use, pc_feature_ind, pc_feature_rows)
                 labels = np.ones((pcs.shape[0],), dtype = 'int') * cluster_id2
 
                 all_pcs = np.concatenate((all_pcs, pcs),0)
@@ -446,81 +826,150 @@ def calculate_pc_metrics(spike_clusters,
         
         if num_pcs > 10 and pcs_for_this_unit > 5 and pcs_for_other_units > 5 :
 
-            isolation_distances[cluster_id], l_ratios[cluster_id] = mahalanobis_metrics(all_pcs, all_labels, cluster_id)
+            isolation_distance, l_ratio = mahalanobis_metrics(all_pcs, all_labels, cluster_id)
 
-            d_primes[cluster_id] = lda_metrics(all_pcs, all_labels, cluster_id)
+            d_prime = lda_metrics(all_pcs, all_labels, cluster_id)
 
-            nn_hit_rates[cluster_id], nn_miss_rates[cluster_id] = nearest_neighbors_metrics(all_pcs, all_labels, cluster_id, max_spikes_for_nn, n_neighbors)
+            nn_hit_rate, nn_miss_rate = nearest_neighbors_metrics(all_pcs, all_labels, cluster_id, max_spikes_for_nn, n_neighbors)
 
-        else:
+            results[idx,:] = [isolation_distance, l_ratio, d_prime, nn_hit_rate, nn_miss_rate]
 
-            isolation_distances[cluster_id] = np.nan
-            d_primes[cluster_id] = np.nan
-            nn_hit_rates[cluster_id] = np.nan
-            nn_miss_rates[cluster_id] = np.nan
+        else:
 
+            # l_ratio is left at zero
+            results[idx,:] = [np.nan, 0, np.nan, np.nan, np.nan]
 
-    return isolation_distances, l_ratios, d_primes, nn_hit_rates, nn_miss_rates 
+    return results
 
 
+@profiled('silhouette')
 def calculate_silhouette_score(spike_clusters,
                                  spike_templates,
                                  total_units,                                
                                  pc_features, 
                                  pc_feature_ind,
-                                 total_spikes):
+                                 total_spikes,
+                                 pc_feature_rows = None,
+                                 seed = None,
+                                 max_block_size = 2**22):
     
-    # total_spikes = number of spikes to sample, given in the metrics params
+    """ Minimum silhouette score of each unit against every other unit
+
+    Distances between the sampled spikes are computed once, a block of rows
+    at a time, and summed per cluster; the silhouette score for each pair of
+    clusters is then derived from these sums (same values as
+    sklearn.metrics.silhouette_score on the spikes of the two clusters)
+
+    Inputs:
+    -------
+    spike_clusters : numpy.ndarray (num_spikes x 0)
+        Cluster IDs for each spike
+    spike_templates : numpy.ndarray (num_spikes x 0)
+        Template IDs for each spike
+    total_units : Int
+        Number of units
+    pc_features : numpy.ndarray (num_spikes x num_pcs x num_channels)
+        Pre-computed PCs for blocks of channels around each spike
+    pc_feature_ind : numpy.ndarray (num_units x num_channels)
+        Channel indices of PCs for each unit
+    total_spikes : Int
+        Number of spikes to sample
+    pc_feature_rows : numpy.ndarray (optional)
+        Row of pc_features for each spike
+    seed : Int (optional)
+        Seed for sampling spikes; defaults to the global numpy random state
+    max_block_size : Int (optional)
+        Maximum number of distances held in memory at once
+
+    Output:
+    -------
+    silhouette_score : numpy.ndarray (total_units x 0)
+
+    """
+
+    if pc_feature_rows is None:
+        pc_feature_rows = np.arange(spike_clusters.size)
+
+    permutation = np.random.permutation if seed is None else np.random.RandomState(seed).permutation
+
+    # sampled spikes, grouped by cluster
+    random_spike_inds = np.sort(permutation(spike_clusters.size)[:total_spikes])
+    random_spike_inds = random_spike_inds[np.argsort(spike_clusters[random_spike_inds], kind = 'stable')]
+    total_spikes = random_spike_inds.size
 
-    random_spike_inds = np.random.permutation(spike_clusters.size)
-    random_spike_inds = random_spike_inds[:total_spikes]
     num_pc_features = pc_features.shape[1]
+    max_channel = np.max(pc_feature_ind)
 
     # initialize array to hold pcs: number of spikes X number of channeles x number of pc features
-    all_pcs = np.zeros((total_spikes, np.max(pc_feature_ind) * num_pc_features + 1))
-
-    for idx, i in enumerate(random_spike_inds):
-        
-        # unit_id = spike_clusters[i]
-        
-        # look up channel using the template id for this spike
-        template_id = spike_templates[i]       
-        channels = pc_feature_ind[template_id,:]
-        
-        # fill pcs into the correct channels for this spike
-        for j in range(0,num_pc_features):
-            all_pcs[idx, channels + np.max(pc_feature_ind) * j] = pc_features[i,j,:]
+    all_pcs = np.zeros((total_spikes, max_channel * num_pc_features + 1))
+
+    # fill pcs into the correct channels for each spike, looking up channels
+    # using the template id for the spike
+    channels = pc_feature_ind[spike_templates[random_spike_inds],:]
+    columns = channels[:,np.newaxis,:] + max_channel * np.arange(num_pc_features)[np.newaxis,:,np.newaxis]
+    rows = pc_feature_rows[random_spike_inds]
+    read_order = np.argsort(rows, kind = 'stable')
+    spike_pcs = np.empty((total_spikes,) + pc_features.shape[1:], dtype = pc_features.dtype)
+    spike_pcs[read_order] = pc_features[rows[read_order]]
+    all_pcs[np.arange(total_spikes)[:,np.newaxis,np.newaxis], columns] = spike_pcs
 
     cluster_labels = spike_clusters[random_spike_inds]
+    cluster_ids, cluster_starts, cluster_counts = np.unique(cluster_labels, return_index = True, return_counts = True)
 
-    cluster_ids = np.unique(cluster_labels)
+    # summed distance from each spike to all spikes of each cluster
+    distance_sums = np.zeros((total_spikes, cluster_ids.size))
+    block_size = max(1, max_block_size // max(total_spikes, 1))
 
-    SS = np.empty((total_units, total_units))
-    SS[:] = np.nan
+    # squared euclidean distances as |x|^2 + |y|^2 - 2 x.y, so that the
+    # bulk of the work is a matrix product
+    squared_norms = np.sum(all_pcs ** 2, 1)
 
-    for idx1, i in enumerate(cluster_ids):
+    for start in range(0, total_spikes, block_size):
 
-        printProgressBar(idx1+1, len(cluster_ids))
-        
-        for idx2, j in enumerate(cluster_ids):
-            
-            if j > i:
-                # positions of cluster labels = i or j
-                inds = np.in1d(cluster_labels, np.array([i,j]))
-                X = all_pcs[inds,:]
-                labels = cluster_labels[inds]
-                
-                if len(labels) > 2:
-                    SS[i,j] = silhouette_score(X, labels)
+        printProgressBar(min(start + block_size, total_spikes), total_spikes)
+
+        block = slice(start, start + block_size)
+        distances = np.dot(all_pcs[block], all_pcs.T)
+        distances *= -2
+        distances += squared_norms[block,np.newaxis]
+        distances += squared_norms[np.newaxis,:]
+        np.maximum(distances, 0, out = distances)
+        np.sqrt(distances, out = distances)
+
+        distance_sums[block] = np.add.reduceat(distances, cluster_starts, axis = 1)
+
+    # silhouette of each spike, given its own cluster and one other cluster
+    own_cluster = np.repeat(np.arange(cluster_ids.size), cluster_counts)
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        intra = distance_sums[np.arange(total_spikes), own_cluster] / (cluster_counts[own_cluster] - 1)
+        inter = distance_sums / cluster_counts
+        spike_silhouettes = (inter - intra[:,np.newaxis]) / np.maximum(intra[:,np.newaxis], inter)
+
+    # spikes in single-spike clusters have a silhouette of zero
+    spike_silhouettes = np.nan_to_num(spike_silhouettes)
+
+    # pair_sums[i,j] = summed silhouette of cluster i spikes against cluster j
+    pair_sums = np.add.reduceat(spike_silhouettes, cluster_starts, axis = 0)
+    pair_counts = cluster_counts[:,np.newaxis] + cluster_counts[np.newaxis,:]
+    pair_scores = (pair_sums + pair_sums.T) / pair_counts
+
+    valid = np.triu(pair_counts > 2, 1)
+    i, j = np.where(valid)
+
+    SS = np.empty((total_units, total_units))
+    SS[:] = np.nan
+    SS[cluster_ids[i], cluster_ids[j]] = pair_scores[i, j]
 
     with warnings.catch_warnings():
       warnings.simplefilter("ignore")
       a = np.nanmin(SS, 0)
       b = np.nanmin(SS, 1)
 
-    return np.array([np.nanmin([a,b]) for a, b in zip(a,b)])
+    return np.fmin(a, b)
 
 
+@profiled('drift')
 def calculate_drift_metrics(spike_times,
                             spike_clusters,
                             spike_templates,
@@ -530,7 +979,26 @@ def calculate_drift_metrics(spike_times,
                             pc_feature_ind,
                             channel_pos,
                             interval_length,
-                            min_spikes_per_interval):
+                            min_spikes_per_interval,
+                            spike_index = None,
+                            pc_feature_rows = None,
+                            return_depth_matrix = False):
+
+    """ Maximum and cumulative drift of the median spike depth of each unit
+
+    Each spike is assigned to an interval with np.digitize, and the median 
+    depth of every (cluster, interval) group is found in a single pass over 
+    the spikes sorted by cluster, interval and depth
+
+    Additional outputs if return_depth_matrix is True:
+    -------
+    median_depths : numpy.ndarray (total_units x num_intervals)
+        Median depth of each unit in each interval (NaN if fewer than 
+        min_spikes_per_interval spikes)
+    interval_starts : numpy.ndarray (num_intervals x 0)
+        Start time of each interval
+
+    """
 
     max_drift = np.zeros((total_units,))
     cumulative_drift = np.zeros((total_units,))
@@ -558,9 +1026,16 @@ def calculate_drift_metrics(spike_times,
     m_spike_clusters = spike_clusters[match_maj]
     m_spike_times = spike_times[match_maj]
     
+    if spike_index is None:
+        spike_index = SpikeIndex(spike_clusters, total_units)
+    m_spike_index = spike_index.subset(match_maj)
+    
     # same for pc_features, but we only need the first pc for each
     # this operation makes a copy of pc_features so original is not altered
-    m_pc_features_sq = np.squeeze(pc_features[match_maj,0,:]);
+    # spike i is in row pc_feature_rows[i] of pc_features
+    if pc_feature_rows is None:
+        pc_feature_rows = np.arange(spike_clusters.size)
+    m_pc_features_sq = np.squeeze(pc_features[pc_feature_rows[match_maj],0,:]);
     # set negative pc_features to zero before taking square
     m_pc_features_sq[m_pc_features_sq < 0] = 0
     # elementwise square
@@ -576,31 +1051,36 @@ def calculate_drift_metrics(spike_times,
     interval_starts = np.arange(np.min(spike_times), np.max(spike_times), interval_length)
     interval_ends = interval_starts + interval_length
 
-    cluster_ids = np.unique(m_spike_clusters)
+    # interval for each spike; spikes on an interval boundary are not counted
+    interval = np.digitize(m_spike_times, interval_starts) - 1
+    in_interval = interval >= 0
+    in_interval[in_interval] = (m_spike_times[in_interval] > interval_starts[interval[in_interval]]) * \
+                               (m_spike_times[in_interval] < interval_ends[interval[in_interval]])
 
-    for idx, cluster_id in enumerate(cluster_ids):
+    # group spikes by (cluster, interval), sorted by depth within each group
+    group = m_spike_clusters[in_interval].astype('int64') * interval_starts.size + interval[in_interval]
+    group_depths = depths[in_interval]
+    order = np.lexsort((group_depths, group))
+    group = group[order]
+    group_depths = group_depths[order]
 
-        printProgressBar(idx+1, len(cluster_ids))
+    group_ids, group_starts, group_counts = np.unique(group, return_index = True, return_counts = True)
+    group_medians = (group_depths[group_starts + (group_counts - 1) // 2] + group_depths[group_starts + group_counts // 2]) / 2
 
-        in_cluster = m_spike_clusters == cluster_id
-        times_for_cluster = m_spike_times[in_cluster]
-        depths_for_cluster = depths[in_cluster]
+    median_depths = np.empty((total_units, interval_starts.size))
+    median_depths[:] = np.nan
+    enough_spikes = group_counts >= min_spikes_per_interval
+    median_depths.flat[group_ids[enough_spikes]] = group_medians[enough_spikes]
 
-        median_depths = []
+    cluster_ids = m_spike_index.cluster_ids
 
-        for t1, t2 in zip(interval_starts, interval_ends):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        max_drift[cluster_ids] = np.around(np.nanmax(median_depths[cluster_ids], 1) - np.nanmin(median_depths[cluster_ids], 1), 2)
+    cumulative_drift[cluster_ids] = np.around(np.nansum(np.abs(np.diff(median_depths[cluster_ids], axis = 1)), 1), 2)
 
-            in_range = (times_for_cluster > t1) * (times_for_cluster < t2)
-            
-            if np.sum(in_range) >= min_spikes_per_interval:
-                median_depths.append(np.median(depths_for_cluster[in_range]))
-            else:
-                median_depths.append(np.nan)
-            
-        median_depths = np.array(median_depths)
-            
-        max_drift[cluster_id] = np.around(np.nanmax(median_depths) - np.nanmin(median_depths),2)
-        cumulative_drift[cluster_id] = np.around(np.nansum(np.abs(np.diff(median_depths))),2)
+    if return_depth_matrix:
+        return max_drift, cumulative_drift, median_depths, interval_starts
 
     return max_drift, cumulative_drift
 
@@ -917,7 +1397,7 @@ def nearest_neighbors_metrics(all_pcs, all_labels, this_unit_id, max_spikes_for_
 
 # ==========================================================
 
-def make_index_mask(spike_clusters, unit_id, min_num, max_num):
+def make_index_mask(spike_clusters, unit_id, min_num, max_num, spike_index = None, random_state = None):
 
     """ Create a mask for the spike index dimensions of the pc_features array  
 
@@ -931,6 +1411,10 @@ def make_index_mask(spike_clusters, unit_id, min_num, max_num):
         Minimum number of spikes to return; if there are not enough spikes for this unit, return all False
     max_num : Int
         Maximum number of spikes to return; if too many spikes for this unit, return a random subsample
+    spike_index : SpikeIndex (optional)
+        Spikes grouped by cluster; avoids searching all of spike_clusters for this unit
+    random_state : numpy.random.RandomState (optional)
+        Source of the random subsample; defaults to the global numpy random state
 
     Output:
     -------
@@ -939,18 +1423,48 @@ def make_index_mask(spike_clusters, unit_id, min_num, max_num):
 
     """
     
-    index_mask = spike_clusters == unit_id
+    if spike_index is None:
+        spike_index = SpikeIndex(spike_clusters)
+
+    index_mask = np.zeros((spike_clusters.size,), dtype='bool')
+    index_mask[subsample_unit_spikes(spike_index, unit_id, min_num, max_num, random_state)] = True
         
-    inds = np.where(index_mask)[0]
+    return index_mask
+
+
+def subsample_unit_spikes(spike_index, unit_id, min_num, max_num, random_state = None):
+
+    """ Same selection as make_index_mask, returned as sorted spike indices  
+
+    Inputs:
+    -------
+    spike_index : SpikeIndex
+        Spikes grouped by cluster
+    unit_id : Int
+        ID for this unit
+    min_num : Int
+        Minimum number of spikes to return; if there are not enough spikes for this unit, return none
+    max_num : Int
+        Maximum number of spikes to return; if too many spikes for this unit, return a random subsample
+    random_state : numpy.random.RandomState (optional)
+        Source of the random subsample; defaults to the global numpy random state
+
+    Output:
+    -------
+    inds : numpy.ndarray (int)
+        Indices of the selected spikes, in increasing order
+
+    """
+
+    inds = spike_index.indices(unit_id)
     
     if len(inds) < min_num:
-        index_mask = np.zeros((spike_clusters.size,), dtype='bool')
-    else:
-        index_mask = np.zeros((spike_clusters.size,), dtype='bool')
-        order = np.random.permutation(inds.size)
-        index_mask[inds[order[:max_num]]] = True
-        
-    return index_mask
+        return inds[:0]
+
+    permutation = np.random.permutation if random_state is None else random_state.permutation
+    order = permutation(inds.size)
+
+    return np.sort(inds[order[:max_num]])
 
 
 def make_channel_mask(unit_id, pc_feature_ind, channels_to_use):
@@ -1006,7 +1520,7 @@ def make_channel_mask(unit_id, pc_feature_ind, channels_to_use):
 #    
 #    return unit_PCs
     
-def get_unit_pcs(these_pc_features, index_mask, spike_templates, channels_to_use, pc_feature_ind):
+def get_unit_pcs(these_pc_features, index_mask, spike_templates, channels_to_use, pc_feature_ind, pc_feature_rows = None):
 
     """ Use the index_mask and channel_mask to return PC features for one unit 
 
@@ -1014,10 +1528,16 @@ def get_unit_pcs(these_pc_features, index_mask, spike_templates, channels_to_use
     -------
     these_pc_features : numpy.ndarray (float)
         Array of pre-computed PC features (num_spikes x num_PCs x num_channels)
-    index_mask : numpy.ndarray (boolean)
-        Mask for spike index dimension of pc_features array
-    channel_mask : numpy.ndarray (boolean)
-        Mask for channel index dimension of pc_features array
+    index_mask : numpy.ndarray (boolean or int)
+        Mask (or sorted indices) for spike index dimension of pc_features array
+    spike_templates : numpy.ndarray (num_spikes x 0)
+        Template IDs for each spike
+    channels_to_use : numpy.ndarray
+        Channels to use for calculating metrics
+    pc_feature_ind : numpy.ndarray (num_units x num_channels)
+        Channel indices of PCs for each unit
+    pc_feature_rows : numpy.ndarray (optional)
+        Row of these_pc_features for each spike; only these rows are read
 
     Output:
     -------
@@ -1028,6 +1548,12 @@ def get_unit_pcs(these_pc_features, index_mask, spike_templates, channels_to_use
 
     # start with an empty 3D array
     [nspike,npcs,nchan] = these_pc_features.shape
+
+    if index_mask.dtype == 'bool':
+        index_mask = np.where(index_mask)[0]
+
+    if pc_feature_rows is None:
+        pc_feature_rows = np.arange(nspike)
     
     nchan_to_use = channels_to_use.shape[0]
 
@@ -1035,11 +1561,12 @@ def get_unit_pcs(these_pc_features, index_mask, spike_templates, channels_to_use
     
     # get list of templates included in this cluster
     # for data with no curation, there will just be one value   
-    template_ids = np.unique(spike_templates[index_mask])
+    unit_templates = spike_templates[index_mask]
+    template_ids = np.unique(unit_templates)
     
     # for each template id, create a channel mask (if possible) and extract templates
     for tid in template_ids:
-        curr_idx = index_mask & (spike_templates == tid)
+        curr_idx = pc_feature_rows[index_mask[unit_templates == tid]]
         try:
             channel_mask = make_channel_mask(tid, pc_feature_ind, channels_to_use)            
         except IndexError:
@@ -1056,6 +1583,188 @@ def get_unit_pcs(these_pc_features, index_mask, spike_templates, channels_to_use
 
 def ccg(st1, st2, nbins, tbin, auto):
     
+    """ calculate crosscorrelogram between two sets of spike times (st1, st2)
+        in seconds, with bin width tbin, time lags = plus/minus nbins.
+        Algorithm from Kilosort2, written by Marius Pachitariu
+        
+        Pairs of spikes within the lag window are found with searchsorted
+        and binned with bincount (or with a compiled kernel when numba is
+        installed); output matches the original loop version, ccg_loop
+        
+    st1 : spike times for set #1 in sec
+    st2 : spike times for set #2 in sec
+    nbins : ccg will be calculated for 2*nbins + 1, 
+    tbin : bin width in seconds
+    
+    output:
+        
+    K = ccg histogram
+    Qi
+    Q00
+    Q01
+    
+    """
+    st1 = np.sort(np.squeeze(st1))
+    st2 = np.sort(np.squeeze(st2))
+    
+    T = max(np.max(st1),np.max(st2)) - min(np.min(st1),np.min(st2))
+    
+    if HAS_NUMBA:
+        K = ccg_counts_numba(st1, st2, nbins, tbin)
+    else:
+        K = ccg_counts(st1, st2, nbins, tbin)
+    K = K.astype('float64')
+    
+    if auto:
+        # if this is an autocorrelogram, remove the self-found spikes from the zero bin
+        K[nbins] = K[nbins] - len(st1)
+        
+    Qi, Q00, Q01, Ri = ccg_refractoriness(K, len(st1), len(st2), T, nbins, tbin)
+    
+    return K, Qi, Q00, Q01, Ri
+
+
+def ccg_counts(st1, st2, nbins, tbin, max_pairs = 2**22):
+    
+    """ Count spike pairs in each lag bin of the crosscorrelogram
+    
+    Inputs:
+    -------
+    st1 : numpy.ndarray
+        Sorted spike times for set #1 in sec
+    st2 : numpy.ndarray
+        Sorted spike times for set #2 in sec
+    nbins : int
+        Number of bins on either side of zero lag
+    tbin : float
+        Bin width in seconds
+    max_pairs : int
+        Maximum number of spike pairs held in memory at once
+        
+    Output:
+    -------
+    K : numpy.ndarray (2*nbins + 1)
+        Number of pairs in each bin, lag = st2 - st1
+        
+    """
+    
+    dt = nbins*tbin
+    
+    K = np.zeros((2*nbins+1,), dtype = 'int64')
+    
+    # for each spike in st2, range of spikes in st1 within plus/minus dt
+    ilow = np.searchsorted(st1, st2 - dt, side = 'right')
+    ihigh = np.searchsorted(st1, st2 + dt, side = 'left')
+    num_pairs = np.maximum(ihigh - ilow, 0)
+    cum_pairs = np.cumsum(num_pairs)
+    
+    # walk over st2 in chunks, keeping the number of pairs per chunk bounded
+    j0 = 0
+    while j0 < len(st2):
+        offset = cum_pairs[j0-1] if j0 > 0 else 0
+        j1 = max(np.searchsorted(cum_pairs, offset + max_pairs, side = 'right'), j0 + 1)
+        
+        counts = num_pairs[j0:j1]
+        total = np.sum(counts)
+        
+        if total > 0:
+            j = np.repeat(np.arange(j0, j1), counts)
+            k = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(ilow[j0:j1], counts)
+            ibin = np.rint((st2[j] - st1[k])/tbin).astype('int64')
+            K = K + np.bincount(ibin + nbins, minlength = 2*nbins+1)
+            
+        j0 = j1
+        
+    return K
+
+
+if HAS_NUMBA:
+    
+    @numba.njit
+    def ccg_counts_numba(st1, st2, nbins, tbin):
+        
+        """ Compiled version of ccg_counts: same two-pointer walk as ccg_loop """
+        
+        dt = nbins*tbin
+        K = np.zeros((2*nbins+1,), dtype = np.int64)
+        
+        ilow = 0
+        ihigh = 0
+        n_st1 = len(st1)
+        
+        for j in range(len(st2)):
+            while (ihigh < n_st1) and (st1[ihigh] < st2[j]+dt):
+                ihigh = ihigh + 1
+            while (ilow < n_st1) and (st1[ilow] <= st2[j]-dt):
+                ilow = ilow + 1
+            for k in range(ilow, ihigh):
+                ibin = int(np.rint((st2[j]-st1[k])/tbin))
+                K[ibin + nbins] = K[ibin + nbins] + 1
+                
+        return K
+
+
+def ccg_refractoriness(K, n_st1, n_st2, T, nbins, tbin):
+    
+    """ Compute Kilosort2 refractoriness measures from a crosscorrelogram
+    
+    Inputs:
+    -------
+    K : numpy.ndarray (2*nbins + 1)
+        ccg histogram
+    n_st1, n_st2 : int
+        Number of spikes in each spike train
+    T : float
+        Time spanned by both spike trains, in sec
+    nbins : int
+        Number of bins on either side of zero lag
+    tbin : float
+        Bin width in seconds
+        
+    Outputs:
+    --------
+    Qi, Q00, Q01, Ri : see ccg
+    
+    """
+    
+    irange1 = np.concatenate((np.arange(1, int(nbins/2)), np.arange(int(3/2*nbins), 2*nbins-1)),0) # this index range corresponds to the CCG shoulders, excluding end bins
+    irange2 = np.arange(nbins-50, nbins-10)  # 40 channels to negative side of peak
+    irange3 = np.arange(nbins+10, nbins+50)  # 40 channels to positive side of peak
+    
+    # Normalize the firing rate in the shoulders by the mean firing rate
+    # A Poisson process has a flat ACG (equal numbers of spikes at all ISIs) and these ratios would = 1
+    mean_firing_rate = (n_st2)/T
+    Q00 = (sum(K[irange1])/(n_st1 * tbin * len(irange1)))/mean_firing_rate
+    Q01_neg = (sum(K[irange2])/(n_st1 * tbin * len(irange2)))/mean_firing_rate
+    Q01_pos = (sum(K[irange3])/(n_st1 * tbin * len(irange3)))/mean_firing_rate
+    Q01 = max(Q01_neg, Q01_pos)
+    
+    # Get highest spike rate of the sampled time regions
+    R00 = max(np.mean(K[irange2]), np.mean(K[irange3])) # Larger of the two shoulders near t = 0
+    R00 = max(R00, np.mean(K[irange1])) # compare this to the asymptotic shoulder
+    
+    # Calculate "refractoriness for periods from 1*tbin to 10*tbin
+    Qi = np.zeros((11,))
+    Ri = np.zeros((11,))
+    for i in range(1,11):
+        irange = np.arange(nbins-i,nbins+i)
+        Qi[i] = (sum(K[irange])/(n_st1 * (2*i+1)*tbin))/mean_firing_rate    #rate in this time period/mean rate
+
+        # Marius note: this is tricky: we approximate the Poisson likelihood with a gaussian of equal mean and variance
+        # that allows us to integrate the probability that we would see <N spikes in the center of the
+        # cross-correlogram from a distribution with mean R00*i spikes
+        
+        # this calculation is done in KS2 but never used
+        # n = sum(K[irange])/2
+        # lam = R00 + i
+        # Ri[i] =  1/2 * (1+ special.erf((n - lam)/np.sqrt(2*lam)))
+        
+    return Qi, Q00, Q01, Ri
+
+
+# original pure python version of ccg, retained as a reference for testing
+def ccg_loop(st1, st2, nbins, tbin, auto):
+    
     """ calculate crosscorrelogram between two sets of spike times (st1, st2)
         in seconds, with bin width tbin, time lags = plus/minus nbins.
         Algorithm from Kilosort2, written by Marius Pachitariu
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+Times the post-sorting modules on synthetic Kilosort output at several scales
+
+Runs offline: each dataset is generated with common.synthetic_data, the
+modules are run in pipeline order with their default parameters (Python
+code paths only, no C_Waves), and the timings are written to a JSON report.
+
+Example:
+
+    python -m ecephys_spike_sorting.scripts.helpers.benchmark --scales small medium --output_json benchmark.json
+
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+from datetime import datetime
+
+import numpy as np
+import psutil
+from argschema import ArgSchemaParser
+
+from ...common.synthetic_data import make_synthetic_dataset
+
+
+# dataset sizes; the binary is num_channels * duration * 60 kB
+SCALES = {
+    'small'  : {'num_units' : 16,  'num_channels' : 32,  'duration' : 30.0},
+    'medium' : {'num_units' : 64,  'num_channels' : 64,  'duration' : 60.0},
+    'large'  : {'num_units' : 256, 'num_channels' : 128, 'duration' : 120.0},
+    'xlarge' : {'num_units' : 512, 'num_channels' : 384, 'duration' : 300.0},
+}
+
+MODULES = ['kilosort_postprocessing', 'noise_templates', 'mean_waveforms', 'quality_metrics', 'depth_estimation']
+
+
+def module_inputs(module, dataset, work_dir, num_channels, sample_rate):
+
+    """ Input parameters for one module on a synthetic dataset (defaults for everything else) """
+
+    ks_dir = dataset['kilosort_output_directory']
+
+    ephys_params = {'sample_rate' : sample_rate,
+                    'lfp_sample_rate' : 2500.0,
+                    'num_channels' : num_channels,
+                    'reference_channels' : [num_channels // 2],
+                    'ap_band_file' : dataset['ap_band_file'],
+                    'lfp_band_file' : dataset['lfp_band_file']}
+
+    directories = {'kilosort_output_directory' : ks_dir}
+
+    if module == 'kilosort_postprocessing':
+        return {'ephys_params' : ephys_params,
+                'directories' : directories,
+                'ks_postprocessing_params' : {'align_avg_waveform' : False}}
+
+    if module == 'noise_templates':
+        from ...modules import noise_templates
+        return {'ephys_params' : ephys_params,
+                'directories' : directories,
+                'noise_waveform_params' : {'classifier_path' : os.path.join(os.path.dirname(noise_templates.__file__), 'rf_classifier.pkl')}}
+
+    if module == 'mean_waveforms':
+        return {'ephys_params' : ephys_params,
+                'directories' : directories,
+                'waveform_metrics' : {'waveform_metrics_file' : os.path.join(ks_dir, 'waveform_metrics.csv')},
+                'cluster_metrics' : {'cluster_metrics_file' : os.path.join(ks_dir, 'metrics.csv')},
+                'mean_waveform_params' : {'mean_waveforms_file' : os.path.join(ks_dir, 'mean_waveforms.npy'),
+                                          'use_C_Waves' : False}}
+
+    if module == 'quality_metrics':
+        return {'ephys_params' : ephys_params,
+                'directories' : directories,
+                'waveform_metrics' : {'waveform_metrics_file' : os.path.join(ks_dir, 'waveform_metrics.csv')},
+                'cluster_metrics' : {'cluster_metrics_file' : os.path.join(ks_dir, 'metrics.csv')},
+                'quality_metrics_params' : {}}
+
+    if module == 'depth_estimation':
+        return {'ephys_params' : ephys_params,
+                'directories' : directories,
+                'common_files' : {'probe_json' : os.path.join(work_dir, 'probe_info.json')},
+                'depth_estimation_params' : {'save_figure' : False,
+                                             'figure_location' : os.path.join(work_dir, 'probe_depth.png'),
+                                             'n_passes' : 4,
+                                             'skip_s_per_pass' : 2,
+                                             'saline_range_um' : [0, 0]}}
+
+    raise ValueError('unrecognized module: {}'.format(module))
+
+
+def run_module(module, input_data):
+
+    """ Parses the inputs with the module's schema and runs it in this process """
+
+    if module == 'kilosort_postprocessing':
+        from ...modules.kilosort_postprocessing.__main__ import run_postprocessing as run
+        from ...modules.kilosort_postprocessing._schemas import InputParameters
+    elif module == 'noise_templates':
+        from ...modules.noise_templates.__main__ import classify_noise_templates as run
+        from ...modules.noise_templates._schemas import InputParameters
+    elif module == 'mean_waveforms':
+        from ...modules.mean_waveforms.__main__ import calculate_mean_waveforms as run
+        from ...modules.mean_waveforms._schemas import InputParameters
+    elif module == 'quality_metrics':
+        from ...modules.quality_metrics.__main__ import calculate_quality_metrics as run
+        from ...modules.quality_metrics._schemas import InputParameters
+    elif module == 'depth_estimation':
+        from ...modules.depth_estimation.__main__ import run_depth_estimation as run
+        from ...modules.depth_estimation._schemas import InputParameters
+
+    mod = ArgSchemaParser(input_data = input_data, schema_type = InputParameters, args = [])
+
+    return run(mod.args)
+
+
+def benchmark_scale(name, scale, work_dir, modules, repeats, seed):
+
+    """ Generates one dataset and times each module on it """
+
+    data_dir = os.path.join(work_dir, name)
+
+    print('Generating ' + name + ' dataset: ' + repr(scale))
+
+    start = time.perf_counter()
+    dataset = make_synthetic_dataset(data_dir, seed = seed, **scale)
+    generate_time = time.perf_counter() - start
+
+    # modules overwrite the Kilosort output, so each repeat starts from a copy
+    pristine_dir = dataset['kilosort_output_directory'] + '_original'
+    shutil.copytree(dataset['kilosort_output_directory'], pristine_dir)
+
+    result = {'parameters' : scale,
+              'num_spikes' : int(dataset['num_spikes']),
+              'ap_band_bytes' : os.path.getsize(dataset['ap_band_file']),
+              'generate_time' : generate_time,
+              'modules' : {module : [] for module in modules}}
+
+    for repeat in range(repeats):
+
+        if repeat > 0:
+            shutil.rmtree(dataset['kilosort_output_directory'])
+            shutil.copytree(pristine_dir, dataset['kilosort_output_directory'])
+
+        for module in modules:
+
+            input_data = module_inputs(module, dataset, data_dir, scale['num_channels'], 30000.0)
+
+            process = psutil.Process()
+            wall_start = time.perf_counter()
+            cpu_start = time.process_time()
+
+            entry = {'status' : 'ok'}
+
+            try:
+                output = run_module(module, input_data)
+                entry['execution_time'] = output.get('execution_time')
+                entry['stage_profile'] = output.get('stage_profile')
+            except Exception as e:
+                traceback.print_exc()
+                entry['status'] = 'error'
+                entry['error'] = type(e).__name__ + ': ' + str(e)
+
+            entry['wall_time'] = time.perf_counter() - wall_start
+            entry['cpu_time'] = time.process_time() - cpu_start
+            entry['rss_mb'] = process.memory_info().rss / 2**20
+
+            result['modules'][module].append(entry)
+
+    return result
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'Benchmark post-sorting modules on synthetic data')
+    parser.add_argument('--scales', nargs = '+', default = ['small', 'medium'], choices = sorted(SCALES.keys()))
+    parser.add_argument('--modules', nargs = '+', default = MODULES, choices = MODULES)
+    parser.add_argument('--repeats', type = int, default = 1)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--work_dir', default = None, help = 'Directory for the synthetic data (default: temporary directory)')
+    parser.add_argument('--keep_data', action = 'store_true', help = 'Do not delete the synthetic data')
+    parser.add_argument('--output_json', default = 'benchmark.json')
+    args = parser.parse_args()
+
+    work_dir = args.work_dir if args.work_dir is not None else tempfile.mkdtemp(prefix = 'ecephys_benchmark_')
+    os.makedirs(work_dir, exist_ok = True)
+
+    report = {'date' : datetime.now().isoformat(timespec = 'seconds'),
+              'platform' : platform.platform(),
+              'python' : sys.version.split()[0],
+              'numpy' : np.__version__,
+              'cpu_count' : os.cpu_count(),
+              'memory_gb' : psutil.virtual_memory().total / 2**30,
+              'repeats' : args.repeats,
+              'scales' : {}}
+
+    try:
+        for name in args.scales:
+            report['scales'][name] = benchmark_scale(name, SCALES[name], work_dir, args.modules, args.repeats, args.seed)
+
+            # write after every scale, so partial results survive
+            with open(args.output_json, 'w') as f:
+                json.dump(report, f, indent = 2)
+    finally:
+        if not args.keep_data:
+            shutil.rmtree(work_dir, ignore_errors = True)
+
+    print()
+    for name, result in report['scales'].items():
+        print(name + ' (' + repr(result['num_spikes']) + ' spikes)')
+        for module, entries in result['modules'].items():
+            times = [entry['wall_time'] for entry in entries]
+            status = 'ok' if all(entry['status'] == 'ok' for entry in entries) else 'error'
+            print('    {:<26s}{:>9.2f} s  {}'.format(module, np.min(times), status))
+
+    print('Report written to ' + args.output_json)
+
+
+if __name__ == "__main__":
+    main()
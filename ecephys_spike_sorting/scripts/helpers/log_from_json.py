@@ -68,11 +68,53 @@ def addEntry(modules, jsondir, session_id, logFullPath):
     with open(logFullPath, 'a') as log:
         log.write(log_entry_str + '\n')
 
+    addStageEntries(modules, jsondir, session_id, stageLogPath(logFullPath))
+
+
+# Per-stage breakdown (wall time, CPU time, peak RSS) recorded in the
+# 'stage_profile' of each module's output json; one row per stage,
+# written to a companion table next to the main log
+#
+def addStageEntries(modules, jsondir, session_id, stageLogFullPath):
+
+    sep = ','
+
+    if not os.path.exists(stageLogFullPath):
+        writeStageHeader(stageLogFullPath)
+
+    with open(stageLogFullPath, 'a') as log:
+        for module in modules:
+            jsonFile = os.path.join(jsondir, session_id + '-' + module + '-output.json')
+            if not os.path.exists(jsonFile):
+                continue
+            with open(jsonFile) as currJson:
+                modData = json.load(currJson)
+            for stage, entry in modData.get('stage_profile', {}).items():
+                stage_entry = [session_id, module, stage,
+                               '{:.2f}'.format(entry['wall_time']),
+                               '{:.2f}'.format(entry['cpu_time']),
+                               '{:.1f}'.format(entry['peak_rss_mb']),
+                               repr(entry['calls'])]
+                log.write(sep.join(stage_entry) + '\n')
+
+
+# name of the stage table that goes with a log file: <log>_stages.csv
+def stageLogPath(logFullPath):
+    logStem, logExt = os.path.splitext(logFullPath)
+    return logStem + '_stages' + logExt
+
 
 # write header to file
 def writeHeader(logFullPath):
     with open(logFullPath, 'w') as log:
         log.write('session_id,date_run,time_run,ntot,nTemplate,KS2_time,KS_postprocess_time,noise_template_time,mean_waveform_time,QC_time\n')
+    writeStageHeader(stageLogPath(logFullPath))
+
+
+# write header to the stage table
+def writeStageHeader(stageLogFullPath):
+    with open(stageLogFullPath, 'w') as log:
+        log.write('session_id,module,stage,wall_time,cpu_time,peak_rss_mb,calls\n')
 
 
 # For testing, prompt user for kilosort_helper-out.json,
@@ -38,4 +38,8 @@ setup(
         'joblib',
         'psutil'
     ],
+    extras_require={
+        # chunked mean waveform stores (mean_waveforms_store: .zarr or .nc)
+        'store': ['zarr', 'netCDF4', 'dask'],
+    },
 )
\ No newline at end of file
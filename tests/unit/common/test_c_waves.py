@@ -0,0 +1,111 @@
+import pytest
+import numpy as np
+import os
+
+from ecephys_spike_sorting.common.synthetic_data import make_synthetic_dataset
+from ecephys_spike_sorting.common.utils import getSortResults
+from ecephys_spike_sorting.common.c_waves import c_waves, c_waves_executable, select_spikes
+
+# directory with the C_Waves executable (runit.sh / runit.bat); the comparison
+# with the executable is skipped if this is not set
+CWAVES_PATH = os.environ.get('CWAVES_PATH', False)
+
+
+def test_select_spikes():
+
+	spike_clusters = np.array([2, 0, 2, 2, 0, 2, 2, 2, 2, 2])
+
+	selected = select_spikes(spike_clusters, 4, 3)
+
+	assert(np.array_equal(selected, [0, 1, 3, 4, 7]))
+
+
+def test_c_waves(tmpdir):
+
+	num_channels = 16
+	samples_per_spike = 82
+	pre_samples = 20
+	num_spikes = 50
+
+	dataset = make_synthetic_dataset(str(tmpdir), num_units = 5, num_channels = num_channels, duration = 5.0, firing_rate = 20.0, num_pc_channels = 8)
+	ks_dir = dataset['kilosort_output_directory']
+
+	getSortResults(ks_dir, 0)
+
+	mean_waveforms_file, snr_file = c_waves(dataset['ap_band_file'],
+											os.path.join(ks_dir, 'clus_Table.npy'),
+											os.path.join(ks_dir, 'spike_times.npy'),
+											os.path.join(ks_dir, 'spike_clusters.npy'),
+											str(tmpdir),
+											samples_per_spike = samples_per_spike,
+											pre_samples = pre_samples,
+											num_spikes = num_spikes,
+											snr_radius = 0,
+											prefix = 'preprocess',
+											num_threads = 3,
+											chunk_bytes = 2**14)
+
+	assert(os.path.basename(mean_waveforms_file) == 'preprocess_mean_waveforms.npy')
+	assert(os.path.basename(snr_file) == 'preprocess_cluster_snr.npy')
+
+	mean_waveforms = np.load(mean_waveforms_file)
+	cluster_snr = np.load(snr_file)
+	clus_table = np.load(os.path.join(ks_dir, 'clus_Table.npy'))
+
+	assert(mean_waveforms.shape == (5, num_channels, samples_per_spike))
+	assert(mean_waveforms.dtype == np.float32 and cluster_snr.dtype == np.float32)
+	assert(cluster_snr.shape == (5, 2))
+
+	# brute force, one spike at a time
+	spike_times = np.squeeze(np.load(os.path.join(ks_dir, 'spike_times.npy'))).astype('int64')
+	spike_clusters = np.load(os.path.join(ks_dir, 'spike_clusters.npy'))
+	data = np.memmap(dataset['ap_band_file'], dtype = 'int16', mode = 'r').reshape(-1, num_channels)
+
+	selected = select_spikes(spike_clusters, 5, num_spikes)
+
+	for cluster_id in range(5):
+
+		times = spike_times[selected[spike_clusters[selected] == cluster_id]]
+		times = times[(times >= pre_samples) * (times - pre_samples + samples_per_spike <= data.shape[0])]
+		snippets = np.array([data[t - pre_samples:t - pre_samples + samples_per_spike, :].T for t in times], dtype = 'float64')
+
+		mean = np.mean(snippets, 0)
+		peak = clus_table[cluster_id, 1]
+		W = snippets[:, peak, :]
+		snr = (np.max(mean[peak]) - np.min(mean[peak])) / (2 * np.std(W - np.mean(W, 0)))
+
+		assert(cluster_snr[cluster_id, 1] == len(times))
+		assert(np.allclose(mean_waveforms[cluster_id], mean * 0.195, rtol = 1e-5, atol = 1e-4))
+		assert(np.isclose(cluster_snr[cluster_id, 0], snr, rtol = 1e-4))
+
+
+@pytest.mark.skipif(not CWAVES_PATH, reason = 'set CWAVES_PATH to the directory with the C_Waves executable')
+@pytest.mark.parametrize('snr_radius,snr_radius_um', [(8, None), (0, None), (8, 40)])
+def test_c_waves_matches_executable(tmpdir, snr_radius, snr_radius_um):
+
+	dataset = make_synthetic_dataset(str(tmpdir), num_units = 8, num_channels = 32, duration = 10.0, firing_rate = 20.0, num_pc_channels = 8)
+	ks_dir = dataset['kilosort_output_directory']
+
+	getSortResults(ks_dir, 0)
+
+	inputs = (dataset['ap_band_file'],
+			  os.path.join(ks_dir, 'clus_Table.npy'),
+			  os.path.join(ks_dir, 'spike_times.npy'),
+			  os.path.join(ks_dir, 'spike_clusters.npy'))
+
+	settings = dict(samples_per_spike = 82, pre_samples = 20, num_spikes = 100, snr_radius = snr_radius, snr_radius_um = snr_radius_um)
+
+	os.makedirs(os.path.join(str(tmpdir), 'executable'))
+	os.makedirs(os.path.join(str(tmpdir), 'python'))
+
+	reference = c_waves_executable(CWAVES_PATH, *inputs, os.path.join(str(tmpdir), 'executable'), **settings)
+	outputs = c_waves(*inputs, os.path.join(str(tmpdir), 'python'), **settings)
+
+	for reference_file, output_file in zip(reference, outputs):
+
+		expected = np.load(reference_file)
+		actual = np.load(output_file)
+
+		assert(os.path.basename(reference_file) == os.path.basename(output_file))
+		assert(expected.dtype == actual.dtype and expected.shape == actual.shape)
+		assert(np.allclose(expected, actual, rtol = 1e-5, atol = 1e-4))
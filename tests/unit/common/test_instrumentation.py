@@ -0,0 +1,61 @@
+import pytest
+import numpy as np
+import time
+
+from ecephys_spike_sorting.common.instrumentation import StageProfiler, stage, profiled, profile_stages
+
+
+@profiled('allocate')
+def allocate(num_bytes):
+	x = np.ones((num_bytes,), dtype = 'uint8')
+	time.sleep(0.1)
+	return x.sum()
+
+
+def test_stage_profiler():
+
+	with StageProfiler(sample_interval = 0.01) as profiler:
+
+		with stage('sleep'):
+			time.sleep(0.05)
+
+		for i in range(3):
+			allocate(2**26)
+
+	summary = profiler.summary()
+
+	assert(list(summary.keys()) == ['sleep', 'allocate'])
+	assert(summary['sleep']['wall_time'] >= 0.05)
+	assert(summary['sleep']['cpu_time'] < summary['sleep']['wall_time'])
+	assert(summary['sleep']['calls'] == 1)
+
+	# repeated stages accumulate
+	assert(summary['allocate']['calls'] == 3)
+	assert(summary['allocate']['wall_time'] >= 0.3)
+
+	# the 64 MB array is held while the stage is running
+	assert(summary['allocate']['peak_rss_mb'] >= summary['sleep']['peak_rss_mb'] + 32)
+
+
+def test_stages_without_profiler():
+
+	with stage('unused'):
+		pass
+
+	assert(allocate(16) == 16)
+
+
+def test_profile_stages():
+
+	@profile_stages
+	def run_module(args):
+		with stage('load'):
+			pass
+		with stage('save'):
+			pass
+		return {'execution_time' : 0.0}
+
+	output = run_module({})
+
+	assert(list(output['stage_profile'].keys()) == ['load', 'save'])
+	assert(set(output['stage_profile']['load'].keys()) == {'wall_time', 'cpu_time', 'peak_rss_mb', 'calls'})
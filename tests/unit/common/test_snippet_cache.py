@@ -0,0 +1,97 @@
+import pytest
+import numpy as np
+import os
+
+from ecephys_spike_sorting.common.snippets import read_snippets
+from ecephys_spike_sorting.common.snippet_cache import SnippetCache
+
+
+def test_snippet_cache(tmpdir):
+
+	rng = np.random.RandomState(0)
+
+	num_samples = 20000
+	num_channels = 8
+	pre_samples = 20
+	samples_per_spike = 82
+
+	raw_data_file = os.path.join(str(tmpdir), 'continuous.ap.bin')
+	rng.randint(-1000, 1000, (num_samples, num_channels)).astype('int16').tofile(raw_data_file)
+	raw_data = np.memmap(raw_data_file, dtype = 'int16', mode = 'r').reshape(-1, num_channels)
+
+	spike_times = np.sort(np.concatenate((rng.randint(0, num_samples, 500), [5, num_samples - 10]))).astype('uint64')
+
+	cache_dir = os.path.join(str(tmpdir), 'cache')
+
+	first = rng.choice(spike_times.size, 200, replace = False)
+	first = np.concatenate((first, [0, spike_times.size - 1]))	# unreadable snippets
+	second = rng.choice(spike_times.size, 300, replace = False)
+
+	for spike_indices in [first, second]:
+
+		# a new cache object each time, as in a later stage or a rerun
+		cache = SnippetCache(cache_dir, raw_data_file, spike_times, pre_samples, samples_per_spike, num_channels)
+		snippets, valid = cache.read_snippets(raw_data, spike_times, spike_indices, chunk_bytes = 4096)
+
+		expected, expected_valid = read_snippets(raw_data, spike_times[spike_indices], pre_samples, samples_per_spike)
+
+		assert(np.array_equal(valid, expected_valid))
+		assert(np.array_equal(snippets, expected))
+
+	cached = np.unique(np.concatenate((first, second)))
+	cached = cached[(cached > 0) * (cached < spike_times.size - 1)]
+
+	cache = SnippetCache(cache_dir, raw_data_file, spike_times, pre_samples, samples_per_spike, num_channels)
+	assert(np.array_equal(cache.index, cached))
+
+	# cached snippets are served without the binary
+	snippets, valid = cache.read_snippets(None, spike_times, second)
+	assert(np.all(valid))
+
+	# different spike times invalidate the cache
+	cache = SnippetCache(cache_dir, raw_data_file, spike_times + 1, pre_samples, samples_per_spike, num_channels)
+	assert(cache.index.size == 0)
+
+
+def test_snippet_cache_merge_once(tmpdir):
+
+	rng = np.random.RandomState(1)
+
+	num_samples = 20000
+	num_channels = 8
+
+	raw_data_file = os.path.join(str(tmpdir), 'continuous.ap.bin')
+	rng.randint(-1000, 1000, (num_samples, num_channels)).astype('int16').tofile(raw_data_file)
+	raw_data = np.memmap(raw_data_file, dtype = 'int16', mode = 'r').reshape(-1, num_channels)
+
+	spike_times = np.sort(rng.randint(100, num_samples - 100, 600)).astype('uint64')
+
+	cache_dir = os.path.join(str(tmpdir), 'cache')
+	cache = SnippetCache(cache_dir, raw_data_file, spike_times, 20, 82, num_channels)
+
+	# several passes, as in the batches of extract_waveforms, staged and merged once
+	passes = [rng.choice(spike_times.size, 150, replace = False) for _ in range(4)]
+
+	for spike_indices in passes:
+
+		snippets, valid = cache.read_snippets(raw_data, spike_times, spike_indices, chunk_bytes = 4096, merge = False)
+		expected, expected_valid = read_snippets(raw_data, spike_times[spike_indices], 20, 82)
+
+		assert(np.array_equal(snippets, expected))
+		assert(cache.index.size == 0)
+		assert(not os.path.exists(cache.snippets_file))
+
+	assert(len(cache.pending) == 4)
+
+	cache.merge_pending(chunk_bytes = 4096)
+
+	assert(cache.pending == [])
+	assert(sorted(os.listdir(cache_dir)) == sorted(os.path.basename(f) for f in (cache.snippets_file, cache.index_file, cache.key_file)))
+
+	reopened = SnippetCache(cache_dir, raw_data_file, spike_times, 20, 82, num_channels)
+	assert(np.array_equal(reopened.index, np.unique(np.concatenate(passes))))
+
+	snippets, valid = reopened.read_snippets(None, spike_times, reopened.index)
+	expected, _ = read_snippets(raw_data, spike_times[reopened.index], 20, 82)
+	assert(np.all(valid))
+	assert(np.array_equal(snippets, expected))
@@ -0,0 +1,41 @@
+import pytest
+import numpy as np
+
+from ecephys_spike_sorting.common.snippets import read_snippets, iter_snippets
+
+
+def test_read_snippets():
+
+	rng = np.random.RandomState(0)
+
+	num_samples = 5000
+	num_channels = 8
+	pre_samples = 20
+	samples_per_spike = 82
+
+	raw_data = rng.randint(-1000, 1000, (num_samples, num_channels)).astype('int16')
+
+	# unsorted, with repeats and spikes at both ends of the data
+	spike_times = np.concatenate((rng.randint(0, num_samples, 200), [0, 19, 20, num_samples - 62, num_samples - 61, 100, 100])).astype('uint64')
+
+	# a small chunk size forces many sequential reads
+	snippets, valid = read_snippets(raw_data, spike_times, pre_samples, samples_per_spike, chunk_bytes = 4096)
+
+	for i, t in enumerate(spike_times.astype('int64')):
+		start = t - pre_samples
+		expected_valid = (start >= 0) and (start + samples_per_spike <= num_samples)
+		assert(valid[i] == expected_valid)
+		if expected_valid:
+			assert(np.array_equal(snippets[i], raw_data[start:start + samples_per_spike, :].T))
+		else:
+			assert(np.all(snippets[i] == 0))
+
+
+def test_iter_snippets_time_order():
+
+	raw_data = np.arange(10000 * 4, dtype = 'int16').reshape(-1, 4)
+	spike_times = np.array([9000, 50, 4000, 60, 7000])
+
+	positions = np.concatenate([p for p, _ in iter_snippets(raw_data, spike_times, 10, 30, chunk_bytes = 2000)])
+
+	assert(np.array_equal(spike_times[positions], np.sort(spike_times)))
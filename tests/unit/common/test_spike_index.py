@@ -0,0 +1,27 @@
+import pytest
+import numpy as np
+
+from ecephys_spike_sorting.common.spike_index import SpikeIndex
+
+def test_spike_index():
+
+	spike_clusters = np.array([3, 0, 3, 1, 0, 3, 5])
+
+	index = SpikeIndex(spike_clusters)
+
+	assert(index.total_units == 6)
+	assert(np.array_equal(index.cluster_ids, np.unique(spike_clusters)))
+	assert(np.array_equal(index.counts, np.bincount(spike_clusters)))
+
+	for cluster_id in range(8):
+		assert(np.array_equal(index.indices(cluster_id), np.where(spike_clusters == cluster_id)[0]))
+
+def test_spike_index_subset():
+
+	spike_clusters = np.array([3, 0, 3, 1, 0, 3, 5])
+	mask = np.array([True, False, False, True, True, True, False])
+
+	sub = SpikeIndex(spike_clusters).subset(mask)
+
+	for cluster_id in range(6):
+		assert(np.array_equal(sub.indices(cluster_id), np.where(spike_clusters[mask] == cluster_id)[0]))
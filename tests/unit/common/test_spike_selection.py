@@ -0,0 +1,89 @@
+import os
+import pytest
+import numpy as np
+
+from ecephys_spike_sorting.common.epoch import Epoch
+from ecephys_spike_sorting.common.spike_selection import select_spikes_stratified, load_or_select_spikes, \
+	isolated_spikes
+
+
+def make_spikes(num_spikes = 20000, num_units = 12):
+
+	rng = np.random.RandomState(0)
+
+	spike_times = np.sort(rng.randint(1, 30000 * 600, num_spikes))
+	spike_clusters = rng.randint(0, num_units, num_spikes)
+	spike_clusters[spike_clusters == 5] = 6		# one empty cluster
+
+	return spike_times, spike_clusters
+
+
+def test_select_spikes_stratified():
+
+	spike_times, spike_clusters = make_spikes()
+	epochs = [Epoch('first', 0, 200), Epoch('second', 200, np.inf), Epoch('complete_session', 0, np.inf)]
+
+	selection = select_spikes_stratified(spike_times, spike_clusters, epochs, 30000.0, 100, seed = 1)
+	repeat = select_spikes_stratified(spike_times, spike_clusters, epochs, 30000.0, 100, seed = 1)
+
+	assert(np.array_equal(selection.spike_indices, repeat.spike_indices))
+	assert(np.array_equal(selection.chosen, repeat.chosen))
+
+	spike_seconds = spike_times / 30000.0
+
+	for epoch in epochs:
+
+		chosen = selection.for_epoch(epoch.name)
+		in_epoch = np.where((spike_seconds > epoch.start_time) * (spike_seconds < epoch.end_time))[0]
+
+		assert(np.all(np.isin(chosen, in_epoch)))
+		assert(np.array_equal(np.bincount(spike_clusters[chosen], minlength = 12),
+							  np.minimum(np.bincount(spike_clusters[in_epoch], minlength = 12), 100)))
+
+		# one spike from each of 100 equal strata of each cluster's spike train
+		for cluster_id in [0, 6]:
+			cluster_spikes = in_epoch[spike_clusters[in_epoch] == cluster_id]
+			rank = np.searchsorted(cluster_spikes, chosen[spike_clusters[chosen] == cluster_id])
+			bounds = np.arange(101) * cluster_spikes.size // 100
+			assert(np.array_equal(np.searchsorted(bounds, rank, side = 'right') - 1, np.arange(100)))
+
+	groups = selection.by_cluster(spike_clusters)
+	assert([cluster_id for cluster_id, _, _ in groups] == [0, 1, 2, 3, 4, 6, 7, 8, 9, 10, 11])
+
+
+def test_prefer_isolated():
+
+	spike_times, spike_clusters = make_spikes(num_spikes = 60000)
+	epochs = [Epoch('complete_session', 0, np.inf)]
+
+	isolated = isolated_spikes(spike_times, 82)
+
+	selection = select_spikes_stratified(spike_times, spike_clusters, epochs, 30000.0, 50, prefer_isolated = True)
+	chosen = selection.for_epoch('complete_session')
+
+	assert(np.mean(isolated) < 0.9)
+	assert(np.all(isolated[chosen]))
+	assert(np.array_equal(np.bincount(spike_clusters[chosen]), np.minimum(np.bincount(spike_clusters), 50)))
+
+
+def test_load_or_select_spikes(tmpdir_factory):
+
+	selection_file = os.path.join(str(tmpdir_factory.mktemp('selection')), 'selection.npz')
+
+	spike_times, spike_clusters = make_spikes()
+	epochs = [Epoch('complete_session', 0, np.inf)]
+
+	selection = load_or_select_spikes(selection_file, spike_times, spike_clusters, epochs, 30000.0, 100, seed = 3)
+	assert(os.path.exists(selection_file))
+
+	# reused for the same spikes and settings, replaced for a different seed
+	reused = load_or_select_spikes(selection_file, spike_times, spike_clusters, epochs, 30000.0, 100, seed = 3)
+	assert(np.array_equal(reused.spike_indices, selection.spike_indices))
+
+	other = load_or_select_spikes(selection_file, spike_times, spike_clusters, epochs, 30000.0, 100, seed = 4)
+	assert(not np.array_equal(other.spike_indices, selection.spike_indices))
+
+	# curation changes the clusters, so the saved selection is replaced
+	spike_clusters[:10] = 0
+	curated = load_or_select_spikes(selection_file, spike_times, spike_clusters, epochs, 30000.0, 100, seed = 4)
+	assert(curated.key != other.key)
@@ -0,0 +1,36 @@
+import pytest
+import numpy as np
+import os
+
+import ecephys_spike_sorting.common.utils as utils
+from ecephys_spike_sorting.common.synthetic_data import make_synthetic_dataset
+
+def test_make_synthetic_dataset(tmpdir):
+
+	num_channels = 16
+
+	dataset = make_synthetic_dataset(str(tmpdir), num_units = 4, num_channels = num_channels, duration = 2.0, num_pc_channels = 8)
+
+	spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
+	channel_pos, cluster_ids, cluster_quality, cluster_amplitude, pc_features, pc_feature_ind, template_features = \
+		utils.load_kilosort_data(dataset['kilosort_output_directory'], 30000.0, convert_to_seconds = False, include_pcs = True)
+
+	assert(spike_times.size == dataset['num_spikes'])
+	assert(np.all(np.diff(spike_times.astype('int64')) >= 0))
+	assert(np.array_equal(cluster_ids, np.arange(4)))
+	assert(templates.shape == (4, 61, num_channels))
+	assert(pc_features.shape == (spike_times.size, 3, 8))
+	assert(pc_feature_ind.shape == (4, 8))
+	assert(len(cluster_amplitude) == 4)
+
+	# int16 binary with a matching meta file
+	assert(os.path.getsize(dataset['ap_band_file']) == 2 * 30000 * 2 * num_channels)
+	meta = dict(line.split('=', 1) for line in open(dataset['ap_band_file'][:-4] + '.meta').read().splitlines())
+	assert(int(meta['nSavedChans']) == num_channels)
+	assert(int(meta['fileSizeBytes']) == os.path.getsize(dataset['ap_band_file']))
+
+	# spikes are visible in the raw data on the peak channel of their template
+	data = np.memmap(dataset['ap_band_file'], dtype = 'int16', mode = 'r').reshape(-1, num_channels)
+	peak_channels = np.argmin(np.min(templates, 1), 1)
+	troughs = data[spike_times.astype('int64'), peak_channels[spike_clusters]]
+	assert(np.median(troughs) < -5 * np.std(data[:1000, :]))
@@ -0,0 +1,50 @@
+import pytest
+import numpy as np
+
+from scipy.spatial.distance import cdist
+
+from ecephys_spike_sorting.common.unit_neighbors import UnitNeighborIndex
+
+
+@pytest.mark.parametrize('inclusive', [False, True])
+@pytest.mark.parametrize('radius', [0.0, 20.0, 50.0, 1000.0])
+def test_unit_neighbor_index(inclusive, radius):
+
+	rng = np.random.RandomState(0)
+
+	# units on a neuropixels-like grid, so many distances fall exactly on the radius
+	num_channels = 64
+	channel_pos = np.stack((np.tile([0, 32], num_channels // 2), np.repeat(np.arange(num_channels // 2) * 20, 2)), 1).astype('float64')
+	peak_channels = rng.randint(0, num_channels, 100)
+
+	index = UnitNeighborIndex.from_peak_channels(peak_channels, channel_pos)
+
+	distance = cdist(channel_pos[peak_channels], channel_pos[peak_channels])
+	close = distance <= radius if inclusive else distance < radius
+	close[np.diag_indices(peak_channels.size)] = True
+
+	for unit in range(peak_channels.size):
+		assert(np.array_equal(index.neighbors(unit, radius, inclusive), np.where(close[unit])[0]))
+
+	first, second = index.pairs(radius, inclusive)
+	expected_first, expected_second = np.where(np.triu(close, 1))
+
+	assert(np.array_equal(first, expected_first))
+	assert(np.array_equal(second, expected_second))
+
+
+def test_from_templates():
+
+	templates = np.zeros((3, 82, 8))
+	templates[[0, 1, 2], 40, [5, 0, 7]] = -1
+
+	channel_map = np.arange(8) + 100
+	channel_pos = np.stack((np.zeros(8), np.arange(8) * 20.0), 1)
+
+	index = UnitNeighborIndex.from_templates(templates, channel_map, channel_pos)
+
+	assert(np.array_equal(index.peak_channel_idx, [5, 0, 7]))
+	assert(np.array_equal(index.peak_channels, [105, 100, 107]))
+	assert(np.array_equal(index.neighbors(0, 40), [0]))
+	assert(np.array_equal(index.neighbors(0, 40, inclusive = True), [0, 2]))
+	assert(np.array_equal(index.neighbors(2, 140, inclusive = True), [0, 1, 2]))
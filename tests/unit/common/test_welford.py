@@ -0,0 +1,32 @@
+import pytest
+import numpy as np
+
+from ecephys_spike_sorting.common.welford import GroupedWelford
+
+
+def test_grouped_welford():
+
+	rng = np.random.RandomState(0)
+
+	num_groups = 5
+	groups = rng.randint(0, num_groups - 1, 1000)	# last group stays empty
+	samples = (rng.randn(1000, 3, 4) * 50 + 1000).astype('int16')
+
+	accumulator = GroupedWelford(num_groups, (3, 4))
+
+	# blocks of different sizes, mixed across groups
+	bounds = [0, 1, 7, 300, 301, 1000]
+
+	for first, last in zip(bounds[:-1], bounds[1:]):
+		accumulator.update(groups[first:last], samples[first:last], max_block_size = 128)
+
+	variance = accumulator.variance()
+
+	for group in range(num_groups - 1):
+		expected = samples[groups == group].astype('float64')
+		assert(accumulator.count[group] == expected.shape[0])
+		assert(np.allclose(accumulator.mean[group], np.mean(expected, 0)))
+		assert(np.allclose(variance[group], np.var(expected, 0)))
+
+	assert(accumulator.count[-1] == 0)
+	assert(np.all(np.isnan(variance[-1])))
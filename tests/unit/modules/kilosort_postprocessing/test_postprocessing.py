@@ -0,0 +1,240 @@
+import os
+import pytest
+import numpy as np
+
+from ecephys_spike_sorting.modules.kilosort_postprocessing.postprocessing import remove_double_counted_spikes, remove_spikes, replace_compacted_features, \
+	find_within_unit_overlap, find_within_unit_overlaps, align_spike_times_to_peaks, align_spike_times, peak_alignment_shifts, \
+	shift_spike_times
+from ecephys_spike_sorting.common.synthetic_data import make_synthetic_dataset
+from ecephys_spike_sorting.common.utils import load_kilosort_data
+
+
+def make_sorting(seed, num_units = 40, num_channels = 64, duration = 60.0, sample_rate = 30000.0):
+
+	""" Poisson units, plus copies of half the spikes of some units, shifted by a few samples, under other units """
+
+	rng = np.random.RandomState(seed)
+
+	spike_times = []
+	spike_clusters = []
+
+	for unit in range(num_units):
+		num_spikes = rng.poisson(20 * duration)
+		spike_times.append(rng.randint(0, int(duration * sample_rate), num_spikes))
+		spike_clusters.append(np.full((num_spikes,), unit))
+
+	for copy in range(num_units // 2):
+		source = spike_times[rng.randint(num_units)]
+		copied = source[rng.rand(source.size) < 0.5]
+		spike_times.append(copied + [0, 1, 2, 3, 5, 7][rng.randint(6)] + rng.randint(-1, 2, copied.size))
+		spike_clusters.append(np.full((copied.size,), rng.randint(num_units)))
+
+	spike_times = np.concatenate(spike_times)
+	spike_clusters = np.concatenate(spike_clusters)
+
+	order = np.argsort(spike_times, kind = 'stable')
+	spike_times = spike_times[order].astype('uint64')
+	spike_clusters = spike_clusters[order].astype('int32')
+
+	templates = np.zeros((num_units, 82, num_channels))
+	templates[np.arange(num_units), 40, rng.randint(0, num_channels, num_units)] = -1
+
+	channel_pos = np.stack((np.tile([0, 32], num_channels // 2), np.repeat(np.arange(num_channels // 2) * 20, 2)), 1).astype('float64')
+
+	cluster_amplitude = rng.rand(num_units)
+	cluster_amplitude[:4] = cluster_amplitude[4]
+
+	return spike_times, spike_clusters, templates, np.arange(num_channels), channel_pos, cluster_amplitude
+
+
+@pytest.mark.parametrize('deletion_mode', ['lowAmpCluster', 'deleteFirst'])
+@pytest.mark.parametrize('within_window,between_window', [(0.000166, 0.000166), (0.0001, 0.0004), (0.0, 0.0002)])
+def test_between_unit_engines(deletion_mode, within_window, between_window):
+
+	for seed in range(3):
+
+		spike_times, spike_clusters, templates, channel_map, channel_pos, cluster_amplitude = make_sorting(seed)
+
+		params = {'within_unit_overlap_window' : within_window,
+				  'between_unit_overlap_window' : between_window,
+				  'between_unit_dist_um' : 60,
+				  'deletion_mode' : deletion_mode,
+				  'include_pcs' : False}
+
+		results = [remove_double_counted_spikes(spike_times.copy(), spike_clusters.copy(), spike_clusters.copy(),
+												np.arange(spike_times.size), channel_map, channel_pos, templates,
+												None, None, None, cluster_amplitude, 30000.0,
+												dict(params, between_unit_engine = engine))
+				   for engine in ['pairwise', 'sweep']]
+
+		for pairwise, sweep in zip(results[0], results[1]):
+			if pairwise is not None:
+				assert(np.array_equal(pairwise, sweep))
+
+
+def test_memmapped_features_compacted_on_disk(tmpdir_factory):
+
+	output_dir = str(tmpdir_factory.mktemp('features'))
+
+	spike_times, spike_clusters, templates, channel_map, channel_pos, cluster_amplitude = make_sorting(0)
+
+	rng = np.random.RandomState(1)
+	pc_features = rng.rand(spike_times.size, 3, 32).astype('float32')
+	template_features = rng.rand(spike_times.size, 32).astype('float32')
+
+	np.save(os.path.join(output_dir, 'pc_features.npy'), pc_features)
+	np.save(os.path.join(output_dir, 'template_features.npy'), template_features)
+
+	params = {'within_unit_overlap_window' : 0.000166,
+			  'between_unit_overlap_window' : 0.000166,
+			  'between_unit_dist_um' : 60,
+			  'deletion_mode' : 'lowAmpCluster',
+			  'include_pcs' : True,
+			  'compaction_chunk_mb' : 1}
+
+	in_memory = remove_double_counted_spikes(spike_times.copy(), spike_clusters.copy(), spike_clusters.copy(),
+											 np.arange(spike_times.size), channel_map, channel_pos, templates,
+											 pc_features, None, template_features, cluster_amplitude, 30000.0, params)
+
+	memmapped = remove_double_counted_spikes(spike_times.copy(), spike_clusters.copy(), spike_clusters.copy(),
+											 np.arange(spike_times.size), channel_map, channel_pos, templates,
+											 np.load(os.path.join(output_dir, 'pc_features.npy'), mmap_mode = 'r'), None,
+											 np.load(os.path.join(output_dir, 'template_features.npy'), mmap_mode = 'r'),
+											 cluster_amplitude, 30000.0, params)
+
+	assert(in_memory[0].size < spike_times.size)
+
+	for expected, actual in zip(in_memory, memmapped):
+		assert(np.array_equal(expected, actual))
+
+	assert(isinstance(memmapped[4], np.memmap))
+
+	# the originals are only replaced once every map of them is closed
+	assert(np.array_equal(np.load(os.path.join(output_dir, 'pc_features.npy')), pc_features))
+
+	del memmapped
+	replace_compacted_features(os.path.join(output_dir, 'pc_features.npy'))
+	replace_compacted_features(os.path.join(output_dir, 'template_features.npy'))
+
+	assert(np.array_equal(np.load(os.path.join(output_dir, 'pc_features.npy')), in_memory[4]))
+	assert(np.array_equal(np.load(os.path.join(output_dir, 'template_features.npy')), in_memory[5]))
+	assert(sorted(os.listdir(output_dir)) == ['pc_features.npy', 'template_features.npy'])
+
+	# removing spikes by index matches np.delete
+	to_remove = np.array([0, 5, 5, 17])
+	removed = remove_spikes(spike_times, spike_clusters, spike_clusters, spike_times, pc_features, template_features, to_remove, True)
+
+	for original, compacted in zip((spike_times, spike_clusters, spike_clusters, spike_times, pc_features, template_features), removed):
+		assert(np.array_equal(np.delete(original, to_remove, 0), compacted))
+
+
+@pytest.mark.parametrize('overlap_window', [0, 1, 5, 50])
+def test_find_within_unit_overlaps(overlap_window):
+
+	rng = np.random.RandomState(2)
+
+	spike_times = np.sort(rng.randint(0, 200000, 20000)).astype('uint64')
+	spike_clusters = rng.randint(0, 25, spike_times.size)		# clusters 20-24 are not listed
+
+	spikes_to_remove, removed_per_unit = find_within_unit_overlaps(spike_times, spike_clusters, 20, overlap_window)
+
+	expected = []
+
+	for unit in range(20):
+		for_unit = np.where(spike_clusters == unit)[0]
+		to_remove = for_unit[find_within_unit_overlap(spike_times[for_unit].astype('int64'), overlap_window)]
+		assert(removed_per_unit[unit] == to_remove.size)
+		expected.append(to_remove)
+
+	assert(removed_per_unit.size == 20)
+	assert(np.array_equal(spikes_to_remove, np.sort(np.concatenate(expected))))
+
+
+def test_align_spike_times_to_peaks():
+
+	rng = np.random.RandomState(3)
+
+	num_units, num_channels, num_samples = 6, 16, 300000
+	peak_offsets = np.array([19, 15, 25, 19, 30, 10])		# trough position within the snippet
+
+	raw_data = rng.randint(-5, 6, (num_samples, num_channels)).astype('int16')
+
+	spike_times = np.sort(rng.choice(np.arange(100, num_samples - 100), 3000, replace = False)).astype('uint64')
+	spike_clusters = rng.randint(0, num_units + 1, spike_times.size)		# last cluster has no template
+	spike_clusters[:5] = 5		# unit 5 has too few spikes to be shifted
+	spike_clusters[5:][spike_clusters[5:] == 5] = 0
+
+	templates = np.zeros((num_units, 82, num_channels))
+	channel_map = np.arange(num_channels)[::-1]
+	template_peaks = rng.randint(0, num_channels, num_units)
+	templates[np.arange(num_units), 40, template_peaks] = -1
+
+	for unit in range(num_units):
+		starts = spike_times[spike_clusters == unit].astype('int64') - 20 + peak_offsets[unit]
+		raw_data[starts, channel_map[template_peaks[unit]]] = -1000
+
+	aligned = align_spike_times_to_peaks(spike_times, spike_clusters, raw_data, templates, channel_map,
+										 samples_per_spike = 82, pre_samples = 20, spikes_per_unit = 200, chunk_bytes = 2**14)
+
+	expected_shift = np.concatenate((19 - peak_offsets[:5], [0, 0]))
+
+	assert(aligned.dtype == spike_times.dtype)
+	assert(np.array_equal(aligned.astype('int64'), spike_times.astype('int64') - expected_shift[spike_clusters]))
+
+
+def test_peak_alignment_shifts():
+
+	rng = np.random.RandomState(4)
+
+	peak_waveforms = rng.randn(500, 82) * rng.choice([5, 20, 60], (500, 1))
+	spike_counts = rng.randint(0, 20, 500)
+
+	shift = peak_alignment_shifts(peak_waveforms, spike_counts, 20)
+
+	# per-unit rule used when aligning to C_Waves mean waveforms
+	for unit in range(500):
+
+		wave = peak_waveforms[unit]
+		min_v, max_v = abs(np.min(wave)), abs(np.max(wave))
+		min_t, max_t = np.argmin(wave), np.argmax(wave)
+
+		if min_v > 30 and max_v > 30:
+			mean_peak_time = min(min_t, max_t)
+		else:
+			mean_peak_time = min_t if min_v >= max_v else max_t
+
+		assert(shift[unit] == (19 - mean_peak_time if spike_counts[unit] > 10 else 0))
+
+
+def test_align_engines_agree(tmpdir):
+
+	num_channels = 32
+
+	dataset = make_synthetic_dataset(str(tmpdir), num_units = 12, num_channels = num_channels, duration = 20.0, num_pc_channels = 8)
+	output_dir = dataset['kilosort_output_directory']
+
+	spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
+		channel_pos, clusterIDs, cluster_quality, cluster_amplitude = \
+		load_kilosort_data(output_dir, 30000.0, convert_to_seconds = False)
+
+	data = np.memmap(dataset['ap_band_file'], dtype = 'int16', mode = 'r').reshape(-1, num_channels)
+
+	python_aligned = align_spike_times_to_peaks(spike_times, spike_clusters, data, templates, channel_map, 0.195,
+												samples_per_spike = 82, pre_samples = 20, spikes_per_unit = 5000, chunk_bytes = 2**20)
+
+	c_waves_aligned = align_spike_times(spike_times, spike_clusters, dataset['ap_band_file'], output_dir, None, 'python', 0.195,
+										samples_per_spike = 82, pre_samples = 20, spikes_per_unit = 5000)
+
+	assert(np.any(python_aligned != spike_times))
+	assert(np.array_equal(python_aligned, c_waves_aligned))
+
+
+def test_shift_spike_times_clips_at_zero():
+
+	spike_times = np.array([0, 1, 5, 100, 2, 3], dtype = 'uint64')
+	spike_clusters = np.array([0, 0, 0, 0, 1, 2])
+
+	shifted = shift_spike_times(spike_times, spike_clusters, np.array([2, -3]))
+
+	assert(shifted.dtype == spike_times.dtype)
+	assert(np.array_equal(shifted, [0, 0, 3, 98, 5, 3]))
@@ -0,0 +1,53 @@
+import pytest
+import numpy as np
+import os
+
+from scipy.io import loadmat
+
+from ecephys_spike_sorting.common.synthetic_data import make_synthetic_dataset
+from ecephys_spike_sorting.common.utils import load_kilosort_data
+from ecephys_spike_sorting.common.epoch import Epoch
+from ecephys_spike_sorting.modules.mean_waveforms.extract_waveforms import extract_waveforms
+
+
+def test_extract_waveforms_epochs(tmpdir):
+
+	num_channels = 16
+
+	dataset = make_synthetic_dataset(str(tmpdir), num_units = 4, num_channels = num_channels, duration = 4.0, firing_rate = 10.0, num_pc_channels = 8)
+
+	spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
+		channel_pos, clusterIDs, cluster_quality, cluster_amplitude = \
+		load_kilosort_data(dataset['kilosort_output_directory'], 30000.0, convert_to_seconds = False)
+
+	data = np.memmap(dataset['ap_band_file'], dtype = 'int16', mode = 'r').reshape(-1, num_channels)
+	chan_map = loadmat(os.path.splitext(dataset['ap_band_file'])[0] + '_chanMap.mat')
+
+	params = {'samples_per_spike' : 82, 'pre_samples' : 20, 'num_epochs' : 1, 'spikes_per_epoch' : 1000,
+			  'upsampling_factor' : 200/82, 'spread_threshold' : 0.12, 'site_range' : 4,
+			  'snippet_buffer_mb' : 1, 'read_chunk_mb' : 1}
+
+	# the complete session is added after the given epochs
+	epochs = [Epoch('first', 0, 1.5), Epoch('second', 1.5, np.inf)]
+
+	results = {}
+
+	for streaming in [False, True]:
+		params['streaming_mean_waveforms'] = streaming
+		results[streaming] = extract_waveforms(data, spike_times, spike_clusters, templates, channel_map, 0.195, 30000.0, 20e-6,
+											   np.squeeze(chan_map['xcoords']), np.squeeze(chan_map['ycoords']), params, epochs)
+
+	mean_waveforms, spike_count, dimCoords, dimLabels, metrics = results[False]
+
+	assert(mean_waveforms.shape == (4, 3, 2, num_channels, 82))
+	assert(list(metrics['epoch_name'].unique()) == ['first', 'second', 'complete_session'])
+
+	# every spike is chosen, so the session mean is the count-weighted mean of the epochs
+	assert(np.array_equal(spike_count[:, 2], spike_count[:, 0] + spike_count[:, 1]))
+
+	weighted = (mean_waveforms[:, 0, 0] * spike_count[:, 0, np.newaxis, np.newaxis] +
+				mean_waveforms[:, 1, 0] * spike_count[:, 1, np.newaxis, np.newaxis]) / spike_count[:, 2, np.newaxis, np.newaxis]
+	assert(np.allclose(mean_waveforms[:, 2, 0], weighted))
+
+	assert(np.allclose(results[True][0], mean_waveforms))
+	assert(np.array_equal(results[True][1], spike_count))
@@ -0,0 +1,110 @@
+import pytest
+import numpy as np
+
+from scipy.signal import resample
+
+from ecephys_spike_sorting.modules.mean_waveforms.waveform_metrics import calculate_waveform_metrics_from_avg, \
+	Upsampler, calculate_waveform_metrics_batch, calculate_1D_features, calculate_waveform_duration, \
+	calculate_waveform_halfwidth, calculate_waveform_PT_ratio, calculate_waveform_repolarization_slope, \
+	calculate_waveform_recovery_slope, calculate_2D_features, features_2D_for_units
+
+
+def test_calculate_1D_features():
+
+	rng = np.random.RandomState(0)
+
+	timestamps = np.linspace(0, 82 / 30000, 200)
+
+	# spike-like waveforms of both polarities, and one positive-first
+	# waveform whose halfwidth crossings are missing
+	shape = -np.exp(-((np.arange(200) - 60) / 8.0)**2) + 0.4 * np.exp(-((np.arange(200) - 100) / 20.0)**2)
+	waveforms = np.array([shape * a + rng.randn(200) * 0.01 for a in [50, 80, -60]])
+	waveforms = np.vstack((waveforms, np.linspace(1, 0, 200)))
+
+	features = calculate_1D_features(waveforms, timestamps)
+
+	for i, waveform in enumerate(waveforms[:3]):
+		assert(np.isclose(features[0][i], calculate_waveform_duration(waveform, timestamps)))
+		assert(np.isclose(features[1][i], calculate_waveform_halfwidth(waveform, timestamps)))
+		assert(np.isclose(features[2][i], calculate_waveform_PT_ratio(waveform)))
+		assert(np.isclose(features[3][i], calculate_waveform_repolarization_slope(waveform, timestamps)))
+		assert(np.isclose(features[4][i], calculate_waveform_recovery_slope(waveform, timestamps)))
+
+	assert(np.isnan(features[1][3]))
+
+
+def test_calculate_waveform_metrics_batch():
+
+	rng = np.random.RandomState(1)
+
+	num_channels = 16
+	site_x = np.tile([0, 32], num_channels // 2)
+	site_y = np.repeat(np.arange(num_channels // 2) * 20, 2)
+
+	t = np.arange(82)
+	channel_gain = np.exp(-np.abs(np.arange(num_channels)[:, np.newaxis] - 6) / 3.0)
+	waveforms = np.array([-channel_gain * np.exp(-((t - 20 - 0.5 * np.arange(num_channels)[:, np.newaxis]) / (2.0 + u))**2) * 100
+						  + rng.randn(num_channels, 82) for u in range(4)])
+
+	peak_channels = np.array([6, 6, 5, 7])
+	snr = np.array([1.0, 2.0, 3.0, 4.0])
+	cluster_ids = np.array([3, 8, 9, 12])
+
+	metrics = calculate_waveform_metrics_batch(waveforms, snr, cluster_ids, peak_channels, np.arange(num_channels),
+											   30000.0, 200/82, 0.12, 4, site_x, site_y, epoch_names = 'epoch_1')
+
+	assert(metrics.shape == (4, 13))
+
+	for i in range(4):
+		expected = calculate_waveform_metrics_from_avg(waveforms[i], snr[i], cluster_ids[i], peak_channels[i], np.arange(num_channels),
+													   30000.0, 200/82, 0.12, 4, site_x, site_y, epoch_name = 'epoch_1')
+		row = metrics.iloc[i]
+		assert(row['cluster_id'] == cluster_ids[i] and row['epoch_name'] == 'epoch_1')
+		for column in expected.columns[2:]:
+			assert(np.isclose(row[column], expected[column].values[0], equal_nan = True))
+
+
+def test_features_2D_for_units():
+
+	rng = np.random.RandomState(2)
+
+	# two shanks of two columns, so units on either shank share peak channels
+	site_x = np.concatenate((np.tile([0, 32], 24), np.tile([250, 282], 24))).astype('float64')
+	site_y = np.tile(np.repeat(np.arange(24) * 15, 2), 2).astype('float64')
+
+	waveforms = rng.randn(12, 96, 82)
+	waveforms[3, :, :] = 0			# no nearest neighbour with signal
+	peak_channels = np.array([10, 10, 10, 10, 60, 60, 61, 0, 95, 47, 48, 10])
+
+	timestamps = np.linspace(0, 82 / 30000, 82)
+
+	features = features_2D_for_units(waveforms, timestamps, peak_channels, site_x, site_y, 0.12, 8)
+
+	for i in range(12):
+		expected = calculate_2D_features(waveforms[i], timestamps, peak_channels[i], site_x, site_y, 0.12, 8)
+		assert(np.allclose(features[i], expected, equal_nan = True))
+
+	metrics = calculate_waveform_metrics_batch(waveforms, np.ones(12), np.arange(12), peak_channels, np.arange(96),
+											   30000.0, 1, 0.12, 8, site_x, site_y, n_jobs = 2, parallel_backend = 'threading')
+
+	assert(np.allclose(metrics[['amplitude', 'spread', 'velocity_above', 'velocity_below']].values, features, equal_nan = True))
+
+
+@pytest.mark.parametrize('num_samples,upsampling_factor,window', [
+	(82, 200/82, None),
+	(81, 200/81, None),
+	(82, 0.5, None),
+	(61, 3.0, 'hann')
+])
+def test_upsampler(num_samples, upsampling_factor, window):
+
+	rng = np.random.RandomState(3)
+
+	waveforms = rng.randn(5, num_samples)
+	new_sample_count = int(num_samples * upsampling_factor)
+
+	upsampler = Upsampler(num_samples, upsampling_factor, 30000.0, window)
+
+	assert(np.allclose(upsampler.resample(waveforms), resample(waveforms, new_sample_count, axis = 1, window = window)))
+	assert(np.allclose(upsampler.resample(waveforms[0]), resample(waveforms[0], new_sample_count, window = window)))
+	assert(np.allclose(upsampler.timestamps, np.linspace(0, num_samples / 30000.0, new_sample_count)))
@@ -0,0 +1,55 @@
+import pytest
+import numpy as np
+import os
+import importlib.util
+
+from ecephys_spike_sorting.modules.mean_waveforms.waveform_store import write_waveform_store, open_waveform_store, \
+	load_unit_waveform, read_unit_index, store_engine
+
+
+@pytest.mark.parametrize('extension', ['.zarr', '.nc'])
+def test_waveform_store(tmpdir, extension):
+
+	if extension == '.zarr':
+		pytest.importorskip('zarr')
+	elif importlib.util.find_spec('netCDF4') is None:
+		# either netCDF4 or h5netcdf can write the .nc store
+		pytest.importorskip('h5netcdf')
+
+	rng = np.random.RandomState(0)
+
+	mean_waveforms = rng.randn(6, 2, 2, 8, 82)
+	spike_count = rng.randint(0, 100, (6, 3))
+	cluster_ids = np.arange(10, 16)
+	peak_channels = np.array([0, 3, 7, -1, 2, 2])
+
+	store_path = os.path.join(str(tmpdir), 'mean_waveforms' + extension)
+
+	index_path = write_waveform_store(mean_waveforms, spike_count, cluster_ids, peak_channels,
+									  ['epoch_1', 'complete_session'], 20, 30000.0, store_path)
+
+	assert(index_path == os.path.join(str(tmpdir), 'mean_waveforms_unit_index.csv'))
+
+	index = read_unit_index(store_path)
+	assert(np.array_equal(index['cluster_id'], cluster_ids))
+	assert(np.array_equal(index['peak_channel'], peak_channels))
+	assert(np.array_equal(index['spike_count'], spike_count[:, 1]))
+
+	ds = open_waveform_store(store_path)
+	assert(ds['waveforms'].encoding['chunks' if extension == '.zarr' else 'chunksizes'] == (1, 2, 2, 8, 82))
+	assert(ds['waveforms'].shape == (6, 2, 2, 8, 82))
+	ds.close()
+
+	assert(np.allclose(load_unit_waveform(store_path, 13), mean_waveforms[3, 1], atol = 1e-6))
+	assert(np.allclose(load_unit_waveform(store_path, 14, 'epoch_1'), mean_waveforms[4, 0], atol = 1e-6))
+
+
+def test_store_engine_missing_backend(monkeypatch):
+
+	monkeypatch.setattr(importlib.util, 'find_spec', lambda name: None)
+
+	with pytest.raises(ImportError, match = 'netCDF4 or h5netcdf'):
+		store_engine('mean_waveforms.nc')
+
+	with pytest.raises(ImportError, match = 'zarr'):
+		store_engine('mean_waveforms.zarr')
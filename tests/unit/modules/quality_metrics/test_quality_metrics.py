@@ -3,6 +3,7 @@ import numpy as np
 import os
 
 from ecephys_spike_sorting.modules.quality_metrics.metrics import calculate_metrics
+from ecephys_spike_sorting.modules.quality_metrics import metrics as qm
 import ecephys_spike_sorting.common.utils as utils
 
 DATA_DIR = os.environ.get('ECEPHYS_SPIKE_SORTING_DATA', False)
@@ -31,6 +32,312 @@ def te_st_quality_metrics():
 
 	print(metrics)
 
+@pytest.mark.parametrize('use_numba', [False, pytest.param(True, marks = pytest.mark.skipif(not qm.HAS_NUMBA, reason = 'numba not installed'))])
+def test_ccg_matches_loop(use_numba, monkeypatch):
+
+	# use_numba = False checks the numpy ccg_counts path even where numba is installed
+	monkeypatch.setattr(qm, 'HAS_NUMBA', use_numba)
+
+	rng = np.random.default_rng(0)
+
+	st1 = np.sort(rng.uniform(0, 60, 3000))
+	st2 = np.sort(rng.uniform(0, 60, 2000))
+	# add near-coincident spikes to populate the central bins
+	st2 = np.sort(np.concatenate((st2, st1[::10] + rng.normal(0, 0.002, 300))))
+
+	for a, b, auto in ((st1, st1, True), (st2, st2, True), (st2, st1, False)):
+
+		expected = qm.ccg_loop(a, b, 500, 0.001, auto)
+		actual = qm.ccg(a, b, 500, 0.001, auto)
+
+		for e, x in zip(expected, actual):
+			assert(np.allclose(e, x))
+
+def test_ccg_counts_chunked():
+
+	rng = np.random.default_rng(1)
+
+	st = np.sort(rng.uniform(0, 20, 2000))
+
+	K_full = qm.ccg_counts(st, st, 100, 0.001)
+	K_chunked = qm.ccg_counts(st, st, 100, 0.001, max_pairs = 50)
+
+	assert(np.array_equal(K_full, K_chunked))
+
+def test_batched_spike_train_metrics():
+
+	rng = np.random.default_rng(2)
+
+	total_units = 8
+	spike_clusters = rng.integers(0, total_units - 1, 20000)   # last unit has no spikes
+	spike_times = np.sort(rng.uniform(0, 100, spike_clusters.size))
+	spike_times[1::50] = spike_times[0::50][:spike_times[1::50].size]   # duplicate spikes
+
+	viol_rates, num_viol = qm.calculate_isi_violations(spike_times, spike_clusters, total_units, 0.0015, 0.0)
+	ratios = qm.calculate_presence_ratio(spike_times, spike_clusters, total_units)
+	rates = qm.calculate_firing_rate(spike_times, spike_clusters, total_units)
+
+	min_time = np.min(spike_times)
+	max_time = np.max(spike_times)
+
+	for cluster_id in range(total_units - 1):
+
+		train = spike_times[spike_clusters == cluster_id]
+
+		fpRate, num_violations = qm.isi_violations(train, min_time, max_time, 0.0015, 0.0)
+		assert(np.isclose(viol_rates[cluster_id], fpRate))
+		assert(num_viol[cluster_id] == num_violations)
+		assert(np.isclose(ratios[cluster_id], qm.presence_ratio(train, min_time, max_time)))
+		assert(np.isclose(rates[cluster_id], qm.firing_rate(train, min_time, max_time)))
+
+	assert(viol_rates[-1] == 0 and ratios[-1] == 0 and rates[-1] == 0)
+
+def make_pc_features(rng, num_units = 6, spikes_per_unit = 200, num_channels = 16, num_pcs = 3, num_feature_channels = 8):
+
+	spike_clusters = np.repeat(np.arange(num_units), spikes_per_unit)
+	rng.shuffle(spike_clusters)
+
+	channel_pos = np.zeros((num_channels, 2))
+	channel_pos[:,1] = np.arange(num_channels) * 10
+
+	# peak channel of each unit is in the middle of its feature channels, one site apart
+	half_width = num_feature_channels // 2
+	pc_feature_ind = np.zeros((num_units, num_feature_channels), dtype = 'int64')
+	for unit in range(num_units):
+		pc_feature_ind[unit,:] = np.arange(num_feature_channels) + unit
+
+	pc_features = rng.normal(0, 1, (spike_clusters.size, num_pcs, num_feature_channels))
+	pc_features[:,0,half_width] += 10
+	pc_features[:,1,half_width] += spike_clusters
+
+	return spike_clusters, pc_features, pc_feature_ind, channel_pos
+
+def test_pc_metrics_parallel_matches_serial():
+
+	rng = np.random.default_rng(3)
+
+	spike_clusters, pc_features, pc_feature_ind, channel_pos = make_pc_features(rng)
+	cluster_ids = np.unique(spike_clusters)
+
+	results = []
+
+	for n_jobs in (1, 2):
+
+		np.random.seed(0)
+		results.append(qm.calculate_pc_metrics(spike_clusters, spike_clusters, cluster_ids.size, cluster_ids, cluster_ids, 
+								pc_features, pc_feature_ind, channel_pos, 25, 500, 10000, 4,
+								n_jobs = n_jobs, parallel_backend = 'loky'))
+
+	for serial, parallel in zip(results[0], results[1]):
+		assert(np.allclose(serial, parallel, equal_nan = True))
+
+	assert(np.sum(np.isfinite(results[0][0])) > 0)
+
+def test_pc_metrics_memmap_rows(tmpdir):
+
+	rng = np.random.default_rng(4)
+
+	spike_clusters, pc_features, pc_feature_ind, channel_pos = make_pc_features(rng)
+	cluster_ids = np.unique(spike_clusters)
+
+	np.save(os.path.join(tmpdir, 'pc_features.npy'), pc_features)
+	mapped = utils.load(tmpdir, 'pc_features.npy', mmap_mode = 'r')
+
+	# every other spike, as for an epoch
+	in_epoch = np.arange(spike_clusters.size) % 2 == 0
+	epoch_rows = np.where(in_epoch)[0]
+	epoch_clusters = spike_clusters[in_epoch]
+
+	np.random.seed(0)
+	copied = qm.calculate_pc_metrics(epoch_clusters, epoch_clusters, cluster_ids.size, cluster_ids, cluster_ids, 
+							pc_features[in_epoch,:,:], pc_feature_ind, channel_pos, 25, 500, 10000, 4)
+
+	np.random.seed(0)
+	rows = qm.calculate_pc_metrics(epoch_clusters, epoch_clusters, cluster_ids.size, cluster_ids, cluster_ids, 
+							mapped, pc_feature_ind, channel_pos, 25, 500, 10000, 4,
+							pc_feature_rows = epoch_rows)
+
+	for a, b in zip(copied, rows):
+		assert(np.allclose(a, b, equal_nan = True))
+
+def test_silhouette_score_matches_sklearn():
+
+	from sklearn.metrics import silhouette_score
+
+	rng = np.random.default_rng(5)
+
+	spike_clusters, pc_features, pc_feature_ind, channel_pos = make_pc_features(rng, spikes_per_unit = 50)
+	spike_clusters[0] = 7 # single-spike cluster
+	total_units = 8
+
+	# small blocks, to exercise the blocked distance sums
+	scores = qm.calculate_silhouette_score(spike_clusters, spike_clusters % 6, total_units, pc_features, pc_feature_ind, 
+							spike_clusters.size, seed = 1, max_block_size = 1000)
+
+	# reference: sklearn for every pair of clusters
+	max_channel = np.max(pc_feature_ind)
+	all_pcs = np.zeros((spike_clusters.size, max_channel * pc_features.shape[1] + 1))
+	for i in range(spike_clusters.size):
+		for j in range(pc_features.shape[1]):
+			all_pcs[i, pc_feature_ind[spike_clusters[i] % 6,:] + max_channel * j] = pc_features[i,j,:]
+
+	SS = np.full((total_units, total_units), np.nan)
+	cluster_ids = np.unique(spike_clusters)
+	for i in cluster_ids:
+		for j in cluster_ids[cluster_ids > i]:
+			inds = np.isin(spike_clusters, [i, j])
+			if np.sum(inds) > 2:
+				SS[i,j] = silhouette_score(all_pcs[inds], spike_clusters[inds])
+
+	expected = np.fmin(np.nanmin(SS, 0), np.nanmin(SS, 1))
+
+	assert(np.allclose(scores, expected, equal_nan = True))
+
+	# same seed, same subsample
+	assert(np.array_equal(qm.calculate_silhouette_score(spike_clusters, spike_clusters % 6, total_units, pc_features, pc_feature_ind, 100, seed = 3),
+						  qm.calculate_silhouette_score(spike_clusters, spike_clusters % 6, total_units, pc_features, pc_feature_ind, 100, seed = 3),
+						  equal_nan = True))
+
+def test_drift_metrics_depth_matrix():
+
+	rng = np.random.default_rng(6)
+
+	spike_clusters, pc_features, pc_feature_ind, channel_pos = make_pc_features(rng, spikes_per_unit = 300)
+	spike_times = np.sort(rng.uniform(0, 100, spike_clusters.size))
+	spike_times[10] = 20.0 # on an interval boundary
+	unit_template_ids = np.arange(6)
+	interval_length = 10
+	min_spikes = 5
+
+	max_drift, cumulative_drift, median_depths, interval_starts = qm.calculate_drift_metrics(spike_times, spike_clusters, spike_clusters, 
+							unit_template_ids, 6, pc_features, pc_feature_ind, channel_pos, interval_length, min_spikes, 
+							return_depth_matrix = True)
+
+	first_pc_sq = np.copy(pc_features[:,0,:])
+	first_pc_sq[first_pc_sq < 0] = 0
+	depths = utils.get_spike_depths(spike_clusters, unit_template_ids, first_pc_sq ** 2, pc_feature_ind, channel_pos)
+
+	assert(median_depths.shape == (6, interval_starts.size))
+
+	for unit in range(6):
+		for idx, t1 in enumerate(interval_starts):
+			in_range = (spike_clusters == unit) * (spike_times > t1) * (spike_times < t1 + interval_length)
+			if np.sum(in_range) >= min_spikes:
+				assert(np.isclose(median_depths[unit, idx], np.median(depths[in_range])))
+			else:
+				assert(np.isnan(median_depths[unit, idx]))
+
+		assert(np.isclose(max_drift[unit], np.around(np.nanmax(median_depths[unit]) - np.nanmin(median_depths[unit]), 2)))
+		assert(np.isclose(cumulative_drift[unit], np.around(np.nansum(np.abs(np.diff(median_depths[unit]))), 2)))
+
+def test_cluster_fingerprints():
+
+	rng = np.random.default_rng(7)
+	spike_clusters = rng.integers(0, 10, 1000)
+
+	counts, hashes = qm.cluster_fingerprints(spike_clusters)
+
+	assert(np.array_equal(counts, np.bincount(spike_clusters)))
+	assert(qm.find_changed_clusters(counts, hashes, spike_clusters).size == 0)
+
+	# merge 3 into 2, and split some spikes of 7 into a new cluster 10
+	curated = np.copy(spike_clusters)
+	curated[curated == 3] = 2
+	curated[np.where(curated == 7)[0][::2]] = 10
+
+	assert(np.array_equal(qm.find_changed_clusters(counts, hashes, curated), [2, 3, 7, 10]))
+
+	# moving one spike between clusters is detected, even with equal counts
+	swapped = np.copy(spike_clusters)
+	i0 = np.where(swapped == 0)[0][0]
+	i1 = np.where(swapped == 1)[0][0]
+	swapped[i0], swapped[i1] = 1, 0
+
+	assert(np.array_equal(qm.find_changed_clusters(counts, hashes, swapped), [0, 1]))
+
+
+def test_find_units_to_update():
+
+	channel_pos = np.zeros((16, 2))
+	channel_pos[:,1] = np.arange(16) * 10
+
+	cluster_ids = np.arange(8)
+	peak_channels = np.arange(8) * 2
+	previous_peak_channels = np.append(np.arange(8) * 2, 15)
+
+	# cluster 8 (peak 15) was merged into cluster 1 (peak 2)
+	units = qm.find_units_to_update(cluster_ids, np.array([1, 8]), peak_channels, previous_peak_channels, 
+									np.arange(9), channel_pos, 25)
+
+	assert(np.array_equal(units, [0, 1, 2, 7]))
+
+	# no earlier peaks: everything is recomputed
+	assert(np.array_equal(qm.find_units_to_update(cluster_ids, np.array([1]), peak_channels, None, np.arange(9), channel_pos, 25), cluster_ids))
+
+
+def test_incremental_metrics_reuse_unchanged_units():
+
+	rng = np.random.default_rng(8)
+
+	spike_clusters, pc_features, pc_feature_ind, channel_pos = make_pc_features(rng)
+	spike_times = np.sort(rng.uniform(0, 100, spike_clusters.size))
+	amplitudes = rng.uniform(50, 100, spike_clusters.size)
+
+	params = {'isi_threshold' : 0.0015, 'min_isi' : 0.0, 'tbin_sec' : 0.001, 'max_radius_um' : 25, 
+			  'max_spikes_for_unit' : 500, 'max_spikes_for_nn' : 10000, 'n_neighbors' : 4, 'n_silhouette' : 1000, 
+			  'silhouette_seed' : 0, 'drift_metrics_min_spikes_per_interval' : 10, 'drift_metrics_interval_s' : 10, 
+			  'include_pcs' : True, 'n_jobs' : 1, 'parallel_backend' : 'loky'}
+
+	metrics, peak_channels = calculate_metrics(spike_times, spike_clusters, spike_clusters, amplitudes, np.arange(16), channel_pos, 
+							None, pc_features, pc_feature_ind, params, return_peak_channels = True)
+
+	# nothing changed: all PC metrics are copied from the earlier run
+	again = calculate_metrics(spike_times, spike_clusters, spike_clusters, amplitudes, np.arange(16), channel_pos, 
+							None, pc_features, pc_feature_ind, params, 
+							previous_metrics = metrics, changed_clusters = np.array([], dtype = 'int64'), 
+							previous_peak_channels = peak_channels)
+
+	assert(np.allclose(metrics.drop(columns = 'epoch_name').values, again.drop(columns = 'epoch_name').values, equal_nan = True))
+
+	# curation moves spikes from cluster 5 to cluster 4 (peak channels 9 and 8), so the
+	# recomputed units are not the first ones; each unit is subsampled to 50 spikes
+	curated_clusters = spike_clusters.copy()
+	moved = np.where(spike_clusters == 5)[0][:40]
+	curated_clusters[moved] = 4
+
+	counts, hashes = qm.cluster_fingerprints(spike_clusters)
+	changed_clusters = qm.find_changed_clusters(counts, hashes, curated_clusters)
+	assert(np.array_equal(changed_clusters, [4, 5]))
+
+	params['max_spikes_for_unit'] = 50
+
+	np.random.seed(0)
+	full = calculate_metrics(spike_times, curated_clusters, spike_clusters, amplitudes, np.arange(16), channel_pos, 
+							 None, pc_features, pc_feature_ind, params)
+
+	np.random.seed(0)
+	previous = calculate_metrics(spike_times, spike_clusters, spike_clusters, amplitudes, np.arange(16), channel_pos, 
+								 None, pc_features, pc_feature_ind, params)
+
+	for n_jobs in (1, 2):
+
+		params['n_jobs'] = n_jobs
+
+		np.random.seed(0)
+		incremental = calculate_metrics(spike_times, curated_clusters, spike_clusters, amplitudes, np.arange(16), channel_pos, 
+										None, pc_features, pc_feature_ind, params, 
+										previous_metrics = previous, changed_clusters = changed_clusters, 
+										previous_peak_channels = peak_channels)
+
+		assert(np.allclose(full.drop(columns = 'epoch_name').values, incremental.drop(columns = 'epoch_name').values, equal_nan = True))
+
+	pc_columns = ['isolation_distance', 'l_ratio', 'd_prime', 'nn_hit_rate', 'nn_miss_rate']
+
+	# units 2 to 5 are recomputed; units 0 and 1 (peaks 30 um or more from
+	# channels 8 and 9) keep their earlier values
+	assert(not np.allclose(previous.loc[[4, 5], pc_columns].values, incremental.loc[[4, 5], pc_columns].values, equal_nan = True))
+	assert(np.array_equal(previous.loc[[0, 1], pc_columns].values, incremental.loc[[0, 1], pc_columns].values, equal_nan = True))
+
 if __name__ == "__main__":
     #test_quality_metrics()
     pass
\ No newline at end of file